@@ -0,0 +1,262 @@
+import re
+
+from esquema_consulta import OCURRENCIAS_BOOL
+
+# Campos de los hoteles de top_hits: lo justo para nombrarlos en la respuesta
+CAMPOS_TOP_HITS = ["nombre", "localidad", "provincia", "precio", "opinion", "comentarios", "url"]
+
+# Cómo se nombra cada métrica en la respuesta
+METRICAS = {
+    "precio": {"min": "el precio mínimo", "max": "el precio máximo", "avg": "el precio medio"},
+    "opinion": {"min": "la peor opinión", "max": "la mejor opinión", "avg": "la opinión media"},
+    "comentarios": {"min": "el mínimo de comentarios", "max": "el máximo de comentarios", "avg": "la media de comentarios"},
+}
+
+# (singular, plural) del hotel que encabeza cada orden de top_hits
+SUPERLATIVOS = {
+    ("precio", "asc"): ("más barato", "más baratos"),
+    ("precio", "desc"): ("más caro", "más caros"),
+    ("opinion", "desc"): ("mejor valorado", "mejor valorados"),
+    ("opinion", "asc"): ("peor valorado", "peor valorados"),
+    ("comentarios", "desc"): ("con más comentarios", "con más comentarios"),
+    ("comentarios", "asc"): ("con menos comentarios", "con menos comentarios"),
+}
+
+# Cada documento es un hotel en una fecha: los hoteles distintos se cuentan con cardinality sobre el
+# nombre. Si el índice no tiene nombre.keyword, las cifras son de fechas disponibles, no de hoteles
+AGREGACION_HOTELES = "hoteles_distintos"
+
+TERMS = {
+    "servicios": "los servicios más frecuentes",
+    "localidad": "las localidades con más hoteles",
+    "provincia": "las provincias con más hoteles",
+    "nombre": "los nombres más repetidos",
+}
+
+
+def es_agregacion(consulta: dict) -> bool:
+    """Modo agregación: size 0, la respuesta sale del total y de las agregaciones, sin documentos."""
+    return consulta.get("size") == 0
+
+
+def campo_hotel(mapeo: dict):
+    """Campo keyword con el que contar hoteles distintos, o None si el índice no lo tiene."""
+    return "nombre.keyword" if mapeo.get("nombre.keyword") == "keyword" else None
+
+
+def cuerpo_agregaciones(consulta: dict, campo_hoteles: str = None) -> dict:
+    """La consulta lista para buscar: total exacto, top_hits solo con los campos de la plantilla y,
+    con campo_hoteles, el número de hoteles distintos (también en cada cubo de terms)."""
+    contar = {"cardinality": {"field": campo_hoteles}} if campo_hoteles else None
+    agregaciones = {}
+    for nombre, agregacion in consulta.get("aggs", {}).items():
+        if "top_hits" in agregacion:
+            agregacion = {**agregacion, "top_hits": {"_source": CAMPOS_TOP_HITS, **agregacion["top_hits"]}}
+        if contar and "terms" in agregacion:
+            agregacion = {**agregacion, "aggs": {**agregacion.get("aggs", {}), AGREGACION_HOTELES: contar}}
+        agregaciones[nombre] = agregacion
+    if contar:
+        agregaciones[AGREGACION_HOTELES] = contar
+    cuerpo = {**consulta, "track_total_hits": True}
+    if agregaciones:
+        cuerpo["aggs"] = agregaciones
+    return cuerpo
+
+
+def total_resultados(resultados) -> int:
+    total = resultados.get("hits", {}).get("total", 0)
+    return total.get("value", 0) if isinstance(total, dict) else total
+
+
+def sin_resultados(consulta: dict, resultados) -> bool:
+    if es_agregacion(consulta):
+        return total_resultados(resultados) == 0
+    return not resultados.get("hits", {}).get("hits")
+
+
+def numero(valor, decimales: int = 0) -> str:
+    """Formato español: 1.234,50."""
+    texto = f"{valor:,.{decimales}f}"
+    return texto.replace(",", "_").replace(".", ",").replace("_", ".")
+
+
+def valor_campo(campo: str, valor, media: bool = False) -> str:
+    if valor is None:
+        return "sin datos"
+    if campo == "precio":
+        return f"{numero(valor, 2 if media and valor % 1 else 0)} €"
+    if campo == "opinion":
+        return numero(valor, 1)
+    return numero(valor, 1 if media and valor % 1 else 0)
+
+
+def cuantos(resultado: dict, filas: int) -> str:
+    """ "3 hoteles" con el cardinality de AGREGACION_HOTELES; si no está, "12 fechas disponibles" (filas)."""
+    hoteles = resultado.get(AGREGACION_HOTELES, {}).get("value")
+    if hoteles is not None:
+        return f"{numero(hoteles)} {'hotel' if hoteles == 1 else 'hoteles'}"
+    return f"{numero(filas)} {'fecha disponible' if filas == 1 else 'fechas disponibles'}"
+
+
+def enumerar(elementos: list) -> str:
+    if len(elementos) <= 1:
+        return "".join(elementos)
+    return ", ".join(elementos[:-1]) + " y " + elementos[-1]
+
+
+def _fecha(valor: str) -> str:
+    anio, mes, dia = str(valor)[:10].split("-")
+    return f"{dia}/{mes}/{anio}"
+
+
+def _texto(valor):
+    return valor.get("query", valor.get("value")) if isinstance(valor, dict) else valor
+
+
+def _rango(campo: str, limites: dict) -> str:
+    formato = _fecha if campo == "fechaEntrada" else (lambda v: valor_campo(campo, v))
+    desde = next((formato(limites[o]) for o in ("gte", "gt") if o in limites), None)
+    hasta = next((formato(limites[o]) for o in ("lte", "lt") if o in limites), None)
+    if desde and hasta:
+        return f"entre {desde} y {hasta}"
+    return f"desde {desde}" if desde else f"hasta {hasta}"
+
+
+def _filtros(clausula, partes: dict, negada: bool = False):
+    """Recorre la query y reparte la descripción de cada cláusula por tipo de restricción."""
+    if not isinstance(clausula, dict) or len(clausula) != 1:
+        return
+    tipo, cuerpo = next(iter(clausula.items()))
+    if tipo == "bool":
+        for ocurrencia in OCURRENCIAS_BOOL:
+            hijos = cuerpo.get(ocurrencia, [])
+            hijos = hijos if isinstance(hijos, list) else [hijos]
+            if ocurrencia == "should" and hijos and all(_campo(h) == "servicios" for h in hijos):
+                minimo = cuerpo.get("minimum_should_match", 1)
+                servicios = [str(_texto(next(iter(next(iter(h.values())).values())))) for h in hijos]
+                union = " y " if minimo == len(servicios) else " o "
+                partes["servicios"].append(union.join(servicios))
+                continue
+            for hijo in hijos:
+                _filtros(hijo, partes, negada or ocurrencia == "must_not")
+        return
+    if not isinstance(cuerpo, dict) or not cuerpo:
+        return
+    campo = _campo(clausula)
+    valor = next(iter(cuerpo.values()))
+    if tipo == "geo_distance":
+        lugar = f" de {cuerpo['_name']}" if cuerpo.get("_name") else ""
+        partes["ubicacion"].append(f"a menos de {cuerpo.get('distance', '').replace('km', ' km')}{lugar}")
+    elif campo == "localidad":
+        partes["ubicacion"].append(f"en {_texto(valor)}")
+    elif campo == "provincia":
+        partes["ubicacion"].append(f"en la provincia de {_texto(valor)}")
+    elif campo == "servicios":
+        partes["servicios_sin" if negada else "servicios"].append(str(_texto(valor)))
+    elif campo == "fechaEntrada":
+        partes["fecha"].append(f"con entrada el {_fecha(_texto(valor))}" if tipo == "term"
+                               else f"con entrada {_rango(campo, valor)}")
+    elif campo in ("precio", "opinion", "comentarios") and tipo == "range":
+        nombre = {"precio": "con precio", "opinion": "con opinión", "comentarios": "con comentarios"}[campo]
+        partes["rango"].append(f"{nombre} {_rango(campo, valor)}")
+    elif campo == "nombre":
+        partes["nombre"].append(f"llamados «{_texto(valor)}»")
+    elif campo == "descripcion":
+        partes["descripcion"].append(f"que mencionan «{_texto(valor)}»")
+
+
+def _campo(clausula):
+    if not isinstance(clausula, dict) or len(clausula) != 1:
+        return None
+    tipo, cuerpo = next(iter(clausula.items()))
+    if tipo == "bool" or not isinstance(cuerpo, dict) or not cuerpo:
+        return None
+    return next(iter(cuerpo)).split(".")[0]
+
+
+def describir_filtros(consulta: dict) -> str:
+    """Los filtros de la consulta en castellano: " en Málaga con piscina y parking con entrada el 01/06/2025"."""
+    partes = {clave: [] for clave in ("nombre", "ubicacion", "servicios", "servicios_sin", "rango", "descripcion", "fecha")}
+    _filtros(consulta.get("query", {}), partes)
+    texto = []
+    texto += partes["nombre"] + partes["ubicacion"]
+    if partes["servicios"]:
+        texto.append("con " + enumerar(partes["servicios"]))
+    if partes["servicios_sin"]:
+        texto.append("sin " + " ni ".join(partes["servicios_sin"]))
+    texto += partes["rango"] + partes["descripcion"] + partes["fecha"]
+    return "".join(f" {t}" for t in texto)
+
+
+def _hotel(fuente: dict, campo: str = None) -> str:
+    lugar = fuente.get("localidad") or fuente.get("provincia")
+    detalle = [lugar] if lugar else []
+    if campo and fuente.get(campo) is not None:
+        detalle.append(valor_campo(campo, fuente[campo]) + (" de opinión" if campo == "opinion" else "")
+                       + (" comentarios" if campo == "comentarios" else ""))
+    return fuente.get("nombre", "(sin nombre)") + (f" ({', '.join(detalle)})" if detalle else "")
+
+
+def _frase_metrica(tipo: str, campo: str, resultado: dict) -> str:
+    nombre = METRICAS.get(campo, {}).get(tipo, f"{tipo} de {campo}")
+    return f"{nombre} es {valor_campo(campo, resultado.get('value'), media=tipo == 'avg')}"
+
+
+def _frase_terms(campo: str, cuerpo: dict, resultado: dict, subagregaciones: dict) -> str:
+    cubos = resultado.get("buckets", [])
+    if not cubos:
+        return f"{TERMS.get(campo, campo)}: ninguno"
+    elementos = []
+    for cubo in cubos:
+        detalle = [cuantos(cubo, cubo["doc_count"])]
+        for nombre, subagregacion in subagregaciones.items():
+            subtipo, subcuerpo = next(iter(subagregacion.items()))
+            subcampo = subcuerpo.get("field")
+            valor = cubo.get(nombre, {}).get("value")
+            etiqueta = METRICAS.get(subcampo, {}).get(subtipo, f"{subtipo} {subcampo}").split(" ", 1)[-1]
+            detalle.append(f"{etiqueta} {valor_campo(subcampo, valor, media=subtipo == 'avg')}")
+        elementos.append(f"{cubo['key']} ({', '.join(detalle)})")
+    return f"{TERMS.get(campo, campo)} son {enumerar(elementos)}"
+
+
+def _frase_top_hits(cuerpo: dict, resultado: dict) -> str:
+    hits = resultado.get("hits", {}).get("hits", [])
+    orden = cuerpo.get("sort") or []
+    campo, sentido = next(iter(orden[0].items())) if orden and isinstance(orden[0], dict) else (None, None)
+    if isinstance(sentido, dict):
+        sentido = sentido.get("order", "asc")
+    singular, plural = SUPERLATIVOS.get((campo, sentido), ("", ""))
+    hoteles = [_hotel(hit.get("_source", {}), campo) for hit in hits]
+    if not hoteles:
+        return None
+    if len(hoteles) == 1:
+        return re.sub(r"\s+", " ", f"El hotel {singular} es {hoteles[0]}.")
+    return re.sub(r"\s+", " ", f"Los hoteles {plural} son {enumerar(hoteles)}.")
+
+
+def respuesta_agregaciones(consulta: dict, resultados) -> str:
+    """Respuesta en castellano a partir del total y las agregaciones, con plantillas fijas (sin LLM)."""
+    filtros = describir_filtros(consulta)
+    total = total_resultados(resultados)
+    if total == 0:
+        return f"No hay hoteles{filtros}."
+    valores = resultados.get("aggregations", {})
+    frases = [f"Hay {cuantos(valores, total)}{filtros}."]
+    metricas = []
+    for nombre, agregacion in consulta.get("aggs", {}).items():
+        tipo, cuerpo = next((t, c) for t, c in agregacion.items() if t != "aggs")
+        resultado = valores.get(nombre, {})
+        campo = str(cuerpo.get("field", "")).split(".")[0]
+        if tipo == "top_hits":
+            frase = _frase_top_hits(cuerpo, resultado)
+            if frase:
+                frases.append(frase)
+        elif tipo == "terms":
+            frase = _frase_terms(campo, cuerpo, resultado, agregacion.get("aggs", {}))
+            frases.append(frase[0].upper() + frase[1:] + ".")
+        else:
+            metricas.append(_frase_metrica(tipo, campo, resultado))
+    if metricas:
+        frase = enumerar(metricas)
+        frases.insert(1, frase[0].upper() + frase[1:] + ".")
+    return " ".join(frases)
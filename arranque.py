@@ -0,0 +1,42 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Momento en que se importa este módulo; se usa como origen de los tiempos de arranque
+INICIO_PROCESO = time.perf_counter()
+
+
+class PerfilArranque:
+    """Registra la duración de cada paso de importación e inicialización."""
+
+    def __init__(self):
+        self.pasos = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def medir(self, nombre: str):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar(nombre, time.perf_counter() - inicio, inicio)
+
+    def registrar(self, nombre: str, duracion: float, inicio: float = None):
+        hilo = threading.current_thread().name
+        with self._lock:
+            self.pasos.append((nombre, duracion, (inicio or time.perf_counter()) - INICIO_PROCESO, hilo))
+
+    def marcar(self, nombre: str):
+        """Registra un hito (por ejemplo, "prompt mostrado") medido desde el inicio del proceso."""
+        self.registrar(nombre, time.perf_counter() - INICIO_PROCESO, INICIO_PROCESO)
+
+    def informe(self) -> str:
+        with self._lock:
+            pasos = sorted(self.pasos, key=lambda paso: paso[2])
+        lineas = [f"{'Paso':<32}{'inicio (ms)':>12}{'duración (ms)':>15}  hilo"]
+        for nombre, duracion, desde_inicio, hilo in pasos:
+            lineas.append(f"{nombre:<32}{desde_inicio * 1000:>12.1f}{duracion * 1000:>15.1f}  {hilo}")
+        return "\n".join(lineas)
+
+
+perfil = PerfilArranque()
@@ -0,0 +1,497 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import itertools
+import logging
+import random
+import threading
+import time
+
+from metricas import metricas, uso_ollama, uso_openai
+
+
+class ErrorLLM(Exception):
+    """Ningún backend ha podido responder dentro del plazo y de los reintentos."""
+
+
+def es_reintentable(error: Exception) -> bool:
+    """Errores transitorios: límite de peticiones, conexión, timeout o 5xx del proveedor."""
+    nombre = type(error).__name__
+    if nombre in ("RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError"):
+        return True
+    # httpx (Ollama): ConnectError, ReadTimeout, RemoteProtocolError...
+    if nombre.endswith(("ConnectError", "Timeout", "TimeoutException", "RemoteProtocolError")):
+        return True
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    estado = getattr(error, "status_code", None)
+    return estado is not None and (estado == 429 or estado >= 500)
+
+
+def consumir_stream(fragmentos, callback) -> tuple:
+    """Pasa cada fragmento a callback según llega.
+
+    Devuelve (respuesta completa, segundos hasta el primer fragmento, segundos en total).
+    """
+    inicio = time.perf_counter()
+    primer_token = None
+    partes = []
+    for fragmento in fragmentos:
+        if primer_token is None:
+            primer_token = time.perf_counter() - inicio
+        partes.append(fragmento)
+        callback(fragmento)
+    total = time.perf_counter() - inicio
+    return "".join(partes).strip(), primer_token or total, total
+
+
+# Proveedores de OpenRouter que solo cachean el prompt si se marca con cache_control; el resto
+# (OpenAI, DeepSeek...) cachea de forma automática los prefijos repetidos
+CACHE_EXPLICITO = ("anthropic/", "google/gemini")
+
+
+class BackendOpenRouter:
+    """Backend OpenAI-compatible (OpenRouter). Los clientes síncrono y asíncrono se crean al primer uso."""
+
+    tipo = "openrouter"
+
+    def __init__(self, modelo: str, base_url: str, api_key: str, site_url: str = None,
+                 conexiones: int = 10, timeout: float = 60, cachear_prefijo: bool = True):
+        self.modelo = modelo
+        self.cachear_prefijo = cachear_prefijo
+        self.base_url = base_url
+        self.api_key = api_key
+        self.site_url = site_url
+        self.conexiones = conexiones
+        self.timeout = timeout
+        self._cliente = None
+        self._cliente_async = None
+        self._lock = threading.Lock()
+
+    @property
+    def nombre(self) -> str:
+        return f"openrouter:{self.modelo}"
+
+    def _argumentos_cliente(self, cliente_http):
+        import httpx
+        limites = httpx.Limits(max_connections=self.conexiones, max_keepalive_connections=self.conexiones)
+        return dict(
+            base_url=self.base_url,
+            api_key=self.api_key,
+            default_headers={"HTTP-Referer": self.site_url} if self.site_url else None,
+            timeout=self.timeout,
+            # Los reintentos los gestiona ClienteLLM para poder cambiar de backend
+            max_retries=0,
+            http_client=cliente_http(limits=limites),
+        )
+
+    def cliente(self):
+        with self._lock:
+            if self._cliente is None:
+                from openai import OpenAI, DefaultHttpxClient
+                self._cliente = OpenAI(**self._argumentos_cliente(DefaultHttpxClient))
+        return self._cliente
+
+    def cliente_async(self):
+        with self._lock:
+            if self._cliente_async is None:
+                from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+                self._cliente_async = AsyncOpenAI(**self._argumentos_cliente(DefaultAsyncHttpxClient))
+        return self._cliente_async
+
+    def _mensajes(self, mensajes: list) -> list:
+        """Marca el mensaje de sistema como prefijo cacheable en los modelos que lo necesitan."""
+        if not self.cachear_prefijo or not self.modelo.startswith(CACHE_EXPLICITO):
+            return mensajes
+        return [
+            {**m, "content": [{"type": "text", "text": m["content"], "cache_control": {"type": "ephemeral"}}]}
+            if m["role"] == "system" and isinstance(m["content"], str) else m
+            for m in mensajes
+        ]
+
+    @staticmethod
+    def _formato(esquema: dict) -> dict:
+        if not esquema:
+            return {}
+        return {"response_format": {"type": "json_schema", "json_schema": {"name": "respuesta", "schema": esquema}}}
+
+    def chat(self, mensajes: list, esquema: dict = None, timeout: float = None, max_tokens: int = None) -> dict:
+        respuesta = self.cliente().chat.completions.create(
+            model=self.modelo,
+            messages=self._mensajes(mensajes),
+            timeout=timeout or self.timeout,
+            **self._formato(esquema),
+            **({"max_tokens": max_tokens} if max_tokens else {})
+        )
+        return {"contenido": respuesta.choices[0].message.content, "uso": uso_openai(respuesta), "backend": self.nombre}
+
+    async def chat_async(self, mensajes: list, esquema: dict = None, timeout: float = None, max_tokens: int = None) -> dict:
+        respuesta = await self.cliente_async().chat.completions.create(
+            model=self.modelo,
+            messages=self._mensajes(mensajes),
+            timeout=timeout or self.timeout,
+            **self._formato(esquema),
+            **({"max_tokens": max_tokens} if max_tokens else {})
+        )
+        return {"contenido": respuesta.choices[0].message.content, "uso": uso_openai(respuesta), "backend": self.nombre}
+
+    def chat_stream(self, mensajes: list, uso: dict, timeout: float = None):
+        stream = self.cliente().chat.completions.create(
+            model=self.modelo,
+            messages=self._mensajes(mensajes),
+            timeout=timeout or self.timeout,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            uso.update(uso_openai(chunk))
+
+    def calentar(self, mensajes: list = None):
+        self.cliente().models.list()
+
+    async def aclose(self):
+        """Cierra el cliente asíncrono (va ligado al bucle de eventos que lo ha usado)."""
+        with self._lock:
+            cliente, self._cliente_async = self._cliente_async, None
+        if cliente is not None:
+            await cliente.close()
+
+
+# Plazo de la llamada en curso a Ollama: su cliente no admite timeout por llamada, así que un hook de
+# httpx lo pone como timeout de la petición (por fase: conexión, escritura, cada lectura)
+_plazo_peticion = contextvars.ContextVar("plazo_peticion", default=None)
+
+
+@contextlib.contextmanager
+def _con_plazo(segundos: float):
+    token = _plazo_peticion.set(segundos)
+    try:
+        yield
+    finally:
+        _plazo_peticion.reset(token)
+
+
+def _aplicar_plazo(peticion):
+    import httpx
+    segundos = _plazo_peticion.get()
+    if segundos is not None:
+        peticion.extensions["timeout"] = httpx.Timeout(segundos).as_dict()
+
+
+async def _aplicar_plazo_async(peticion):
+    _aplicar_plazo(peticion)
+
+
+class BackendOllama:
+    """Backend Ollama local. host None usa OLLAMA_HOST (o localhost:11434)."""
+
+    tipo = "ollama"
+
+    def __init__(self, modelo: str, host: str = None, conexiones: int = 10, timeout: float = 60,
+                 opciones: dict = None, keep_alive: str = None):
+        self.modelo = modelo
+        # Tiempo que el modelo (y su caché KV con el último prompt) sigue cargado tras cada llamada
+        self.keep_alive = keep_alive
+        self.host = host
+        self.conexiones = conexiones
+        self.timeout = timeout
+        self.opciones = opciones if opciones is not None else {"temperature": 0.1}
+        self._cliente = None
+        self._cliente_async = None
+        self._lock = threading.Lock()
+
+    @property
+    def nombre(self) -> str:
+        return f"ollama:{self.modelo}"
+
+    def _argumentos_cliente(self, hook):
+        import httpx
+        return dict(
+            host=self.host,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.conexiones, max_keepalive_connections=self.conexiones),
+            event_hooks={"request": [hook]},
+        )
+
+    def cliente(self):
+        with self._lock:
+            if self._cliente is None:
+                import ollama
+                self._cliente = ollama.Client(**self._argumentos_cliente(_aplicar_plazo))
+        return self._cliente
+
+    def cliente_async(self):
+        with self._lock:
+            if self._cliente_async is None:
+                import ollama
+                self._cliente_async = ollama.AsyncClient(**self._argumentos_cliente(_aplicar_plazo_async))
+        return self._cliente_async
+
+    def _opciones(self, max_tokens: int = None) -> dict:
+        return {**self.opciones, "num_predict": max_tokens} if max_tokens else self.opciones
+
+    def _extra(self, esquema: dict = None) -> dict:
+        extra = {"format": esquema} if esquema else {}
+        if self.keep_alive is not None:
+            extra["keep_alive"] = self.keep_alive
+        return extra
+
+    def chat(self, mensajes: list, esquema: dict = None, timeout: float = None, max_tokens: int = None) -> dict:
+        with _con_plazo(timeout or self.timeout):
+            respuesta = self.cliente().chat(
+                model=self.modelo,
+                messages=mensajes,
+                options=self._opciones(max_tokens),
+                **self._extra(esquema)
+            )
+        return {"contenido": respuesta["message"]["content"].strip(), "uso": uso_ollama(respuesta), "backend": self.nombre}
+
+    async def chat_async(self, mensajes: list, esquema: dict = None, timeout: float = None, max_tokens: int = None) -> dict:
+        plazo = timeout or self.timeout
+        with _con_plazo(plazo):
+            respuesta = await asyncio.wait_for(self.cliente_async().chat(
+                model=self.modelo,
+                messages=mensajes,
+                options=self._opciones(max_tokens),
+                **self._extra(esquema)
+            ), plazo)
+        return {"contenido": respuesta["message"]["content"].strip(), "uso": uso_ollama(respuesta), "backend": self.nombre}
+
+    def chat_stream(self, mensajes: list, uso: dict, timeout: float = None):
+        plazo = timeout or self.timeout
+        limite = time.monotonic() + plazo
+        # La petición sale con el primer fragmento, que se pide aquí para que el hook vea el plazo
+        with _con_plazo(plazo):
+            stream = iter(self.cliente().chat(
+                model=self.modelo,
+                messages=mensajes,
+                options=self.opciones,
+                stream=True,
+                **self._extra()
+            ))
+            primero = next(stream, None)
+        if primero is None:
+            return
+        for chunk in itertools.chain([primero], stream):
+            if time.monotonic() > limite:
+                raise TimeoutError(f"Plazo de {plazo:.1f}s agotado en {self.nombre}")
+            if chunk["message"]["content"]:
+                yield chunk["message"]["content"]
+            if chunk.get("done"):
+                uso.update(uso_ollama(chunk))
+
+    def calentar(self, mensajes: list = None):
+        # Con mensajes (el prefijo del prompt) la caché KV queda ya preparada para la primera pregunta
+        self.cliente().chat(
+            model=self.modelo,
+            messages=mensajes or [{"role": "user", "content": "hola"}],
+            options={**self.opciones, "num_predict": 1},
+            **self._extra()
+        )
+
+    async def aclose(self):
+        """Cierra el cliente asíncrono (va ligado al bucle de eventos que lo ha usado)."""
+        with self._lock:
+            cliente, self._cliente_async = self._cliente_async, None
+        if cliente is not None:
+            await cliente.close()
+
+
+class ClienteLLM:
+    """Llamadas al LLM con plazo, reintentos con espera exponencial, hedging y failover.
+
+    backends es la lista en orden de preferencia: el primero es el principal y los
+    demás se usan cuando se agotan los reintentos del anterior con un error transitorio.
+    Con hedge_segundos > 0, si una llamada no ha respondido en ese tiempo se lanza una
+    segunda (al siguiente backend si lo hay) y se usa la que termine antes.
+    """
+
+    def __init__(self, backends: list, reintentos: int = 3, espera_inicial: float = 0.5,
+                 espera_maxima: float = 8.0, plazo: float = 60, hedge_segundos: float = 0):
+        if not backends:
+            raise ValueError("Se necesita al menos un backend")
+        self.backends = backends
+        self.reintentos = reintentos
+        self.espera_inicial = espera_inicial
+        self.espera_maxima = espera_maxima
+        self.plazo = plazo
+        self.hedge_segundos = hedge_segundos
+        self._hilos = None
+        self._lock = threading.Lock()
+
+    @property
+    def principal(self):
+        return self.backends[0]
+
+    def _espera(self, intento: int) -> float:
+        # Espera exponencial con jitter para que los reintentos concurrentes no coincidan
+        return random.uniform(0, min(self.espera_maxima, self.espera_inicial * 2 ** intento))
+
+    def _con_reintentos(self, backend, llamada, limite: float):
+        for intento in range(self.reintentos + 1):
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                raise ErrorLLM(f"Plazo de {self.plazo}s agotado en {backend.nombre}")
+            try:
+                return llamada(backend, restante)
+            except Exception as e:
+                if not es_reintentable(e) or intento == self.reintentos:
+                    raise
+                espera = self._espera(intento)
+                if time.monotonic() + espera >= limite:
+                    raise
+                metricas.incrementar("llm_reintentos_total", backend=backend.nombre)
+                logging.warning(f"{backend.nombre}: {type(e).__name__} ({e}); reintento {intento + 1} en {espera:.2f}s")
+                time.sleep(espera)
+
+    def _con_failover(self, llamada, limite: float, inicio: int = 0):
+        ultimo_error = None
+        for posicion, backend in enumerate(self.backends[inicio:] + self.backends[:inicio]):
+            if posicion > 0:
+                metricas.incrementar("llm_failover_total", backend=backend.nombre)
+                logging.warning(f"Failover a {backend.nombre} tras error: {ultimo_error}")
+            try:
+                return self._con_reintentos(backend, llamada, limite)
+            except ErrorLLM as e:
+                ultimo_error = e
+            except Exception as e:
+                if not es_reintentable(e):
+                    raise ErrorLLM(f"{backend.nombre}: {e}") from e
+                ultimo_error = e
+        raise ErrorLLM(f"Ningún backend disponible: {ultimo_error}") from ultimo_error
+
+    def _ejecutor(self):
+        with self._lock:
+            if self._hilos is None:
+                # Un hilo por conexión HTTP de los backends: más hilos solo esperarían en el pool de httpx
+                hilos = sum(getattr(backend, "conexiones", 8) for backend in self.backends)
+                self._hilos = concurrent.futures.ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="hedge")
+        return self._hilos
+
+    def chat(self, mensajes: list, esquema: dict = None, plazo: float = None, max_tokens: int = None) -> dict:
+        """Devuelve {"contenido", "uso", "backend"}; lanza ErrorLLM si no se obtiene respuesta."""
+        limite = time.monotonic() + (plazo or self.plazo)
+
+        def llamada(backend, restante):
+            return backend.chat(mensajes, esquema, timeout=restante, max_tokens=max_tokens)
+
+        if not self.hedge_segundos:
+            return self._con_failover(llamada, limite)
+
+        ejecutor = self._ejecutor()
+        empezada = threading.Event()
+
+        def principal():
+            empezada.set()
+            return self._con_failover(llamada, limite)
+
+        pendientes = {ejecutor.submit(principal)}
+        # hedge_segundos cuenta desde que la llamada empieza, no desde que entra en la cola del pool
+        empezada.wait(max(0.0, limite - time.monotonic()))
+        hechos, _ = concurrent.futures.wait(pendientes, timeout=self.hedge_segundos)
+        if not hechos:
+            metricas.incrementar("llm_hedge_total", backend=self.principal.nombre)
+            logging.info(f"Sin respuesta en {self.hedge_segundos}s: se lanza una petición de respaldo")
+            pendientes.add(ejecutor.submit(self._con_failover, llamada, limite, 1 % len(self.backends)))
+        error = None
+        while pendientes:
+            hechos, pendientes = concurrent.futures.wait(pendientes, return_when=concurrent.futures.FIRST_COMPLETED)
+            for futuro in hechos:
+                if futuro.exception() is None:
+                    return futuro.result()
+                error = futuro.exception()
+        raise error
+
+    async def chat_async(self, mensajes: list, esquema: dict = None, plazo: float = None, max_tokens: int = None) -> dict:
+        """Versión asyncio de chat, con los mismos reintentos, failover y hedging."""
+        limite = time.monotonic() + (plazo or self.plazo)
+
+        async def con_failover(inicio: int):
+            ultimo_error = None
+            for posicion, backend in enumerate(self.backends[inicio:] + self.backends[:inicio]):
+                if posicion > 0:
+                    metricas.incrementar("llm_failover_total", backend=backend.nombre)
+                    logging.warning(f"Failover a {backend.nombre} tras error: {ultimo_error}")
+                for intento in range(self.reintentos + 1):
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        ultimo_error = ErrorLLM(f"Plazo de {self.plazo}s agotado en {backend.nombre}")
+                        break
+                    try:
+                        return await asyncio.wait_for(backend.chat_async(mensajes, esquema, timeout=restante, max_tokens=max_tokens), restante)
+                    except asyncio.TimeoutError as e:
+                        ultimo_error = e
+                        break
+                    except Exception as e:
+                        if not es_reintentable(e):
+                            raise ErrorLLM(f"{backend.nombre}: {e}") from e
+                        ultimo_error = e
+                        espera = self._espera(intento)
+                        if intento == self.reintentos or time.monotonic() + espera >= limite:
+                            break
+                        metricas.incrementar("llm_reintentos_total", backend=backend.nombre)
+                        await asyncio.sleep(espera)
+            raise ErrorLLM(f"Ningún backend disponible: {ultimo_error}") from ultimo_error
+
+        if not self.hedge_segundos:
+            return await con_failover(0)
+
+        tareas = {asyncio.ensure_future(con_failover(0))}
+        hechas, _ = await asyncio.wait(tareas, timeout=self.hedge_segundos)
+        if not hechas:
+            metricas.incrementar("llm_hedge_total", backend=self.principal.nombre)
+            tareas.add(asyncio.ensure_future(con_failover(1 % len(self.backends))))
+        error = None
+        try:
+            while tareas:
+                hechas, tareas = await asyncio.wait(tareas, return_when=asyncio.FIRST_COMPLETED)
+                for tarea in hechas:
+                    if tarea.exception() is None:
+                        return tarea.result()
+                    error = tarea.exception()
+            raise error
+        finally:
+            for tarea in tareas:
+                tarea.cancel()
+
+    def chat_stream(self, mensajes: list, uso: dict = None, plazo: float = None):
+        """Genera los fragmentos de la respuesta. Reintenta o cambia de backend solo si
+        el error llega antes del primer fragmento; después ya se ha mostrado texto."""
+        uso = uso if uso is not None else {}
+        limite = time.monotonic() + (plazo or self.plazo)
+        ultimo_error = None
+        for posicion, backend in enumerate(self.backends):
+            if posicion > 0:
+                metricas.incrementar("llm_failover_total", backend=backend.nombre)
+                logging.warning(f"Failover a {backend.nombre} tras error: {ultimo_error}")
+            for intento in range(self.reintentos + 1):
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                emitido = False
+                try:
+                    for fragmento in backend.chat_stream(mensajes, uso, timeout=restante):
+                        emitido = True
+                        yield fragmento
+                    return
+                except Exception as e:
+                    if emitido or not es_reintentable(e):
+                        raise ErrorLLM(f"{backend.nombre}: {e}") from e
+                    ultimo_error = e
+                    espera = self._espera(intento)
+                    if intento == self.reintentos or time.monotonic() + espera >= limite:
+                        break
+                    metricas.incrementar("llm_reintentos_total", backend=backend.nombre)
+                    time.sleep(espera)
+        raise ErrorLLM(f"Ningún backend disponible: {ultimo_error}") from ultimo_error
+
+    def calentar(self, mensajes: list = None):
+        self.principal.calentar(mensajes)
+
+    async def aclose(self):
+        """Cierra los clientes asíncronos de todos los backends; se vuelven a crear si se usan otra vez."""
+        for backend in self.backends:
+            await backend.aclose()
@@ -0,0 +1,264 @@
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PREGUNTAS = [
+    "Muéstrame hoteles en Aguadulce con piscina y parking para el día 01/06/2025.",
+    "Dime hoteles en Madrid disponibles el 10 de julio de 2025.",
+    "¿Cuál es el hotel más barato de la provincia de Huelva?",
+    "Quiero conocer los detalles del hotel La Perla.",
+    "Hoteles con spa cerca de la playa en Marbella",
+]
+
+CONSULTA_SIMULADA = {"query": {"match": {"localidad": "Málaga"}}, "size": 10}
+
+ETAPAS = ["generar_consulta_llm", "buscar_en_elasticsearch", "construir_prompt_multiple", "respuesta_natural", "total"]
+
+
+class ConfiguracionSimulada:
+    def __init__(self, latencia_es: float, latencia_llm: float, ms_por_token: float, hits: int,
+                 tamano_descripcion: int, tokens_respuesta: int):
+        self.latencia_es = latencia_es / 1000
+        self.latencia_llm = latencia_llm / 1000
+        self.segundos_por_token = ms_por_token / 1000
+        self.hits = hits
+        self.tamano_descripcion = tamano_descripcion
+        self.tokens_respuesta = tokens_respuesta
+
+    def respuesta_busqueda(self) -> dict:
+        descripcion = ("Hotel con vistas al mar y habitaciones amplias. " * (self.tamano_descripcion // 48 + 1))[:self.tamano_descripcion]
+        hits = [{
+            "_index": "hoteles", "_id": str(i), "_score": 1.0, "_seq_no": i, "_primary_term": 1,
+            "_source": {
+                "nombre": f"Hotel {i}", "provincia": "Málaga", "localidad": "Málaga",
+                "descripcion": descripcion, "servicios": ["piscina", "parking", "wifi"],
+                "opinion": 8.5, "comentarios": 120, "url": f"https://example.com/{i}", "precio": 80 + i,
+            },
+        } for i in range(self.hits)]
+        return {"took": int(self.latencia_es * 1000), "timed_out": False,
+                "hits": {"total": {"value": self.hits, "relation": "eq"}, "hits": hits}}
+
+    def texto_llm(self, prompt: str) -> list:
+        if "consulta JSON" in prompt:
+            return [json.dumps(CONSULTA_SIMULADA)]
+        return [f"palabra{i} " for i in range(self.tokens_respuesta)]
+
+
+def crear_manejador(config: ConfiguracionSimulada):
+    class ManejadorSimulado(BaseHTTPRequestHandler):
+        """Sustituto local de _search de Elasticsearch y de las APIs de chat de OpenAI y Ollama."""
+
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def enviar(self, cuerpo, tipo: str = "application/json"):
+            datos = cuerpo if isinstance(cuerpo, bytes) else json.dumps(cuerpo).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", tipo)
+            self.send_header("X-Elastic-Product", "Elasticsearch")
+            self.send_header("Content-Length", str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+
+        def enviar_por_fragmentos(self, fragmentos, tipo: str):
+            self.send_response(200)
+            self.send_header("Content-Type", tipo)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for fragmento in fragmentos:
+                time.sleep(config.segundos_por_token)
+                self.wfile.write(f"{len(fragmento):X}\r\n".encode() + fragmento + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+        def leer_cuerpo(self) -> dict:
+            longitud = int(self.headers.get("Content-Length") or 0)
+            datos = self.rfile.read(longitud) if longitud else b""
+            try:
+                return json.loads(datos) if datos else {}
+            except ValueError:
+                return {}
+
+        def do_HEAD(self):
+            self.enviar({})
+
+        def do_GET(self):
+            self.do_POST()
+
+        def do_POST(self):
+            ruta = self.path.split("?")[0]
+            cuerpo = self.leer_cuerpo()
+            if ruta == "/":
+                self.enviar({"version": {"number": "8.15.0", "build_flavor": "default"}, "tagline": "You Know, for Search"})
+            elif ruta.endswith("/_search"):
+                time.sleep(config.latencia_es)
+                self.enviar(config.respuesta_busqueda())
+            elif "/_stats" in ruta:
+                self.enviar({"_all": {"primaries": {"docs": {"count": config.hits, "deleted": 0},
+                                                    "indexing": {"index_total": config.hits, "delete_total": 0}}}})
+            elif ruta.endswith("/chat/completions"):
+                self.chat_openai(cuerpo)
+            elif ruta == "/api/chat":
+                self.chat_ollama(cuerpo)
+            else:
+                self.enviar({"acknowledged": True})
+
+        def chat_openai(self, cuerpo: dict):
+            time.sleep(config.latencia_llm)
+            prompt = " ".join(str(m.get("content")) for m in cuerpo.get("messages", []))
+            fragmentos = config.texto_llm(prompt)
+            uso = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(fragmentos), "total_tokens": len(prompt) // 4 + len(fragmentos)}
+            if not cuerpo.get("stream"):
+                self.enviar({"id": "sim", "object": "chat.completion", "created": 0, "model": "simulado", "usage": uso,
+                             "choices": [{"index": 0, "finish_reason": "stop",
+                                          "message": {"role": "assistant", "content": "".join(fragmentos)}}]})
+                return
+            eventos = [b"data: " + json.dumps({"id": "sim", "object": "chat.completion.chunk", "created": 0, "model": "simulado",
+                                               "choices": [{"index": 0, "delta": {"content": f}, "finish_reason": None}]}).encode() + b"\n\n"
+                       for f in fragmentos]
+            eventos.append(b"data: [DONE]\n\n")
+            self.enviar_por_fragmentos(eventos, "text/event-stream")
+
+        def chat_ollama(self, cuerpo: dict):
+            time.sleep(config.latencia_llm)
+            prompt = " ".join(str(m.get("content")) for m in cuerpo.get("messages", []))
+            fragmentos = config.texto_llm(prompt)
+            final = {"model": "simulado", "done": True, "prompt_eval_count": len(prompt) // 4, "eval_count": len(fragmentos)}
+            if not cuerpo.get("stream", True):
+                self.enviar({**final, "message": {"role": "assistant", "content": "".join(fragmentos)}})
+                return
+            lineas = [json.dumps({"model": "simulado", "done": False, "message": {"role": "assistant", "content": f}}).encode() + b"\n"
+                      for f in fragmentos]
+            lineas.append(json.dumps({**final, "message": {"role": "assistant", "content": ""}}).encode() + b"\n")
+            self.enviar_por_fragmentos(lineas, "application/x-ndjson")
+
+    return ManejadorSimulado
+
+
+class ServidorSimulado(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Los clientes cierran sus conexiones keep-alive al terminar; no es un error del benchmark
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def arrancar_servidor_simulado(config: ConfiguracionSimulada, puerto: int = 0) -> ThreadingHTTPServer:
+    servidor = ServidorSimulado(("127.0.0.1", puerto), crear_manejador(config))
+    threading.Thread(target=servidor.serve_forever, name="servidor-simulado", daemon=True).start()
+    return servidor
+
+
+def configurar_entorno(puerto: int, backend: str, con_caches: bool):
+    """Apunta llm.py a los servicios simulados; debe llamarse antes de importar llm."""
+    base = f"http://127.0.0.1:{puerto}"
+    os.environ.update({
+        "ELASTICSEARCH_HOST": "127.0.0.1", "ELASTICSEARCH_PORT": str(puerto),
+        "ELASTICSEARCH_USERNAME": "benchmark", "ELASTICSEARCH_PASSWORD": "benchmark",
+        "ES_INDEX": "hoteles", "OUT_DIRECTORY": os.environ.get("OUT_DIRECTORY") or tempfile.mkdtemp(prefix="benchmark_"),
+        "USE_OPEN_ROUTER": "yes" if backend == "openrouter" else "no",
+        "OPENROUTER_API_BASE": f"{base}/v1", "OPENROUTER_API_KEY": "simulada",
+        "OPENROUTER_MODEL": "simulado", "OPENROUTER_SITE_URL": "http://localhost",
+        "OLLAMA_HOST": base, "OLLAMA_MODEL": "simulado",
+    })
+    if not con_caches:
+        for variable in ("PARSER_REGLAS", "CACHE_CONSULTAS", "CACHE_RESULTADOS", "CACHE_RESPUESTAS"):
+            os.environ[variable] = "no"
+
+
+def percentil(valores: list, p: float) -> float:
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0.0
+    posicion = min(int(round(p / 100 * (len(ordenados) - 1))), len(ordenados) - 1)
+    return ordenados[posicion]
+
+
+def ejecutar_pregunta(llm, pregunta: str, stream: bool) -> dict:
+    tiempos = {}
+    inicio = time.perf_counter()
+    marca = inicio
+    consulta = llm.generar_consulta_llm(pregunta)
+    tiempos["generar_consulta_llm"], marca = time.perf_counter() - marca, time.perf_counter()
+    resultados = llm.buscar_en_elasticsearch(consulta)
+    tiempos["buscar_en_elasticsearch"], marca = time.perf_counter() - marca, time.perf_counter()
+    prompt = llm.construir_prompt_multiple(resultados)
+    tiempos["construir_prompt_multiple"], marca = time.perf_counter() - marca, time.perf_counter()
+    llm.respuesta_natural(prompt, stream=stream, callback=lambda fragmento: None)
+    fin = time.perf_counter()
+    tiempos["respuesta_natural"] = fin - marca
+    tiempos["total"] = fin - inicio
+    return tiempos
+
+
+def medir(llm, concurrencia: int, num_preguntas: int, stream: bool) -> dict:
+    preguntas = [PREGUNTAS[i % len(PREGUNTAS)] for i in range(num_preguntas)]
+    inicio = time.perf_counter()
+    # llm.py imprime la consulta generada; se descarta para no mezclarla con el informe
+    with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+        with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+            mediciones = list(ejecutor.map(lambda p: ejecutar_pregunta(llm, p, stream), preguntas))
+    duracion = time.perf_counter() - inicio
+    informe = {"concurrencia": concurrencia, "preguntas": num_preguntas,
+               "preguntas_por_segundo": round(num_preguntas / duracion, 2), "etapas": {}}
+    for etapa in ETAPAS:
+        valores = [m[etapa] * 1000 for m in mediciones]
+        informe["etapas"][etapa] = {f"p{p}": round(percentil(valores, p), 2) for p in (50, 95, 99)}
+    return informe
+
+
+def imprimir_informe(informes: list):
+    for informe in informes:
+        print(f"\nConcurrencia {informe['concurrencia']}: {informe['preguntas']} preguntas, "
+              f"{informe['preguntas_por_segundo']} preguntas/s")
+        print(f"  {'etapa':<28}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}")
+        for etapa, valores in informe["etapas"].items():
+            print(f"  {etapa:<28}{valores['p50']:>10.1f}{valores['p95']:>10.1f}{valores['p99']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del flujo completo contra Elasticsearch y LLM simulados.")
+    parser.add_argument("--backend", choices=["ollama", "openrouter"], default="ollama")
+    parser.add_argument("--concurrencia", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--preguntas", type=int, default=50, help="Preguntas por nivel de concurrencia")
+    parser.add_argument("--latencia-es", type=float, default=20, help="Latencia simulada de _search (ms)")
+    parser.add_argument("--latencia-llm", type=float, default=200, help="Latencia simulada antes del primer token (ms)")
+    parser.add_argument("--ms-por-token", type=float, default=0, help="Retardo simulado entre tokens en streaming (ms)")
+    parser.add_argument("--hits", type=int, default=10, help="Hoteles devueltos por búsqueda")
+    parser.add_argument("--tamano-descripcion", type=int, default=800, help="Caracteres de cada descripción")
+    parser.add_argument("--tokens-respuesta", type=int, default=200, help="Tokens de la respuesta final simulada")
+    parser.add_argument("--stream", action="store_true", help="Genera la respuesta final en streaming")
+    parser.add_argument("--con-caches", action="store_true", help="Mantiene activados el parser de reglas y las cachés")
+    parser.add_argument("--json", help="Guarda el informe en este fichero JSON")
+    args = parser.parse_args()
+
+    config = ConfiguracionSimulada(args.latencia_es, args.latencia_llm, args.ms_por_token, args.hits,
+                                   args.tamano_descripcion, args.tokens_respuesta)
+    servidor = arrancar_servidor_simulado(config)
+    configurar_entorno(servidor.server_address[1], args.backend, args.con_caches)
+    llm = importlib.import_module("llm")
+    # Importaciones perezosas, creación de clientes y primera conexión fuera de la medición
+    llm.comprobar_es()
+    llm.calentar_modelo()
+
+    informes = [medir(llm, concurrencia, args.preguntas, args.stream) for concurrencia in args.concurrencia]
+    imprimir_informe(informes)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"parametros": vars(args), "resultados": informes}, f, indent=2, ensure_ascii=False)
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from normalizacion import normalizar_pregunta
+
+
+POLITICAS = ("lru", "lfu", "fifo")
+
+
+class CacheLRU:
+    """Caché en memoria con caducidad (TTL) y contadores de aciertos/fallos.
+
+    Por defecto expulsa la entrada usada hace más tiempo (LRU); con politica="lfu"
+    expulsa la menos usada y con politica="fifo" la más antigua.
+    """
+
+    def __init__(self, capacidad: int = 1024, ttl: float = None, politica: str = "lru"):
+        if politica not in POLITICAS:
+            raise ValueError(f"Política de expulsión desconocida: {politica}")
+        self.capacidad = capacidad
+        self.ttl = ttl
+        self.politica = politica
+        self.aciertos = 0
+        self.fallos = 0
+        self._datos = OrderedDict()
+        self._usos = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is not None:
+                valor, expira = entrada
+                if expira is None or expira > time.monotonic():
+                    if self.politica == "lru":
+                        self._datos.move_to_end(clave)
+                    self._usos[clave] = self._usos.get(clave, 0) + 1
+                    self.aciertos += 1
+                    return valor
+                del self._datos[clave]
+                self._usos.pop(clave, None)
+            self.fallos += 1
+            return None
+
+    def guardar(self, clave, valor):
+        expira = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            nueva = clave not in self._datos
+            self._datos[clave] = (valor, expira)
+            if self.politica == "lru" or nueva:
+                self._datos.move_to_end(clave)
+            self._usos.setdefault(clave, 0)
+            while len(self._datos) > self.capacidad:
+                self._expulsar(excepto=clave)
+
+    def _expulsar(self, excepto=None):
+        if self.politica == "lfu":
+            # La entrada recién guardada no se expulsa; a igualdad de usos sale la más antigua
+            clave = min((c for c in self._datos if c != excepto), key=lambda c: self._usos.get(c, 0))
+            del self._datos[clave]
+        else:
+            clave, _ = self._datos.popitem(last=False)
+        self._usos.pop(clave, None)
+
+    def invalidar(self, clave=None):
+        with self._lock:
+            if clave is None:
+                self._datos.clear()
+                self._usos.clear()
+            else:
+                self._datos.pop(clave, None)
+                self._usos.pop(clave, None)
+
+    def estadisticas(self) -> dict:
+        total = self.aciertos + self.fallos
+        return {
+            "entradas": len(self._datos),
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": round(self.aciertos / total, 3) if total else 0.0,
+        }
+
+
+class CacheConsultas:
+    """Caché pregunta normalizada -> consulta Elasticsearch, con nivel en memoria y nivel opcional en disco.
+
+    Las claves incluyen una versión calculada a partir de la plantilla del prompt y el modelo,
+    de modo que al cambiar cualquiera de los dos las entradas antiguas dejan de usarse.
+    """
+
+    def __init__(self, plantilla: str, modelo: str = "", capacidad: int = 1024, ttl: float = None, directorio: str = None):
+        self.memoria = CacheLRU(capacidad, ttl)
+        self.ttl = ttl
+        self.version = self.calcular_version(plantilla, modelo)
+        self.aciertos_disco = 0
+        self._conexion = None
+        self._lock = threading.Lock()
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+            self._conexion = sqlite3.connect(os.path.join(directorio, "cache_consultas.sqlite"), check_same_thread=False)
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS consultas "
+                "(clave TEXT PRIMARY KEY, version TEXT, pregunta TEXT, consulta TEXT, creada REAL)"
+            )
+            self._conexion.commit()
+
+    @staticmethod
+    def calcular_version(plantilla: str, modelo: str = "") -> str:
+        return hashlib.sha256(f"{modelo}\n{plantilla}".encode("utf-8")).hexdigest()[:16]
+
+    def clave(self, pregunta: str) -> str:
+        return hashlib.sha256(f"{self.version}:{normalizar_pregunta(pregunta)}".encode("utf-8")).hexdigest()
+
+    def obtener(self, pregunta: str):
+        clave = self.clave(pregunta)
+        consulta = self.memoria.obtener(clave)
+        if consulta is not None or self._conexion is None:
+            return consulta
+
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT consulta, creada FROM consultas WHERE clave = ?", (clave,)
+            ).fetchone()
+        if fila is None or (self.ttl and time.time() - fila[1] > self.ttl):
+            return None
+        consulta = json.loads(fila[0])
+        self.aciertos_disco += 1
+        self.memoria.guardar(clave, consulta)
+        return consulta
+
+    def guardar(self, pregunta: str, consulta: dict):
+        clave = self.clave(pregunta)
+        self.memoria.guardar(clave, consulta)
+        if self._conexion is not None:
+            with self._lock:
+                self._conexion.execute(
+                    "INSERT OR REPLACE INTO consultas VALUES (?, ?, ?, ?, ?)",
+                    (clave, self.version, normalizar_pregunta(pregunta), json.dumps(consulta, ensure_ascii=False), time.time())
+                )
+                self._conexion.commit()
+
+    def invalidar(self, plantilla: str = None, modelo: str = ""):
+        """Vacía la caché. Si se indica una nueva plantilla, la versión cambia y se borran las entradas de otras versiones."""
+        if plantilla is not None:
+            self.version = self.calcular_version(plantilla, modelo)
+        self.memoria.invalidar()
+        if self._conexion is not None:
+            with self._lock:
+                if plantilla is None:
+                    self._conexion.execute("DELETE FROM consultas")
+                else:
+                    self._conexion.execute("DELETE FROM consultas WHERE version != ?", (self.version,))
+                self._conexion.commit()
+
+    def estadisticas(self) -> dict:
+        estadisticas = self.memoria.estadisticas()
+        # Los aciertos en disco cuentan como fallos de memoria; se corrigen para el total
+        estadisticas["aciertos_disco"] = self.aciertos_disco
+        estadisticas["fallos"] -= self.aciertos_disco
+        estadisticas["aciertos"] += self.aciertos_disco
+        total = estadisticas["aciertos"] + estadisticas["fallos"]
+        estadisticas["tasa_aciertos"] = round(estadisticas["aciertos"] / total, 3) if total else 0.0
+        return estadisticas
+
+
+def _canonizar(valor):
+    # Sin pasar a minúsculas: en un campo keyword o en un term "Málaga" y "málaga" son búsquedas distintas
+    if isinstance(valor, dict):
+        return {clave: _canonizar(v) for clave, v in valor.items()}
+    if isinstance(valor, list):
+        return [_canonizar(v) for v in valor]
+    if isinstance(valor, str):
+        return " ".join(valor.split())
+    return valor
+
+
+def consulta_canonica(consulta) -> str:
+    """JSON canónico de una consulta: claves ordenadas y espacios normalizados."""
+    if isinstance(consulta, (str, bytes)):
+        consulta = json.loads(consulta)
+    return json.dumps(_canonizar(consulta), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def version_indice(estadisticas) -> tuple:
+    """Resume las estadísticas de _stats (docs, indexing) en un valor que cambia con cada escritura."""
+    primarios = estadisticas["_all"]["primaries"]
+    docs = primarios.get("docs", {})
+    indexacion = primarios.get("indexing", {})
+    return (
+        docs.get("count"), docs.get("deleted"),
+        indexacion.get("index_total"), indexacion.get("delete_total"),
+    )
+
+
+class CacheResultados:
+    """Caché de respuestas de _search indexada por la consulta canónica.
+
+    Se vacía entera cuando cambia la versión del índice (ver version_indice), que
+    se comprueba como mucho una vez cada intervalo_version segundos.
+    """
+
+    def __init__(self, capacidad: int = 512, ttl: float = 300, intervalo_version: float = 5.0):
+        self.memoria = CacheLRU(capacidad, ttl)
+        self.intervalo_version = intervalo_version
+        self.version = None
+        self.invalidaciones = 0
+        self._ultima_comprobacion = 0.0
+        self._lock = threading.Lock()
+
+    def clave(self, consulta) -> str:
+        return hashlib.sha256(consulta_canonica(consulta).encode("utf-8")).hexdigest()
+
+    def debe_comprobar_version(self) -> bool:
+        with self._lock:
+            ahora = time.monotonic()
+            if ahora - self._ultima_comprobacion < self.intervalo_version:
+                return False
+            self._ultima_comprobacion = ahora
+            return True
+
+    def actualizar_version(self, version):
+        with self._lock:
+            cambiada = self.version is not None and version != self.version
+            self.version = version
+        if cambiada:
+            self.invalidaciones += 1
+            self.memoria.invalidar()
+
+    def obtener(self, consulta):
+        return self.memoria.obtener(self.clave(consulta))
+
+    def guardar(self, consulta, resultados):
+        self.memoria.guardar(self.clave(consulta), resultados)
+
+    def estadisticas(self) -> dict:
+        return {**self.memoria.estadisticas(), "invalidaciones": self.invalidaciones}
+
+
+def clave_respuesta(hits: list, modelo: str, prompt: str, ajustes: str = "") -> str:
+    """Clave de la respuesta final: documentos devueltos y su versión, o el hash del prompt.
+
+    Si todos los hits traen _seq_no y _primary_term (búsqueda con seq_no_primary_term=True),
+    la clave cambia en cuanto se modifica cualquiera de los documentos y no hace falta
+    comparar el texto del prompt; ajustes recoge lo que cambia el prompt sin cambiar los
+    documentos (por ejemplo el presupuesto de tokens). En otro caso se usa el prompt completo.
+    """
+    if hits and all("_seq_no" in hit and "_primary_term" in hit for hit in hits):
+        documentos = ";".join(f"{hit.get('_index')}/{hit['_id']}@{hit['_seq_no']}:{hit['_primary_term']}" for hit in hits)
+        base = f"docs|{modelo}|{ajustes}|{documentos}"
+    else:
+        base = f"prompt|{modelo}|{prompt}"
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
@@ -0,0 +1,214 @@
+import argparse
+import csv
+import json
+import logging
+import re
+import sys
+import time
+
+from elasticsearch import helpers
+
+import llm
+from normalizacion import buscar_fechas
+
+# Mapping del esquema documentado en el README. Los campos de texto por los que se
+# filtra o agrupa llevan un subcampo keyword para las coincidencias exactas.
+_TEXTO_CON_KEYWORD = {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 256}}}
+
+MAPPING_HOTELES = {
+    "properties": {
+        "nombre": _TEXTO_CON_KEYWORD,
+        "provincia": _TEXTO_CON_KEYWORD,
+        "localidad": _TEXTO_CON_KEYWORD,
+        "servicios": _TEXTO_CON_KEYWORD,
+        "location": {"type": "geo_point"},
+        "descripcion": {"type": "text"},
+        "precio": {"type": "integer"},
+        "fechaEntrada": {"type": "date", "format": "yyyy-MM-dd"},
+        "opinion": {"type": "float"},
+        "comentarios": {"type": "integer"},
+        "url": {"type": "text"},
+        # Resúmenes de precalcular_resumenes.py
+        "resumen": {"type": "text"},
+        "resumen_hash": {"type": "keyword"},
+        "resumen_modelo": {"type": "keyword"},
+        "resumen_fecha": {"type": "date"},
+    }
+}
+
+TAMANO_LOTE = 1000
+HILOS = 4
+INFORME_CADA = 10000
+
+
+def detectar_formato(ruta: str) -> str:
+    return "csv" if ruta.endswith(".csv") else "jsonl"
+
+
+def leer_filas(entrada, formato: str):
+    """Devuelve las filas una a una, sin cargar el fichero completo en memoria."""
+    if formato == "csv":
+        yield from csv.DictReader(entrada)
+        return
+    for linea in entrada:
+        if linea.strip():
+            yield json.loads(linea)
+
+
+def _numero(valor, miles: bool = False):
+    """Número escrito con coma o punto decimal ("12,5", "12.5"); con miles, también "1.234" o "1.234,50"."""
+    if valor in (None, ""):
+        return None
+    if isinstance(valor, (int, float)):
+        return valor
+    texto = str(valor).replace("€", "").replace(" ", "").strip()
+    if "," in texto and "." in texto:
+        # El separador que va más a la derecha es el decimal
+        decimal, millar = (",", ".") if texto.rfind(",") > texto.rfind(".") else (".", ",")
+        texto = texto.replace(millar, "").replace(decimal, ".")
+    elif texto.count(",") == 1:
+        texto = texto.replace(",", ".")
+    elif miles and re.fullmatch(r"[+-]?\d{1,3}([.,]\d{3})+", texto):
+        texto = texto.replace(".", "").replace(",", "")
+    return float(texto)
+
+
+def _entero(valor):
+    numero = _numero(valor, miles=True)
+    if numero is not None and numero != int(numero):
+        raise ValueError(f"{valor!r} no es un número entero")
+    return None if numero is None else int(numero)
+
+
+def _precio(valor):
+    # El mapping guarda euros enteros: se redondea al euro más cercano en lugar de truncar
+    numero = _numero(valor, miles=True)
+    return None if numero is None else int(round(numero))
+
+
+def _decimal(valor):
+    return _numero(valor)
+
+
+def preparar_documento(fila: dict) -> dict:
+    """Convierte una fila (JSONL o CSV) a los tipos del mapping."""
+    documento = {campo: valor for campo, valor in fila.items() if valor not in (None, "")}
+
+    servicios = documento.get("servicios")
+    if isinstance(servicios, str):
+        documento["servicios"] = [s.strip() for s in re.split(r"[,;|]", servicios) if s.strip()]
+
+    for campo, conversion in (("precio", _precio), ("comentarios", _entero), ("opinion", _decimal)):
+        if campo in documento:
+            try:
+                documento[campo] = conversion(documento[campo])
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"{campo}: {e}") from e
+
+    fecha = documento.get("fechaEntrada")
+    if isinstance(fecha, str):
+        fechas = buscar_fechas(fecha.lower())
+        if fechas:
+            documento["fechaEntrada"] = fechas[0][2]
+
+    # location como objeto, "lat,lon" o columnas lat/lon (CSV)
+    if "lat" in documento and "lon" in documento:
+        documento["location"] = {"lat": _decimal(documento.pop("lat")), "lon": _decimal(documento.pop("lon"))}
+    elif isinstance(documento.get("location"), str):
+        lat, _, lon = documento["location"].partition(",")
+        documento["location"] = {"lat": _decimal(lat), "lon": _decimal(lon)}
+    return documento
+
+
+def acciones_bulk(filas, indice: str, campo_id: str = None, estadisticas: dict = None):
+    """Acciones _bulk de las filas. Las que no se pueden convertir se descartan y cuentan como errores."""
+    for numero, fila in enumerate(filas, 1):
+        try:
+            documento = preparar_documento(fila)
+        except (TypeError, ValueError) as e:
+            if estadisticas is not None:
+                estadisticas["errores"] += 1
+            logging.warning(f"Fila {numero} descartada: {e}")
+            continue
+        accion = {"_index": indice, "_source": documento}
+        if campo_id and documento.get(campo_id) is not None:
+            accion["_id"] = str(documento[campo_id])
+        yield accion
+
+
+def crear_indice(es, indice: str, recrear: bool = False, replicas: int = 1):
+    if recrear and es.indices.exists(index=indice):
+        es.indices.delete(index=indice)
+    if not es.indices.exists(index=indice):
+        es.indices.create(index=indice, mappings=MAPPING_HOTELES,
+                          settings={"number_of_replicas": replicas})
+    else:
+        es.indices.put_mapping(index=indice, properties=MAPPING_HOTELES["properties"])
+
+
+def ajustes_carga(es, indice: str) -> dict:
+    """Ajustes actuales de refresco y réplicas, para restaurarlos después de la carga."""
+    ajustes = es.indices.get_settings(index=indice, name=["index.refresh_interval", "index.number_of_replicas"],
+                                      include_defaults=True)
+    datos = ajustes.get(indice, {})
+    valor = lambda clave, defecto: (datos.get("settings", {}).get("index", {}).get(clave)
+                                    or datos.get("defaults", {}).get("index", {}).get(clave, defecto))
+    return {"refresh_interval": valor("refresh_interval", "1s"), "number_of_replicas": valor("number_of_replicas", "1")}
+
+
+def cargar(es, filas, indice: str, tamano_lote: int = TAMANO_LOTE, hilos: int = HILOS, campo_id: str = None) -> dict:
+    """Indexa las filas con parallel_bulk sin refresco ni réplicas, y restaura los ajustes al terminar."""
+    originales = ajustes_carga(es, indice)
+    es.indices.put_settings(index=indice, settings={"refresh_interval": "-1", "number_of_replicas": 0})
+    estadisticas = {"indexados": 0, "errores": 0}
+    inicio = time.perf_counter()
+    try:
+        for correcto, resultado in helpers.parallel_bulk(es, acciones_bulk(filas, indice, campo_id, estadisticas),
+                                                         thread_count=hilos, chunk_size=tamano_lote,
+                                                         raise_on_error=False, raise_on_exception=False):
+            if correcto:
+                estadisticas["indexados"] += 1
+            else:
+                estadisticas["errores"] += 1
+                logging.warning(f"Documento no indexado: {resultado}")
+            total = estadisticas["indexados"] + estadisticas["errores"]
+            if total % INFORME_CADA == 0:
+                print(f"{total} documentos, {total / (time.perf_counter() - inicio):.0f} docs/s", file=sys.stderr)
+    finally:
+        es.indices.put_settings(index=indice, settings=originales)
+        es.indices.refresh(index=indice)
+    segundos = time.perf_counter() - inicio
+    estadisticas["segundos"] = round(segundos, 2)
+    estadisticas["docs_por_segundo"] = round(estadisticas["indexados"] / segundos, 1) if segundos else 0.0
+    return estadisticas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga hoteles desde JSONL o CSV en el índice de Elasticsearch.")
+    parser.add_argument("entrada", nargs="?", default="-", help="Fichero JSONL/CSV ('-' para stdin)")
+    parser.add_argument("-f", "--formato", choices=["jsonl", "csv"], help="Formato de la entrada")
+    parser.add_argument("-i", "--indice", default=llm.ES_INDEX, help="Índice destino (por defecto ES_INDEX)")
+    parser.add_argument("--recrear", action="store_true", help="Borra el índice antes de crearlo de nuevo")
+    parser.add_argument("--replicas", type=int, default=1, help="Réplicas del índice si se crea (por defecto 1)")
+    parser.add_argument("--lote", type=int, default=TAMANO_LOTE, help="Documentos por petición _bulk")
+    parser.add_argument("--hilos", type=int, default=HILOS, help="Peticiones _bulk simultáneas")
+    parser.add_argument("--campo-id", help="Campo que se usa como _id (si no, lo asigna Elasticsearch)")
+    args = parser.parse_args()
+
+    llm.configurar_logging()
+    formato = args.formato or detectar_formato(args.entrada)
+    entrada = sys.stdin if args.entrada == "-" else open(args.entrada, encoding="utf-8", newline="")
+    es = llm.obtener_es()
+    try:
+        crear_indice(es, args.indice, args.recrear, args.replicas)
+        estadisticas = cargar(es, leer_filas(entrada, formato), args.indice, args.lote, args.hilos, args.campo_id)
+    finally:
+        if entrada is not sys.stdin:
+            entrada.close()
+    logging.info(f"Carga en {args.indice}: {estadisticas}")
+    print(f"{estadisticas['indexados']} documentos indexados ({estadisticas['errores']} errores) "
+          f"en {estadisticas['segundos']}s, {estadisticas['docs_por_segundo']} docs/s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
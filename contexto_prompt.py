@@ -0,0 +1,169 @@
+import re
+
+from normalizacion import quitar_acentos
+
+# Campos de _source que usa el prompt de respuesta; el resto no se descarga
+CAMPOS_PROMPT = [
+    "nombre", "provincia", "localidad", "direccion", "descripcion",
+    "servicios", "opinion", "comentarios", "url", "precio", "resumen",
+]
+
+CABECERA = "Describe brevemente y en lenguaje natural los siguientes hoteles:\n\n"
+
+# Paso final de la respuesta por bloques: solo una introducción corta, las descripciones ya están escritas
+CABECERA_FUSION = (
+    "Estas son las descripciones de {hoteles} hoteles encontrados para el usuario. "
+    "Escribe una introducción de dos o tres frases que resuma las opciones (zonas, precios, "
+    "puntuaciones) sin repetir los detalles de cada hotel:\n\n"
+)
+
+# Aproximación habitual para texto en español con tokenizadores BPE
+CARACTERES_POR_TOKEN = 4
+
+
+def estimar_tokens(texto: str) -> int:
+    return (len(texto) + CARACTERES_POR_TOKEN - 1) // CARACTERES_POR_TOKEN
+
+
+def deduplicar_servicios(servicios) -> list:
+    if not isinstance(servicios, list):
+        servicios = [s for s in re.split(r"\s*,\s*", str(servicios or "")) if s]
+    vistos = set()
+    unicos = []
+    for servicio in servicios:
+        clave = quitar_acentos(str(servicio).strip().lower())
+        if clave and clave not in vistos:
+            vistos.add(clave)
+            unicos.append(str(servicio).strip())
+    return unicos
+
+
+def recortar_descripcion(descripcion: str, max_tokens: int) -> str:
+    """Recorta la descripción a max_tokens quedándose con frases completas siempre que sea posible."""
+    if estimar_tokens(descripcion) <= max_tokens:
+        return descripcion
+    limite = max(max_tokens * CARACTERES_POR_TOKEN - 1, 0)
+    recorte = descripcion[:limite]
+    fin_frase = max(recorte.rfind(". "), recorte.rfind(".\n"))
+    if fin_frase >= limite // 2:
+        return recorte[:fin_frase + 1]
+    espacio = recorte.rfind(" ")
+    return (recorte[:espacio] if espacio > 0 else recorte).rstrip(" ,;:") + "…"
+
+
+def precio_hotel(hotel: dict) -> str:
+    """Precio por noche; en una estancia (ver estancias.py), el mínimo y el máximo de las noches y el total."""
+    if "noches" not in hotel:
+        return f"{hotel.get('precio', 'N/A')} EUR"
+    minimo, maximo = hotel.get("precio_min"), hotel.get("precio_max")
+    texto = f"{minimo} EUR por noche" if minimo == maximo else f"de {minimo} a {maximo} EUR por noche"
+    if hotel.get("precio_total") is not None:
+        texto += f" ({hotel['precio_total']} EUR en total por {hotel['noches']} noches)"
+    return texto
+
+
+def formatear_hotel(hotel: dict, descripcion: str, servicios: list) -> str:
+    return f"""Hotel {hotel.get('nombre', 'N/A')}:
+
+- Provincia: {hotel.get('provincia', 'N/A')}
+- Localidad: {hotel.get('localidad', 'N/A')}
+- Direccion: {hotel.get('direccion', 'N/A')}
+- Descripcion: {descripcion}
+- Servicios: {', '.join(servicios)}
+- Puntuacion: {hotel.get('opinion', 'Sin opiniones')}
+- Número de comentarios: ({hotel.get('comentarios', '0')} comentarios)
+- Url: {hotel.get('url', 'N/A')}
+- Precio: {precio_hotel(hotel)}
+
+"""
+
+
+def construir_contexto(hits: list, presupuesto_tokens: int = None):
+    """Construye el prompt de respuesta sin superar presupuesto_tokens.
+
+    Los hits se asumen ordenados por relevancia: si ni siquiera caben sus datos
+    sin descripción se descartan los últimos, y el presupuesto restante se reparte
+    entre las descripciones. Devuelve (prompt, informe) donde el informe indica
+    cuántos tokens se han ahorrado frente al prompt sin recortar.
+    """
+    hoteles = [hit.get("_source", {}) for hit in hits]
+    servicios = [deduplicar_servicios(h.get("servicios", [])) for h in hoteles]
+    # El resumen precalculado (precalcular_resumenes.py) sustituye a la descripción completa
+    descripciones = [str(h.get("resumen") or h.get("descripcion", "") or "") for h in hoteles]
+    original = CABECERA + "".join(
+        formatear_hotel(h, d, h.get("servicios") if isinstance(h.get("servicios"), list) else [str(h.get("servicios", ""))])
+        for h, d in zip(hoteles, descripciones)
+    )
+
+    fijos = [estimar_tokens(formatear_hotel(h, "", s)) for h, s in zip(hoteles, servicios)]
+    disponible = presupuesto_tokens - estimar_tokens(CABECERA) if presupuesto_tokens else None
+    incluidos = len(hoteles)
+    if disponible is not None:
+        usados = 0
+        for i, coste in enumerate(fijos):
+            if usados + coste > disponible and i > 0:
+                incluidos = i
+                break
+            usados += coste
+        disponible = max(disponible - usados, 0)
+
+    # Reparto del presupuesto entre descripciones: las cortas se quedan enteras y lo
+    # que sobra se redistribuye entre las largas
+    longitudes = [estimar_tokens(d) for d in descripciones[:incluidos]]
+    cupos = list(longitudes)
+    if disponible is not None and sum(longitudes) > disponible:
+        pendientes = sorted(range(incluidos), key=lambda i: longitudes[i])
+        restante = disponible
+        while pendientes:
+            cupo = restante // len(pendientes)
+            i = pendientes.pop(0)
+            cupos[i] = min(longitudes[i], cupo)
+            restante -= cupos[i]
+
+    bloques = []
+    recortadas = 0
+    for i in range(incluidos):
+        descripcion = recortar_descripcion(descripciones[i], cupos[i]) if cupos[i] else ""
+        recortadas += descripcion != descripciones[i]
+        bloques.append(formatear_hotel(hoteles[i], descripcion, servicios[i]))
+    prompt = (CABECERA + "".join(bloques)).strip()
+
+    informe = {
+        "tokens_originales": estimar_tokens(original.strip()),
+        "tokens_finales": estimar_tokens(prompt),
+        "hoteles_descartados": len(hoteles) - incluidos,
+        "descripciones_recortadas": recortadas,
+    }
+    informe["tokens_ahorrados"] = informe["tokens_originales"] - informe["tokens_finales"]
+    return prompt, informe
+
+
+def dividir_en_bloques(hits: list, tamano: int) -> list:
+    return [hits[i:i + tamano] for i in range(0, len(hits), tamano)]
+
+
+def construir_prompt_fusion(descripciones: list, hoteles: int, presupuesto_tokens: int = None) -> str:
+    """Prompt del paso de fusión; cada descripción se recorta a su parte del presupuesto."""
+    cupo = None
+    if presupuesto_tokens and descripciones:
+        cupo = max(presupuesto_tokens - estimar_tokens(CABECERA_FUSION), 0) // len(descripciones)
+    partes = [recortar_descripcion(d, cupo) if cupo is not None else d for d in descripciones]
+    return CABECERA_FUSION.format(hoteles=hoteles) + "\n\n".join(partes)
+
+
+def respuesta_precalculada(hits: list) -> str:
+    """Respuesta sin LLM uniendo los resúmenes precalculados; None si algún hotel no lo tiene."""
+    if not hits or not all(hit.get("_source", {}).get("resumen") for hit in hits):
+        return None
+    partes = []
+    for hit in hits:
+        hotel = hit["_source"]
+        lugar = ", ".join(str(hotel[c]) for c in ("localidad", "provincia") if hotel.get(c))
+        datos = [precio_hotel(hotel) if hotel.get("precio") is not None else "",
+                 f"puntuación {hotel['opinion']}" if hotel.get("opinion") is not None else "",
+                 str(hotel.get("url") or "")]
+        partes.append(
+            f"**{hotel.get('nombre', 'Hotel')}**" + (f" ({lugar})" if lugar else "") + f": {hotel['resumen'].strip()}"
+            + ("".join(f"\n- {d}" for d in datos if d))
+        )
+    return "\n\n".join(partes)
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import logging
+import math
+import re
+from collections import Counter, defaultdict
+
+from esquema_consulta import validar_consulta
+from normalizacion import normalizar_pregunta
+
+# Palabras que no ayudan a distinguir un ejemplo de otro
+PALABRAS_VACIAS = {
+    "a", "al", "con", "de", "del", "el", "en", "es", "hay", "la", "las", "lo", "los", "me", "mi", "para",
+    "por", "que", "se", "un", "una", "unos", "unas", "y", "o", "dime", "muestrame", "quiero", "hotel", "hoteles",
+}
+
+_FECHA_ISO = re.compile(r"\b\d{4}-\d{2}-\d{2}\b")
+_NUMERO = re.compile(r"\b\d+(?:[.,]\d+)?\b")
+_TOKEN = re.compile(r"[a-zñ0-9]+")
+
+
+def tokenizar(pregunta: str) -> list:
+    """Palabras de la pregunta normalizada; fechas y números se sustituyen por un token común."""
+    texto = _FECHA_ISO.sub(" _fecha ", normalizar_pregunta(pregunta))
+    texto = _NUMERO.sub(" _numero ", texto)
+    return [t for t in re.findall(r"_fecha|_numero|" + _TOKEN.pattern, texto) if t not in PALABRAS_VACIAS]
+
+
+def cargar_ejemplos(ruta: str, mapeo: dict = None) -> list:
+    """Lee un JSONL {"pregunta", "consulta"} y descarta los ejemplos cuya consulta no es válida."""
+    ejemplos = []
+    with open(ruta, encoding="utf-8") as f:
+        for numero, linea in enumerate(f, 1):
+            if not linea.strip():
+                continue
+            ejemplo = json.loads(linea)
+            errores = validar_consulta(ejemplo.get("consulta"), mapeo)
+            if errores:
+                logging.warning(f"Ejemplo {numero} de {ruta} descartado: {errores}")
+                continue
+            ejemplos.append(ejemplo)
+    return ejemplos
+
+
+class SelectorEjemplos:
+    """Recupera los ejemplos pregunta -> consulta más parecidos a una pregunta con BM25 en memoria."""
+
+    def __init__(self, ejemplos: list, k1: float = 1.5, b: float = 0.75):
+        self.ejemplos = ejemplos
+        self.k1 = k1
+        self.b = b
+        self._longitudes = []
+        self._indice = defaultdict(list)
+        for i, ejemplo in enumerate(ejemplos):
+            terminos = Counter(tokenizar(ejemplo["pregunta"]))
+            self._longitudes.append(sum(terminos.values()))
+            for termino, frecuencia in terminos.items():
+                self._indice[termino].append((i, frecuencia))
+        self._media = sum(self._longitudes) / len(self._longitudes) if ejemplos else 0
+        total = len(ejemplos)
+        self._idf = {t: math.log(1 + (total - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self._indice.items()}
+
+    @classmethod
+    def desde_fichero(cls, ruta: str, mapeo: dict = None) -> "SelectorEjemplos":
+        return cls(cargar_ejemplos(ruta, mapeo))
+
+    def huella(self) -> str:
+        """Cambia si cambian los ejemplos (forma parte de la versión de la caché de consultas)."""
+        return hashlib.sha256(json.dumps(self.ejemplos, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def seleccionar(self, pregunta: str, k: int = 3) -> list:
+        """Los k ejemplos con mayor puntuación; si hay empate o ninguno coincide, los primeros del fichero."""
+        puntuaciones = defaultdict(float)
+        for termino in set(tokenizar(pregunta)):
+            idf = self._idf.get(termino)
+            if idf is None:
+                continue
+            for i, frecuencia in self._indice[termino]:
+                norma = self.k1 * (1 - self.b + self.b * self._longitudes[i] / self._media)
+                puntuaciones[i] += idf * frecuencia * (self.k1 + 1) / (frecuencia + norma)
+        elegidos = sorted(puntuaciones, key=lambda i: (-puntuaciones[i], i))[:k]
+        elegidos += [i for i in range(len(self.ejemplos)) if i not in elegidos][:k - len(elegidos)]
+        return [self.ejemplos[i] for i in elegidos]
+
+    def mensajes(self, plantilla: str, pregunta: str, k: int = 3) -> list:
+        """Como esquema_consulta.mensajes_consulta, pero con los k ejemplos más parecidos a la pregunta.
+
+        El mensaje de sistema (instrucciones y esquema, lo anterior a "Ejemplo 1:") sigue siendo
+        fijo; los ejemplos van en el mensaje del usuario, delante de la pregunta.
+        """
+        encabezado = plantilla.split("Ejemplo 1:")[0].strip()
+        instruccion = plantilla.strip().rpartition("\n\n")[2]
+        ejemplos = "\n\n".join(
+            f"Ejemplo {n}:\nPregunta: \"{e['pregunta']}\"\nRespuesta JSON:\n{json.dumps(e['consulta'], ensure_ascii=False)}"
+            for n, e in enumerate(self.seleccionar(pregunta, k), 1)
+        )
+        return [
+            {"role": "system", "content": encabezado},
+            {"role": "user", "content": f"{ejemplos}\n\n{instruccion.replace('{pregunta}', pregunta)}"},
+        ]
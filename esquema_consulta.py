@@ -0,0 +1,553 @@
+import json
+import re
+
+from normalizacion import buscar_fechas, quitar_acentos
+
+# Campos del índice de hoteles y su tipo (ver "Esquema esperado en Elasticsearch" en el README).
+# Si se puede leer el mapping real del índice se usa ese (ver mapeo_desde_indice).
+MAPEO = {
+    "nombre": "text",
+    "provincia": "text",
+    "localidad": "text",
+    "servicios": "text",
+    "location": "geo_point",
+    "descripcion": "text",
+    "precio": "integer",
+    "fechaEntrada": "date",
+    "opinion": "float",
+    "comentarios": "integer",
+    "url": "text",
+}
+
+# Nombres que el LLM usa a veces en lugar del campo real
+ALIAS = {
+    "ciudad": "localidad",
+    "poblacion": "localidad",
+    "municipio": "localidad",
+    "fecha": "fechaEntrada",
+    "fecha_entrada": "fechaEntrada",
+    "fechadeentrada": "fechaEntrada",
+    "servicio": "servicios",
+    "hotel": "nombre",
+    "precios": "precio",
+    "puntuacion": "opinion",
+    "ubicacion": "location",
+}
+
+TIPOS_TEXTO = {"text", "match_only_text"}
+TIPOS_NUMERICOS = {"integer", "long", "short", "byte", "float", "double", "half_float", "scaled_float"}
+CLAVES_RAIZ = {"query", "sort", "size", "from", "aggs"}
+OCURRENCIAS_BOOL = ("must", "filter", "should", "must_not")
+OPERADORES_RANGO = {"gt", "gte", "lt", "lte", "format"}
+TAMANO_MAXIMO = 100
+TAMANO_POR_DEFECTO = 10
+
+# Modo agregación (size 0): métricas sobre campos numéricos, terms sobre los campos keyword que tenga
+# el mapping real (los subcampos .keyword de cargar_hoteles.py) y top_hits para "el hotel más barato".
+# La respuesta sale de una plantilla
+METRICAS_AGREGACION = {"min", "max", "avg"}
+TAMANO_MAXIMO_TERMS = 20
+TAMANO_MAXIMO_TOP_HITS = 10
+
+PROMPT_CORRECCION = (
+    "La consulta anterior no es válida para el índice de hoteles:\n{errores}\n"
+    "Devuelve SOLO la consulta JSON corregida."
+)
+
+
+def mensajes_consulta(plantilla: str, pregunta: str) -> list:
+    """Divide el prompt few-shot en un mensaje de sistema fijo y la pregunta del usuario.
+
+    Las instrucciones y los ejemplos son el último párrafo sin {pregunta}: al ir siempre
+    idénticos al principio, OpenRouter y Ollama pueden reutilizar ese prefijo entre preguntas.
+    """
+    prefijo, _, instruccion = plantilla.strip().rpartition("\n\n")
+    return [
+        {"role": "system", "content": prefijo},
+        {"role": "user", "content": instruccion.replace("{pregunta}", pregunta)},
+    ]
+
+
+def mapeo_desde_indice(respuesta) -> dict:
+    """Convierte la respuesta de indices.get_mapping en {campo: tipo}, incluidos los subcampos (nombre.keyword)."""
+    mapeo = {}
+
+    def recorrer(propiedades, prefijo=""):
+        for campo, definicion in propiedades.items():
+            ruta = prefijo + campo
+            if "properties" in definicion:
+                recorrer(definicion["properties"], ruta + ".")
+                continue
+            mapeo[ruta] = definicion.get("type", "object")
+            for subcampo, subdefinicion in definicion.get("fields", {}).items():
+                mapeo[f"{ruta}.{subcampo}"] = subdefinicion.get("type", "keyword")
+
+    for indice in dict(respuesta).values():
+        if isinstance(indice, dict):
+            recorrer(indice.get("mappings", {}).get("properties", {}))
+    return mapeo
+
+
+def esquema_json(mapeo: dict = None) -> dict:
+    """JSON schema de la consulta, para el parámetro format de Ollama y response_format de OpenAI."""
+    mapeo = mapeo or MAPEO
+    texto = sorted(c for c, t in mapeo.items() if t in TIPOS_TEXTO)
+    exactos = sorted(c for c, t in mapeo.items() if t not in TIPOS_TEXTO and t != "geo_point")
+    ordenables = sorted(c for c, t in mapeo.items() if t in TIPOS_NUMERICOS or t in ("date", "keyword"))
+    geo = sorted(c for c, t in mapeo.items() if t == "geo_point")
+    numericos = sorted(c for c, t in mapeo.items() if t in TIPOS_NUMERICOS)
+    keywords = sorted(c for c, t in mapeo.items() if t == "keyword")
+
+    def por_campo(campos, valor):
+        return {"type": "object", "properties": {c: valor for c in campos},
+                "additionalProperties": False, "minProperties": 1, "maxProperties": 1}
+
+    valor_match = {"anyOf": [
+        {"type": "string"},
+        {"type": "object", "properties": {"query": {"type": "string"}, "operator": {"enum": ["and", "or"]}},
+         "required": ["query"], "additionalProperties": False},
+    ]}
+    valor_exacto = {"type": ["string", "number"]}
+    valor_rango = {"type": "object", "properties": {op: valor_exacto for op in ("gt", "gte", "lt", "lte")},
+                   "additionalProperties": False, "minProperties": 1}
+    lista_clausulas = {"type": "array", "items": {"$ref": "#/$defs/clausula"}}
+    clausula = {"anyOf": [
+        {"type": "object", "properties": {"match_all": {"type": "object"}}, "required": ["match_all"], "additionalProperties": False},
+        {"type": "object", "properties": {"match": por_campo(texto, valor_match)}, "required": ["match"], "additionalProperties": False},
+        {"type": "object", "properties": {"match_phrase": por_campo(texto, {"type": "string"})}, "required": ["match_phrase"], "additionalProperties": False},
+        {"type": "object", "properties": {"term": por_campo(exactos, valor_exacto)}, "required": ["term"], "additionalProperties": False},
+        {"type": "object", "properties": {"terms": por_campo(exactos, {"type": "array", "items": valor_exacto})}, "required": ["terms"], "additionalProperties": False},
+        {"type": "object", "properties": {"range": por_campo(exactos, valor_rango)}, "required": ["range"], "additionalProperties": False},
+        {"type": "object", "properties": {"bool": {
+            "type": "object",
+            "properties": {**{o: lista_clausulas for o in OCURRENCIAS_BOOL}, "minimum_should_match": {"type": ["integer", "string"]}},
+            "additionalProperties": False,
+        }}, "required": ["bool"], "additionalProperties": False},
+    ]}
+    if geo:
+        clausula["anyOf"].append({"type": "object", "properties": {"geo_distance": {
+            "type": "object",
+            "properties": {"distance": {"type": "string"}, **{c: {"type": "object", "properties": {
+                "lat": {"type": "number"}, "lon": {"type": "number"}}, "required": ["lat", "lon"]} for c in geo}},
+            "required": ["distance"],
+        }}, "required": ["geo_distance"], "additionalProperties": False})
+
+    orden = {"type": "array", "items": por_campo(ordenables, {"enum": ["asc", "desc"]})}
+    metrica = {"type": "object", "properties": {"field": {"enum": numericos}}, "required": ["field"], "additionalProperties": False}
+    metricas = [{"type": "object", "properties": {m: metrica}, "required": [m], "additionalProperties": False}
+                for m in sorted(METRICAS_AGREGACION)]
+    agregacion = {"anyOf": metricas + [
+        {"type": "object", "properties": {
+            "top_hits": {"type": "object", "properties": {
+                "size": {"type": "integer", "minimum": 1, "maximum": TAMANO_MAXIMO_TOP_HITS}, "sort": orden},
+                "additionalProperties": False},
+        }, "required": ["top_hits"], "additionalProperties": False},
+    ]}
+    # Sin campos keyword en el índice (mapping del README, todo text) no se ofrece terms
+    if keywords:
+        agregacion["anyOf"].append({"type": "object", "properties": {
+            "terms": {"type": "object", "properties": {
+                "field": {"enum": keywords}, "size": {"type": "integer", "minimum": 1, "maximum": TAMANO_MAXIMO_TERMS}},
+                "required": ["field"], "additionalProperties": False},
+            "aggs": {"type": "object", "additionalProperties": {"anyOf": metricas}},
+        }, "required": ["terms"], "additionalProperties": False})
+
+    return {
+        "type": "object",
+        "properties": {
+            "query": {"$ref": "#/$defs/clausula"},
+            "sort": orden,
+            "size": {"type": "integer", "minimum": 0, "maximum": TAMANO_MAXIMO},
+            "aggs": {"type": "object", "additionalProperties": agregacion},
+        },
+        "required": ["query", "size"],
+        "additionalProperties": False,
+        "$defs": {"clausula": clausula},
+    }
+
+
+def extraer_json(texto: str):
+    """Devuelve el primer objeto JSON completo que aparezca en el texto (o None).
+
+    A diferencia de buscar r'\\{.*\\}', se detiene al cerrar el primer objeto, así que
+    tolera texto o un segundo bloque después de la consulta y los bloques ```json.
+    """
+    if not texto:
+        return None
+    decodificador = json.JSONDecoder()
+    for inicio in (m.start() for m in re.finditer(r"\{", texto)):
+        try:
+            valor, _ = decodificador.raw_decode(texto, inicio)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(valor, dict):
+            return valor
+    return None
+
+
+def _resolver_campo(campo: str, mapeo: dict):
+    if campo in mapeo:
+        return campo
+    normalizado = quitar_acentos(str(campo).lower()).replace(" ", "")
+    for real in mapeo:
+        if quitar_acentos(real.lower()) == normalizado:
+            return real
+    base, _, sufijo = normalizado.partition(".")
+    real = ALIAS.get(base)
+    if real in mapeo:
+        return real
+    if sufijo and base in {c.lower() for c in mapeo}:
+        return _resolver_campo(base, mapeo)
+    return None
+
+
+def _numero(valor):
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return valor
+    match = re.fullmatch(r"\s*(-?\d+(?:[.,]\d+)?)\s*(?:€|eur|euros)?\s*", str(valor), re.IGNORECASE)
+    if not match:
+        return None
+    numero = float(match.group(1).replace(",", "."))
+    return int(numero) if numero.is_integer() else numero
+
+
+def _fecha(valor):
+    texto = str(valor).strip()
+    if re.fullmatch(r"\d{4}-\d{2}-\d{2}", texto):
+        return texto
+    fechas = buscar_fechas(quitar_acentos(texto.lower()))
+    return fechas[0][2] if fechas else None
+
+
+def _valor_exacto(valor, tipo: str):
+    if tipo in TIPOS_NUMERICOS:
+        return _numero(valor)
+    if tipo == "date":
+        return _fecha(valor)
+    return valor
+
+
+def _reparar_clausula(clausula, mapeo: dict, cambios: list):
+    if not isinstance(clausula, dict) or len(clausula) != 1:
+        return clausula
+    tipo, cuerpo = next(iter(clausula.items()))
+
+    if tipo == "bool" and isinstance(cuerpo, dict):
+        reparado = {}
+        for clave, valor in cuerpo.items():
+            if clave in OCURRENCIAS_BOOL:
+                lista = valor if isinstance(valor, list) else [valor]
+                if not isinstance(valor, list):
+                    cambios.append(f"bool.{clave} convertido en lista")
+                reparado[clave] = [_reparar_clausula(c, mapeo, cambios) for c in lista]
+            else:
+                reparado[clave] = valor
+        return {"bool": reparado}
+
+    if tipo in ("match", "match_phrase", "term", "terms", "range") and isinstance(cuerpo, dict) and len(cuerpo) == 1:
+        campo, valor = next(iter(cuerpo.items()))
+        real = _resolver_campo(campo, mapeo)
+        if real is None:
+            return clausula
+        if real != campo:
+            cambios.append(f"campo {campo} -> {real}")
+        tipo_campo = mapeo[real]
+        # term/terms sobre un campo text casi nunca coincide: el texto está analizado
+        if tipo in ("term", "terms") and tipo_campo in TIPOS_TEXTO:
+            if isinstance(valor, dict):
+                valor = valor.get("value", "")
+            if isinstance(valor, list):
+                valor = " ".join(str(v) for v in valor)
+            cambios.append(f"{tipo} sobre {real} (text) -> match")
+            return {"match": {real: valor}}
+        if tipo == "term" and tipo_campo not in TIPOS_TEXTO:
+            original = valor.get("value") if isinstance(valor, dict) else valor
+            exacto = _valor_exacto(original, tipo_campo)
+            if exacto is not None and exacto != original:
+                cambios.append(f"valor de {real} normalizado: {original!r} -> {exacto!r}")
+                valor = exacto
+        if tipo == "range" and isinstance(valor, dict):
+            rango = {}
+            for operador, limite in valor.items():
+                exacto = _valor_exacto(limite, tipo_campo) if operador != "format" else limite
+                if exacto is not None and exacto != limite:
+                    cambios.append(f"límite de {real} normalizado: {limite!r} -> {exacto!r}")
+                rango[operador] = exacto if exacto is not None else limite
+            valor = rango
+        return {tipo: {real: valor}}
+
+    return clausula
+
+
+def _reparar_orden(orden, mapeo: dict, cambios: list):
+    if isinstance(orden, (str, dict)):
+        orden = [orden]
+        cambios.append("sort convertido en lista")
+    reparado = []
+    for criterio in orden if isinstance(orden, list) else []:
+        if isinstance(criterio, str):
+            campo, _, sentido = criterio.partition(":")
+            criterio = {campo: sentido or "asc"}
+        if not isinstance(criterio, dict) or len(criterio) != 1:
+            continue
+        campo, sentido = next(iter(criterio.items()))
+        if campo == "_score":
+            reparado.append(criterio)
+            continue
+        real = _resolver_campo(campo, mapeo)
+        if real is None or mapeo[real] in TIPOS_TEXTO:
+            cambios.append(f"orden por {campo} eliminado")
+            continue
+        if isinstance(sentido, str) and sentido.lower() in ("asc", "desc"):
+            sentido = sentido.lower()
+        if real != campo:
+            cambios.append(f"campo {campo} -> {real}")
+        reparado.append({real: sentido})
+    return reparado
+
+
+def _campo_keyword(campo: str, mapeo: dict):
+    """Campo keyword para terms: el propio si ya lo es, o su subcampo .keyword si existe en el mapping."""
+    if mapeo.get(campo) == "keyword":
+        return campo
+    base = campo.split(".")[0]
+    if mapeo.get(f"{base}.keyword") == "keyword":
+        return f"{base}.keyword"
+    return None
+
+
+def _reparar_agregacion(agregacion, mapeo: dict, cambios: list, anidada: bool = False):
+    if not isinstance(agregacion, dict):
+        return agregacion
+    reparada = {}
+    for tipo, cuerpo in agregacion.items():
+        if tipo in ("aggs", "aggregations") and isinstance(cuerpo, dict) and not anidada:
+            reparada["aggs"] = {n: _reparar_agregacion(a, mapeo, cambios, True) for n, a in cuerpo.items()}
+            continue
+        if not isinstance(cuerpo, dict):
+            reparada[tipo] = cuerpo
+            continue
+        cuerpo = dict(cuerpo)
+        campo = cuerpo.get("field")
+        if isinstance(campo, str):
+            real = _resolver_campo(campo, mapeo)
+            if tipo == "terms":
+                real = _campo_keyword(real or campo, mapeo)
+            if real and real != campo:
+                cambios.append(f"campo {campo} -> {real}")
+                cuerpo["field"] = real
+        if tipo == "top_hits" and "sort" in cuerpo:
+            cuerpo["sort"] = _reparar_orden(cuerpo["sort"], mapeo, cambios)
+        reparada[tipo] = cuerpo
+    return reparada
+
+
+def reparar_consulta(consulta, mapeo: dict = None):
+    """Corrige localmente los fallos habituales del LLM. Devuelve (consulta, cambios)."""
+    mapeo = mapeo or MAPEO
+    cambios = []
+    if not isinstance(consulta, dict):
+        return consulta, cambios
+
+    # {"consulta": {...}} o {"body": {...}}
+    if "query" not in consulta and len(consulta) == 1:
+        interior = next(iter(consulta.values()))
+        if isinstance(interior, dict) and "query" in interior:
+            consulta = interior
+            cambios.append("consulta desenvuelta")
+    # Solo la cláusula, sin "query"
+    if "query" not in consulta and len(consulta) == 1 and next(iter(consulta)) in (
+            "bool", "match", "match_phrase", "term", "terms", "range", "match_all", "geo_distance"):
+        consulta = {"query": consulta}
+        cambios.append("cláusula envuelta en query")
+
+    if "aggregations" in consulta and "aggs" not in consulta:
+        consulta = {("aggs" if clave == "aggregations" else clave): valor for clave, valor in consulta.items()}
+        cambios.append("aggregations -> aggs")
+
+    reparada = {}
+    for clave, valor in consulta.items():
+        if clave not in CLAVES_RAIZ:
+            cambios.append(f"clave {clave} eliminada")
+            continue
+        reparada[clave] = valor
+
+    if "query" in reparada:
+        reparada["query"] = _reparar_clausula(reparada["query"], mapeo, cambios)
+    if "sort" in reparada:
+        reparada["sort"] = _reparar_orden(reparada["sort"], mapeo, cambios)
+        if not reparada["sort"]:
+            del reparada["sort"]
+
+    if "aggs" in reparada and isinstance(reparada["aggs"], dict):
+        reparada["aggs"] = {n: _reparar_agregacion(a, mapeo, cambios) for n, a in reparada["aggs"].items()}
+        # Con agregaciones no hacen falta documentos (el hotel concreto, si se pide, lo da top_hits)
+        if reparada.get("size") != 0:
+            cambios.append(f"size {reparada.get('size')!r} -> 0 (agregaciones)")
+            reparada["size"] = 0
+        if reparada.pop("sort", None) is not None:
+            cambios.append("sort eliminado (agregaciones)")
+        return reparada, cambios
+
+    tamano = _numero(reparada.get("size", TAMANO_POR_DEFECTO))
+    tamano = min(max(int(tamano), 0), TAMANO_MAXIMO) if tamano is not None else TAMANO_POR_DEFECTO
+    if reparada.get("size") != tamano:
+        cambios.append(f"size {reparada.get('size')!r} -> {tamano}")
+        reparada["size"] = tamano
+    return reparada, cambios
+
+
+def _validar_clausula(clausula, mapeo: dict, ruta: str, errores: list):
+    if not isinstance(clausula, dict) or len(clausula) != 1:
+        errores.append(f"{ruta}: debe ser un objeto con una sola cláusula")
+        return
+    tipo, cuerpo = next(iter(clausula.items()))
+    ruta = f"{ruta}.{tipo}"
+
+    if tipo == "match_all":
+        return
+    if tipo == "bool":
+        if not isinstance(cuerpo, dict):
+            errores.append(f"{ruta}: debe ser un objeto")
+            return
+        for clave, valor in cuerpo.items():
+            if clave in OCURRENCIAS_BOOL:
+                for i, hija in enumerate(valor if isinstance(valor, list) else [valor]):
+                    _validar_clausula(hija, mapeo, f"{ruta}.{clave}[{i}]", errores)
+            elif clave not in ("minimum_should_match", "boost"):
+                errores.append(f"{ruta}: clave desconocida {clave}")
+        return
+    if tipo == "geo_distance":
+        campos = [c for c in cuerpo if c not in ("distance", "distance_type", "validation_method", "_name")] if isinstance(cuerpo, dict) else []
+        if not isinstance(cuerpo, dict) or "distance" not in cuerpo or len(campos) != 1:
+            errores.append(f"{ruta}: necesita distance y un campo geo_point")
+        elif mapeo.get(campos[0]) != "geo_point":
+            errores.append(f"{ruta}: {campos[0]} no es un campo geo_point")
+        return
+    if tipo == "exists":
+        if not isinstance(cuerpo, dict) or cuerpo.get("field") not in mapeo:
+            errores.append(f"{ruta}: campo inexistente")
+        return
+    if tipo == "multi_match":
+        campos = cuerpo.get("fields", []) if isinstance(cuerpo, dict) else []
+        desconocidos = [c for c in campos if c.split("^")[0] not in mapeo]
+        if not isinstance(cuerpo, dict) or "query" not in cuerpo or desconocidos:
+            errores.append(f"{ruta}: necesita query y campos existentes")
+        return
+    if tipo not in ("match", "match_phrase", "term", "terms", "range"):
+        errores.append(f"{ruta}: cláusula no permitida")
+        return
+
+    if not isinstance(cuerpo, dict) or len(cuerpo) != 1:
+        errores.append(f"{ruta}: debe indicar un único campo")
+        return
+    campo, valor = next(iter(cuerpo.items()))
+    if campo not in mapeo:
+        errores.append(f"{ruta}: el campo {campo} no existe en el índice")
+        return
+    tipo_campo = mapeo[campo]
+    if tipo_campo == "geo_point":
+        errores.append(f"{ruta}: {campo} es geo_point, usa geo_distance")
+    elif tipo in ("term", "terms") and tipo_campo in TIPOS_TEXTO:
+        errores.append(f"{ruta}: {campo} es text, usa match en lugar de {tipo}")
+    elif tipo == "range":
+        if tipo_campo in TIPOS_TEXTO:
+            errores.append(f"{ruta}: no se puede usar range sobre {campo} (text)")
+        elif not isinstance(valor, dict) or not valor or set(valor) - OPERADORES_RANGO:
+            errores.append(f"{ruta}: operadores permitidos {sorted(OPERADORES_RANGO)}")
+        else:
+            for operador, limite in valor.items():
+                if operador != "format" and _valor_exacto(limite, tipo_campo) != limite:
+                    errores.append(f"{ruta}: valor {limite!r} no válido para {campo} ({tipo_campo})")
+    elif tipo == "term":
+        exacto = valor.get("value") if isinstance(valor, dict) else valor
+        if _valor_exacto(exacto, tipo_campo) != exacto:
+            errores.append(f"{ruta}: valor {exacto!r} no válido para {campo} ({tipo_campo})")
+    elif tipo == "terms" and not isinstance(valor, list):
+        errores.append(f"{ruta}: terms necesita una lista")
+
+
+def _validar_orden(orden, mapeo: dict, ruta: str, errores: list):
+    for criterio in orden if isinstance(orden, list) else [None]:
+        if not isinstance(criterio, dict) or len(criterio) != 1:
+            errores.append(f"{ruta}: cada criterio debe ser {{campo: orden}}")
+            continue
+        campo = next(iter(criterio))
+        if campo != "_score" and (campo not in mapeo or mapeo[campo] in TIPOS_TEXTO):
+            errores.append(f"{ruta}: no se puede ordenar por {campo}")
+
+
+def _validar_agregacion(nombre: str, agregacion, mapeo: dict, ruta: str, errores: list, anidada: bool = False):
+    ruta = f"{ruta}.{nombre}"
+    if not isinstance(agregacion, dict):
+        errores.append(f"{ruta}: debe ser un objeto")
+        return
+    tipos = [t for t in agregacion if t != "aggs"]
+    if len(tipos) != 1:
+        errores.append(f"{ruta}: debe tener un único tipo de agregación")
+        return
+    tipo = tipos[0]
+    cuerpo = agregacion[tipo]
+    ruta = f"{ruta}.{tipo}"
+    if not isinstance(cuerpo, dict):
+        errores.append(f"{ruta}: debe ser un objeto")
+        return
+    if "aggs" in agregacion and (tipo != "terms" or anidada or not isinstance(agregacion["aggs"], dict)):
+        errores.append(f"{ruta}: solo terms admite sub-agregaciones (min, max o avg)")
+    if tipo in METRICAS_AGREGACION:
+        if mapeo.get(cuerpo.get("field")) not in TIPOS_NUMERICOS:
+            errores.append(f"{ruta}: necesita un campo numérico")
+        return
+    if anidada:
+        errores.append(f"{ruta}: dentro de terms solo se admiten min, max o avg")
+    elif tipo == "terms":
+        campo = cuerpo.get("field")
+        if not isinstance(campo, str) or _campo_keyword(campo, mapeo) != campo:
+            keywords = sorted(c for c, t in mapeo.items() if t == "keyword")
+            errores.append(f"{ruta}: necesita un campo keyword ({', '.join(keywords)})" if keywords
+                           else f"{ruta}: el índice no tiene campos keyword, no se puede usar terms")
+        tamano = cuerpo.get("size", 10)
+        if not isinstance(tamano, int) or not 0 < tamano <= TAMANO_MAXIMO_TERMS:
+            errores.append(f"{ruta}: size debe estar entre 1 y {TAMANO_MAXIMO_TERMS}")
+        for hija, subagregacion in agregacion.get("aggs", {}).items():
+            _validar_agregacion(hija, subagregacion, mapeo, f"{ruta}.aggs", errores, True)
+    elif tipo == "top_hits":
+        tamano = cuerpo.get("size", 3)
+        if not isinstance(tamano, int) or not 0 < tamano <= TAMANO_MAXIMO_TOP_HITS:
+            errores.append(f"{ruta}: size debe estar entre 1 y {TAMANO_MAXIMO_TOP_HITS}")
+        _validar_orden(cuerpo.get("sort", []), mapeo, f"{ruta}.sort", errores)
+    else:
+        errores.append(f"{ruta}: agregación no permitida (min, max, avg, terms o top_hits)")
+
+
+def validar_consulta(consulta, mapeo: dict = None) -> list:
+    """Comprueba la consulta contra el mapping: campos, tipos y cláusulas permitidas. Devuelve la lista de errores."""
+    mapeo = mapeo or MAPEO
+    if not isinstance(consulta, dict):
+        return ["la consulta debe ser un objeto JSON"]
+    errores = [f"clave {clave} no permitida" for clave in consulta if clave not in CLAVES_RAIZ]
+    if "query" not in consulta:
+        errores.append("falta la clave query")
+    else:
+        _validar_clausula(consulta["query"], mapeo, "query", errores)
+    _validar_orden(consulta.get("sort", []), mapeo, "sort", errores)
+    if "aggs" in consulta:
+        if not isinstance(consulta["aggs"], dict) or not consulta["aggs"]:
+            errores.append("aggs: debe ser un objeto con al menos una agregación")
+        else:
+            for nombre, agregacion in consulta["aggs"].items():
+                _validar_agregacion(nombre, agregacion, mapeo, "aggs", errores)
+    tamano = consulta.get("size", TAMANO_POR_DEFECTO)
+    # size 0: solo el total y las agregaciones, sin documentos
+    if not isinstance(tamano, int) or isinstance(tamano, bool) or not 0 <= tamano <= TAMANO_MAXIMO:
+        errores.append(f"size debe ser un entero entre 0 y {TAMANO_MAXIMO}")
+    return errores
+
+
+def consulta_valida(texto: str, mapeo: dict = None):
+    """Extrae, repara y valida la consulta devuelta por el LLM. Devuelve (consulta, errores, cambios)."""
+    consulta = extraer_json(texto)
+    if consulta is None:
+        return None, ["la respuesta no contiene un objeto JSON"], []
+    consulta, cambios = reparar_consulta(consulta, mapeo)
+    return consulta, validar_consulta(consulta, mapeo), cambios
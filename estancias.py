@@ -0,0 +1,226 @@
+from datetime import date, timedelta
+
+from esquema_consulta import OCURRENCIAS_BOOL
+from normalizacion import noches
+
+# Una estancia es un range sobre fechaEntrada en contexto obligatorio (must o filter). Cada documento
+# es un hotel en una fecha, así que se busca noche a noche en un solo msearch y se quedan los
+# hoteles disponibles todas las noches, con su precio mínimo, máximo y total
+
+# Cada noche trae como mucho tamano hoteles: si alguna llena la página puede haber hoteles
+# disponibles todas las noches que no han salido en ninguna lista
+AVISO_INCOMPLETA = "Puede haber más hoteles disponibles todas esas noches que no aparecen en esta lista."
+# Tope de documentos por noche en la búsqueda que completa los hoteles que faltan alguna noche
+MAXIMO_COMPLETAR = 10000
+
+
+def _rango_fecha(clausula):
+    """Límites del range sobre fechaEntrada de una cláusula hoja, o None."""
+    if not isinstance(clausula, dict) or len(clausula) != 1 or not isinstance(clausula.get("range"), dict):
+        return None
+    cuerpo = clausula["range"]
+    if len(cuerpo) != 1 or next(iter(cuerpo)) != "fechaEntrada" or not isinstance(cuerpo["fechaEntrada"], dict):
+        return None
+    return cuerpo["fechaEntrada"]
+
+
+def _rangos(clausula, obligatoria: bool = True):
+    """(límites, obligatoria) de cada range sobre fechaEntrada de la query."""
+    limites = _rango_fecha(clausula)
+    if limites is not None:
+        return [(limites, obligatoria)]
+    if not isinstance(clausula, dict) or not isinstance(clausula.get("bool"), dict):
+        return []
+    encontrados = []
+    for ocurrencia in OCURRENCIAS_BOOL:
+        hijos = clausula["bool"].get(ocurrencia, [])
+        for hijo in hijos if isinstance(hijos, list) else [hijos]:
+            encontrados += _rangos(hijo, obligatoria and ocurrencia in ("must", "filter"))
+    return encontrados
+
+
+def _dia(valor, siguiente: bool = False) -> str:
+    dia = date.fromisoformat(str(valor)[:10])
+    return (dia + timedelta(days=1) if siguiente else dia).isoformat()
+
+
+def noches_estancia(consulta: dict, maximo: int) -> list:
+    """Noches (aaaa-mm-dd) de la estancia de la consulta, o [] si no hay una que repartir.
+
+    Hace falta un único range sobre fechaEntrada en contexto obligatorio y con los dos extremos:
+    gte la entrada y lt la salida (con gt y lte se ajustan un día). Con más de maximo noches la
+    consulta se busca tal cual.
+    """
+    rangos = _rangos(consulta.get("query", {}))
+    if len(rangos) != 1 or not rangos[0][1]:
+        return []
+    limites = rangos[0][0]
+    try:
+        entrada = _dia(limites["gte"]) if "gte" in limites else _dia(limites["gt"], siguiente=True)
+        salida = _dia(limites["lt"]) if "lt" in limites else _dia(limites["lte"], siguiente=True)
+    except (KeyError, ValueError):
+        return []
+    lista = noches(entrada, salida)
+    return lista if 0 < len(lista) <= maximo else []
+
+
+def consulta_noche(consulta: dict, noche: str) -> dict:
+    """La consulta con el range de la estancia sustituido por un term de esa noche."""
+    def sustituir(clausula):
+        if _rango_fecha(clausula) is not None:
+            return {"term": {"fechaEntrada": noche}}
+        if not isinstance(clausula, dict) or not isinstance(clausula.get("bool"), dict):
+            return clausula
+        cuerpo = {}
+        for clave, valor in clausula["bool"].items():
+            if clave in OCURRENCIAS_BOOL:
+                valor = [sustituir(h) for h in valor] if isinstance(valor, list) else sustituir(valor)
+            cuerpo[clave] = valor
+        return {"bool": cuerpo}
+    return {**consulta, "query": sustituir(consulta.get("query", {}))}
+
+
+def busquedas_msearch(indice: str, consulta: dict, lista_noches: list, tamano: int, campos: list) -> list:
+    """Cuerpo de msearch con una búsqueda por noche; cada una trae hasta tamano hoteles para cruzarlos."""
+    busquedas = []
+    for noche in lista_noches:
+        cuerpo = {clave: valor for clave, valor in consulta_noche(consulta, noche).items()
+                  if clave not in ("size", "from", "track_total_hits")}
+        busquedas += [{"index": indice}, {**cuerpo, "size": tamano, "_source": campos}]
+    return busquedas
+
+
+def pagina_llena(respuestas: list, tamano: int) -> bool:
+    """Si alguna noche ha devuelto tamano hoteles (y por tanto puede haber más)."""
+    return any(len(r.get("hits", {}).get("hits", [])) >= tamano for r in respuestas if "error" not in r)
+
+
+def busquedas_completar(indice: str, consulta: dict, lista_noches: list, respuestas: list, tamano: int,
+                        campo_hotel: str, campos: list) -> list:
+    """Segundo msearch para los hoteles que han salido unas noches y otras no.
+
+    Un hotel disponible todas las noches puede quedar fuera de la página de alguna; cada noche se
+    vuelve a buscar restringida a esos hoteles (terms sobre campo_hotel) para saber si lo está. []
+    si ninguna noche ha llenado la página o el índice no tiene un campo keyword del hotel.
+    """
+    if not campo_hotel or not pagina_llena(respuestas, tamano):
+        return []
+    vistos = {}
+    for noche, respuesta in zip(lista_noches, respuestas):
+        for hit in respuesta.get("hits", {}).get("hits", []):
+            fuente = hit.get("_source", {})
+            vistos.setdefault(_clave_hotel(fuente), (fuente.get("nombre"), set()))[1].add(noche)
+    nombres = sorted({nombre for nombre, noches in vistos.values() if nombre and len(noches) < len(lista_noches)})
+    if not nombres:
+        return []
+    # Un nombre puede repetirse en otras localidades: se deja margen y se cruza luego por hotel
+    tamano_completar = min(MAXIMO_COMPLETAR, 10 * len(nombres))
+    busquedas = []
+    for noche in lista_noches:
+        cuerpo = {clave: valor for clave, valor in consulta_noche(consulta, noche).items()
+                  if clave not in ("size", "from", "track_total_hits")}
+        cuerpo["query"] = {"bool": {"must": [cuerpo.get("query", {"match_all": {}})],
+                                    "filter": [{"terms": {campo_hotel: nombres}}]}}
+        busquedas += [{"index": indice}, {**cuerpo, "size": tamano_completar, "_source": campos}]
+    return busquedas
+
+
+def unir_respuestas(respuestas: list, extra: list) -> list:
+    """Añade a la respuesta de cada noche los hits del segundo msearch que no traía ya."""
+    unidas = []
+    for respuesta, adicional in zip(respuestas, extra):
+        if "error" in adicional:
+            raise RuntimeError(f"Búsqueda de hoteles pendientes fallida: {adicional['error']}")
+        hits = respuesta.get("hits", {}).get("hits", [])
+        vistos = {hit.get("_id") for hit in hits}
+        nuevos = [hit for hit in adicional.get("hits", {}).get("hits", []) if hit.get("_id") not in vistos]
+        unidas.append({**respuesta, "hits": {**respuesta.get("hits", {}), "hits": hits + nuevos}})
+    return unidas
+
+
+def lista_incompleta(resultados) -> bool:
+    """Si los resultados de una estancia pueden no incluir todos los hoteles disponibles."""
+    return resultados.get("hits", {}).get("total", {}).get("relation") == "gte"
+
+
+def _clave_hotel(fuente: dict) -> tuple:
+    return tuple(str(fuente.get(campo, "")).strip().lower() for campo in ("nombre", "localidad", "provincia"))
+
+
+def _criterio_orden(consulta: dict) -> tuple:
+    """(campo, signo) del primer criterio de sort de la consulta (por defecto, _score descendente)."""
+    orden = consulta.get("sort")
+    criterio = (orden if isinstance(orden, list) else [orden])[0] if orden else "_score"
+    campo, sentido = (criterio, "asc") if isinstance(criterio, str) else next(iter(criterio.items()))
+    if isinstance(sentido, dict):
+        sentido = sentido.get("order", "asc")
+    if campo == "_score":
+        sentido = "desc"
+    return campo, -1 if sentido == "desc" else 1
+
+
+def _numero(valor, signo: int) -> tuple:
+    return (not isinstance(valor, (int, float)), signo * valor if isinstance(valor, (int, float)) else 0)
+
+
+def _clave_orden(consulta: dict):
+    """Función de orden de los hoteles fusionados. Un campo que no está en _source (_geo_distance,
+    un script...) se ordena por el primer valor de sort que devolvió Elasticsearch."""
+    campo, signo = _criterio_orden(consulta)
+
+    def clave(hit):
+        if campo == "_score":
+            valor = hit["_score"]
+        elif campo == "precio" or campo in hit["_source"]:
+            valor = hit["_source"].get("precio_total" if campo == "precio" else campo)
+        else:
+            valor = (hit.get("sort") or [None])[0]
+        return _numero(valor, signo)
+    return clave
+
+
+def fusionar_por_hotel(consulta: dict, lista_noches: list, respuestas: list, completa: bool = True) -> dict:
+    """Resultados con la forma de una búsqueda: un hit por hotel disponible todas las noches.
+
+    Cada hotel lleva en _source precio_min, precio_max, precio_total y noches, y como _score la
+    media de sus puntuaciones. Se ordenan como pedía la consulta (por precio, el total de la
+    estancia) y se devuelven como mucho size. Con completa False (alguna noche llenó su página)
+    el total va con relation "gte".
+    """
+    hoteles = {}
+    _, signo = _criterio_orden(consulta)
+    for noche, respuesta in zip(lista_noches, respuestas):
+        if "error" in respuesta:
+            raise RuntimeError(f"Búsqueda de la noche {noche} fallida: {respuesta['error']}")
+        for hit in respuesta.get("hits", {}).get("hits", []):
+            fuente = hit.get("_source", {})
+            hotel = hoteles.setdefault(_clave_hotel(fuente),
+                                       {"fuente": fuente, "precios": {}, "puntuaciones": [], "orden": None})
+            hotel["precios"].setdefault(noche, fuente.get("precio"))
+            hotel["puntuaciones"].append(hit.get("_score") or 0)
+            # De los valores de sort de cada noche se guarda el mejor (el menor si el orden es ascendente)
+            if hit.get("sort") and (hotel["orden"] is None
+                                    or _numero(hit["sort"][0], signo) < _numero(hotel["orden"][0], signo)):
+                hotel["orden"] = hit["sort"]
+
+    hits = []
+    for hotel in hoteles.values():
+        if len(hotel["precios"]) != len(lista_noches):
+            continue
+        precios = [p for p in hotel["precios"].values() if isinstance(p, (int, float))]
+        completos = len(precios) == len(lista_noches)
+        fuente = {**hotel["fuente"], "noches": len(lista_noches),
+                  "precio_min": min(precios) if precios else None,
+                  "precio_max": max(precios) if precios else None,
+                  "precio_total": sum(precios) if completos else None}
+        # Sin _seq_no: la caché de respuestas usa el prompt, que ya incluye los precios de todas las noches
+        hit = {"_source": fuente, "_score": sum(hotel["puntuaciones"]) / len(hotel["puntuaciones"])}
+        if hotel["orden"] is not None:
+            hit["sort"] = hotel["orden"]
+        hits.append(hit)
+    hits.sort(key=_clave_orden(consulta))
+    return {
+        "took": max((r.get("took", 0) for r in respuestas), default=0),
+        "hits": {"total": {"value": len(hits), "relation": "eq" if completa else "gte"},
+                 "hits": hits[:consulta.get("size", 10)]},
+    }
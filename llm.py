@@ -1,10 +1,27 @@
-from datetime import datetime 
+from agregaciones import campo_hotel, cuerpo_agregaciones, es_agregacion, respuesta_agregaciones, sin_resultados
+from arranque import perfil
+import argparse
+import concurrent.futures
 import logging
 import os
+import random
 import json
-import re
-from elasticsearch import Elasticsearch
+import threading
+import time
 from dotenv import load_dotenv
+from backend_llm import BackendOllama, BackendOpenRouter, ClienteLLM, ErrorLLM, consumir_stream
+from cache import CacheConsultas, CacheResultados, CacheLRU, clave_respuesta, version_indice
+from parser_reglas import parsear_pregunta
+from contexto_prompt import CAMPOS_PROMPT, construir_contexto, construir_prompt_fusion, dividir_en_bloques, respuesta_precalculada
+from estancias import (AVISO_INCOMPLETA, busquedas_completar, busquedas_msearch as busquedas_estancia, fusionar_por_hotel,
+                       lista_incompleta, noches_estancia, pagina_llena, unir_respuestas)
+from esquema_consulta import MAPEO, PROMPT_CORRECCION, TAMANO_MAXIMO, TAMANO_POR_DEFECTO, consulta_valida, esquema_json, extraer_json, mapeo_desde_indice, mensajes_consulta, validar_consulta
+from metricas import etapa, iniciar_logging, metricas, servir_metricas
+from nomenclator import Nomenclator, aplicar_cercania
+from ejemplos import SelectorEjemplos
+from optimizador_consulta import optimizar_consulta
+from paginacion import Paginador
+from relajacion import busquedas_msearch, nota_relajacion, primera_con_resultados, variantes_relajadas
 
 # Cargar entorno
 load_dotenv()
@@ -17,32 +34,219 @@ ELASTICSEARCH_PASSWORD = os.getenv('ELASTICSEARCH_PASSWORD')
 ES_INDEX = os.getenv('ES_INDEX')
 OUT_DIRECTORY = os.getenv('OUT_DIRECTORY')
 
+# Caché de consultas generadas (memoria y, opcionalmente, disco en OUT_DIRECTORY)
+CACHE_CONSULTAS = os.getenv('CACHE_CONSULTAS', 'yes').lower() == 'yes'
+CACHE_DISCO = os.getenv('CACHE_DISCO', 'no').lower() == 'yes'
+CACHE_TTL = int(os.getenv('CACHE_TTL', '86400'))
+CACHE_CAPACIDAD = int(os.getenv('CACHE_CAPACIDAD', '1024'))
+
+# Caché de resultados de Elasticsearch, invalidada cuando cambian las estadísticas del índice
+CACHE_RESULTADOS = os.getenv('CACHE_RESULTADOS', 'yes').lower() == 'yes'
+CACHE_RESULTADOS_TTL = int(os.getenv('CACHE_RESULTADOS_TTL', '300'))
+CACHE_RESULTADOS_CAPACIDAD = int(os.getenv('CACHE_RESULTADOS_CAPACIDAD', '512'))
+
+# Caché de respuestas finales indexada por los documentos devueltos (lru, lfu o fifo)
+CACHE_RESPUESTAS = os.getenv('CACHE_RESPUESTAS', 'yes').lower() == 'yes'
+CACHE_RESPUESTAS_TTL = int(os.getenv('CACHE_RESPUESTAS_TTL', '86400'))
+CACHE_RESPUESTAS_CAPACIDAD = int(os.getenv('CACHE_RESPUESTAS_CAPACIDAD', '256'))
+CACHE_RESPUESTAS_POLITICA = os.getenv('CACHE_RESPUESTAS_POLITICA', 'lru').lower()
+
+# Mostrar la respuesta final a medida que llegan los tokens
+STREAM_RESPUESTA = os.getenv('STREAM_RESPUESTA', 'yes').lower() == 'yes'
+
+# Tamaño máximo aproximado (en tokens) del prompt de respuesta; 0 para no limitarlo
+PRESUPUESTO_TOKENS = int(os.getenv('PRESUPUESTO_TOKENS', '2000'))
+
+# Respuesta por bloques: con más de RESPUESTA_BLOQUE hoteles se describen en paralelo en bloques de ese
+# tamaño y una llamada final corta escribe la introducción (0 para usar siempre un único prompt)
+RESPUESTA_BLOQUE = int(os.getenv('RESPUESTA_BLOQUE', '0'))
+RESPUESTA_BLOQUES_PARALELOS = int(os.getenv('RESPUESTA_BLOQUES_PARALELOS', '4'))
+RESPUESTA_TOKENS_FUSION = int(os.getenv('RESPUESTA_TOKENS_FUSION', '200'))
+
+# Responder sin LLM uniendo los resúmenes precalculados cuando todos los hoteles los tienen
+RESPUESTA_PRECALCULADA = os.getenv('RESPUESTA_PRECALCULADA', 'no').lower() == 'yes'
+
+# Parser de reglas que evita llamar al LLM en las preguntas con forma conocida
+PARSER_REGLAS = os.getenv('PARSER_REGLAS', 'yes').lower() == 'yes'
+
+# Salida estructurada (JSON schema) al generar la consulta y reintentos si no supera la validación
+SALIDA_ESTRUCTURADA = os.getenv('SALIDA_ESTRUCTURADA', 'yes').lower() == 'yes'
+REINTENTOS_CONSULTA = int(os.getenv('REINTENTOS_CONSULTA', '1'))
+
+# Resultados por páginas (point-in-time + search_after): se describen TAMANO_PAGINA hoteles cada vez
+# y, si la consulta encuentra más, el resto se pide con "ver más". Las consultas de un solo hotel
+# (size 1) no se paginan
+PAGINACION = os.getenv('PAGINACION', 'yes').lower() == 'yes'
+TAMANO_PAGINA = int(os.getenv('TAMANO_PAGINA', '10'))
+
+# Nomenclátor de localidades y lugares: "cerca de X" / "a menos de N km de X" se convierte en un filtro
+# geo_distance sin pasar por el LLM. NOMENCLATOR_FICHERO añade lugares propios ({"nombre": [lat, lon]})
+NOMENCLATOR = os.getenv('NOMENCLATOR', 'yes').lower() == 'yes'
+NOMENCLATOR_FICHERO = os.getenv('NOMENCLATOR_FICHERO')
+
+# Ejemplos few-shot dinámicos: en cada prompt van solo los EJEMPLOS_K más parecidos a la pregunta,
+# elegidos con BM25 entre los de EJEMPLOS_FICHERO (JSONL {"pregunta", "consulta"})
+EJEMPLOS_DINAMICOS = os.getenv('EJEMPLOS_DINAMICOS', 'yes').lower() == 'yes'
+EJEMPLOS_FICHERO = os.getenv('EJEMPLOS_FICHERO', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ejemplos_consultas.jsonl'))
+EJEMPLOS_K = int(os.getenv('EJEMPLOS_K', '3'))
+
+# Reescritura de la consulta antes de buscar: las restricciones pasan a contexto filter (cacheable, sin
+# puntuación). OPTIMIZAR_COMPARAR es la fracción de consultas en las que se ejecutan las dos versiones
+# para comparar su took (0 = nunca)
+OPTIMIZAR_CONSULTA = os.getenv('OPTIMIZAR_CONSULTA', 'yes').lower() == 'yes'
+OPTIMIZAR_COMPARAR = float(os.getenv('OPTIMIZAR_COMPARAR', '0'))
+
+# Si la consulta no encuentra nada se prueba relajada (sin fecha, sin todos los servicios, en toda la
+# provincia, con fuzzy) en un solo msearch, en lugar de pedir al usuario que reformule la pregunta
+RELAJAR_CONSULTA = os.getenv('RELAJAR_CONSULTA', 'yes').lower() == 'yes'
+
+# Las preguntas de cifras (precio medio, cuántos hoteles, el más barato...) se responden con size 0 y
+# agregaciones, y la respuesta sale de una plantilla en lugar de resumir documentos con el LLM
+AGREGACIONES = os.getenv('AGREGACIONES', 'yes').lower() == 'yes'
+
+# Estancias ("del 1 al 7 de junio"): una búsqueda por noche en un solo msearch y los hoteles
+# disponibles todas las noches. ESTANCIA_MAX_NOCHES limita las búsquedas por pregunta y
+# ESTANCIA_HITS es cuántos hoteles se piden por noche para cruzarlos
+ESTANCIAS = os.getenv('ESTANCIAS', 'yes').lower() == 'yes'
+ESTANCIA_MAX_NOCHES = int(os.getenv('ESTANCIA_MAX_NOCHES', '14'))
+ESTANCIA_HITS = int(os.getenv('ESTANCIA_HITS', '100'))
+
+# Conexiones HTTP simultáneas por nodo de Elasticsearch
+ES_CONEXIONES = int(os.getenv('ES_CONEXIONES', '10'))
+
+# Logs en formato JSON (una línea por registro) y puerto del endpoint /metrics (0 para desactivarlo)
+LOG_JSON = os.getenv('LOG_JSON', 'no').lower() == 'yes'
+METRICAS_PUERTO = int(os.getenv('METRICAS_PUERTO', '0'))
+
 # Ruta y modelo LLM
 USE_OPEN_ROUTER = os.getenv('USE_OPEN_ROUTER', 'no').lower() == 'yes'
 
-if USE_OPEN_ROUTER:
-    from openai import OpenAI
-    OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
-    OPENROUTER_API_BASE = os.getenv('OPENROUTER_API_BASE')
-    OPENROUTER_SITE_URL = os.getenv('OPENROUTER_SITE_URL')
-    OPENROUTER_MODEL = os.getenv('OPENROUTER_MODEL')
-
-    openai_client = OpenAI(
-        base_url=OPENROUTER_API_BASE,
-        api_key=OPENROUTER_API_KEY,
-        default_headers={"HTTP-Referer": OPENROUTER_SITE_URL}
-    )
-else:
-    import ollama
-    import requests
-    OLLAMA_MODEL = os.getenv('OLLAMA_MODEL')
-
-# Elasticsearch connection
-es = Elasticsearch(
-    [f"http://{ELASTICSEARCH_HOST}:{ELASTICSEARCH_PORT}"],
-    basic_auth=(ELASTICSEARCH_USERNAME, ELASTICSEARCH_PASSWORD)
-)
-es.info()
+OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
+OPENROUTER_API_BASE = os.getenv('OPENROUTER_API_BASE')
+OPENROUTER_SITE_URL = os.getenv('OPENROUTER_SITE_URL')
+OPENROUTER_MODEL = os.getenv('OPENROUTER_MODEL')
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL')
+
+# Caché del prefijo del prompt: cache_control en los modelos de OpenRouter que lo necesitan y
+# keep_alive de Ollama para que el modelo (y su caché KV) no se descargue entre preguntas
+PROMPT_CACHE = os.getenv('PROMPT_CACHE', 'yes').lower() == 'yes'
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+
+# Llamadas al LLM: plazo total por llamada, reintentos ante errores transitorios, petición de
+# respaldo si no hay respuesta en LLM_HEDGE_SEGUNDOS (0 la desactiva) y paso al otro backend
+LLM_PLAZO = float(os.getenv('LLM_PLAZO', '60'))
+LLM_REINTENTOS = int(os.getenv('LLM_REINTENTOS', '3'))
+LLM_HEDGE_SEGUNDOS = float(os.getenv('LLM_HEDGE_SEGUNDOS', '0'))
+LLM_FAILOVER = os.getenv('LLM_FAILOVER', 'no').lower() == 'yes'
+LLM_CONEXIONES = int(os.getenv('LLM_CONEXIONES', '10'))
+
+# Los clientes se crean la primera vez que se usan (o en segundo plano, ver iniciar_en_segundo_plano)
+_es = None
+_cliente_llm = None
+_lock_es = threading.Lock()
+_lock_llm = threading.Lock()
+
+def obtener_es():
+    global _es
+    with _lock_es:
+        if _es is None:
+            with perfil.medir("import elasticsearch"):
+                from elasticsearch import Elasticsearch
+            # Elasticsearch connection (un pool de conexiones por nodo, compartido entre hilos)
+            with perfil.medir("cliente Elasticsearch"):
+                _es = Elasticsearch(
+                    [f"http://{ELASTICSEARCH_HOST}:{ELASTICSEARCH_PORT}"],
+                    basic_auth=(ELASTICSEARCH_USERNAME, ELASTICSEARCH_PASSWORD),
+                    connections_per_node=ES_CONEXIONES
+                )
+    return _es
+
+def crear_backends() -> list:
+    """Backend principal según USE_OPEN_ROUTER y, con LLM_FAILOVER, el otro si está configurado."""
+    openrouter = ollama = None
+    if OPENROUTER_MODEL and OPENROUTER_API_BASE:
+        openrouter = BackendOpenRouter(OPENROUTER_MODEL, OPENROUTER_API_BASE, OPENROUTER_API_KEY, OPENROUTER_SITE_URL,
+                                       conexiones=LLM_CONEXIONES, timeout=LLM_PLAZO, cachear_prefijo=PROMPT_CACHE)
+    if OLLAMA_MODEL:
+        ollama = BackendOllama(OLLAMA_MODEL, conexiones=LLM_CONEXIONES, timeout=LLM_PLAZO,
+                               keep_alive=OLLAMA_KEEP_ALIVE or None)
+    backends = [openrouter, ollama] if USE_OPEN_ROUTER else [ollama, openrouter]
+    if not LLM_FAILOVER:
+        backends = backends[:1]
+    return [b for b in backends if b is not None]
+
+def obtener_cliente_llm() -> ClienteLLM:
+    """Cliente LLM compartido (OpenRouter u Ollama según USE_OPEN_ROUTER, con failover opcional)."""
+    global _cliente_llm
+    with _lock_llm:
+        if _cliente_llm is None:
+            _cliente_llm = ClienteLLM(crear_backends(), reintentos=LLM_REINTENTOS, plazo=LLM_PLAZO,
+                                      hedge_segundos=LLM_HEDGE_SEGUNDOS)
+    return _cliente_llm
+
+def comprobar_es():
+    cliente = obtener_es()
+    with perfil.medir("es.info()"):
+        cliente.info()
+    obtener_mapeo()
+    if NOMENCLATOR:
+        obtener_nomenclator()
+
+_mapeo = None
+
+def obtener_mapeo() -> dict:
+    """Campos y tipos del índice leídos una vez de _mapping; si no se puede, los del esquema del README."""
+    global _mapeo
+    if _mapeo is None:
+        try:
+            _mapeo = mapeo_desde_indice(obtener_es().indices.get_mapping(index=ES_INDEX)) or MAPEO
+        except Exception as e:
+            logging.warning(f"No se ha podido leer el mapping de {ES_INDEX}, se usa el del README: {e}")
+            _mapeo = MAPEO
+    return _mapeo
+
+_nomenclator = None
+_lock_nomenclator = threading.Lock()
+
+def obtener_nomenclator() -> Nomenclator:
+    """Lugares conocidos más el centroide de cada localidad y provincia del índice, calculado una vez."""
+    global _nomenclator
+    with _lock_nomenclator:
+        if _nomenclator is None:
+            nomenclator = Nomenclator()
+            if NOMENCLATOR_FICHERO:
+                nomenclator.cargar_fichero(NOMENCLATOR_FICHERO)
+            try:
+                nomenclator.cargar_desde_indice(obtener_es(), ES_INDEX)
+            except Exception as e:
+                logging.warning(f"No se han podido leer las localidades de {ES_INDEX}, solo se usan los lugares conocidos: {e}")
+            _nomenclator = nomenclator
+    return _nomenclator
+
+def calentar_modelo():
+    """Hace una llamada mínima al LLM para que el modelo quede cargado antes de la primera pregunta.
+
+    En Ollama la llamada lleva el prefijo fijo del prompt de consultas, que queda ya en la caché KV.
+    """
+    cliente = obtener_cliente_llm()
+    with perfil.medir("calentamiento del modelo"):
+        cliente.calentar(mensajes_generar_consulta(""))
+
+def iniciar_en_segundo_plano() -> list:
+    """Comprueba Elasticsearch y precalienta el modelo en hilos aparte mientras el usuario escribe."""
+    def ejecutar(nombre, funcion):
+        try:
+            funcion()
+        except Exception as e:
+            logging.warning(f"Arranque en segundo plano ({nombre}) fallido: {e}")
+
+    hilos = [
+        threading.Thread(target=ejecutar, args=("Elasticsearch", comprobar_es), name="arranque-es", daemon=True),
+        threading.Thread(target=ejecutar, args=("LLM", calentar_modelo), name="arranque-llm", daemon=True),
+    ]
+    for hilo in hilos:
+        hilo.start()
+    return hilos
 
 FEW_SHOT_PROMPT = """
 Eres un experto en Elasticsearch. Dado el siguiente esquema de indice de hoteles, genera SOLO la consulta JSON valida para buscar detalles del hotel solicitado. No expliques nada ni pregunges, solo genera la consulta.
@@ -56,6 +260,13 @@ Esquema:
 - descripcion: text
 - precio: integer
 - fechaEntrada: date (yyyy-MM-dd)
+- opinion: float
+- comentarios: integer
+(nombre, provincia, localidad y servicios tienen además un subcampo .keyword)
+
+Si la pregunta pide una cifra (precio medio, mínimo o máximo, cuántos hoteles, los servicios más frecuentes o el hotel más barato, caro o mejor valorado), usa "size": 0 y "aggs": min, max o avg sobre precio, opinion o comentarios; terms sobre servicios.keyword, localidad.keyword o provincia.keyword; top_hits con sort para el hotel concreto. Para contar hoteles basta con "size": 0.
+
+Si la pregunta es para una estancia de varias noches ("del 1 al 7 de junio de 2025"), usa un range sobre fechaEntrada con "gte" el día de entrada y "lt" el de salida: { "range": { "fechaEntrada": { "gte": "2025-06-01", "lt": "2025-06-07" } } }.
 
 Ejemplo 1:
 Pregunta: "Muustrame hoteles en Aguadulce con piscina y parking, ordenados por precio ascendente para el dia 01/06/2025."
@@ -120,156 +331,669 @@ Respuesta JSON:
       "provincia": "Huelva"
     }
   },
-  "sort": [
-    { "precio": "asc" }
-  ],
-  "size": 1
+  "size": 0,
+  "aggs": {
+    "hotel": { "top_hits": { "size": 1, "sort": [ { "precio": "asc" } ] } }
+  }
 }
 
 Ejemplo 5:
-Pregunta: "¿Cual es el hotel mas caro de Huelva?"
+Pregunta: "¿Cual es el precio medio de los hoteles en Malaga?"
 Respuesta JSON:
 {
   "query": {
     "match": {
-      "localidad": "Huelva"
+      "localidad": "Malaga"
     }
   },
-  "sort": [
-    { "precio": "desc" }
-  ],
-  "size": 1
+  "size": 0,
+  "aggs": {
+    "precio_avg": { "avg": { "field": "precio" } }
+  }
 }
 
 Ahora, genera SOLO la consulta JSON para esta pregunta:
 "{pregunta}"
 """
 
-def configurar_logging():
-    # Ruta a fichero logging
-    log_filename = f"chatbot_{datetime.now().strftime('%Y%m%d')}.log"
-    full_log_path = os.path.join(OUT_DIRECTORY, log_filename)
+selector_ejemplos = None
+if EJEMPLOS_DINAMICOS:
+    try:
+        selector_ejemplos = SelectorEjemplos.desde_fichero(EJEMPLOS_FICHERO)
+    except OSError as e:
+        logging.warning(f"No se han podido leer los ejemplos de {EJEMPLOS_FICHERO}, se usan los del prompt: {e}")
 
-    #Crea el directorio de salida en caso de que no exista
-    if not os.path.exists(OUT_DIRECTORY):
-        os.makedirs(OUT_DIRECTORY)
+def mensajes_generar_consulta(pregunta: str) -> list:
+    """Mensajes de la llamada que genera la consulta: prefijo fijo y, con EJEMPLOS_DINAMICOS, solo los ejemplos más parecidos."""
+    if selector_ejemplos is not None:
+        return selector_ejemplos.mensajes(FEW_SHOT_PROMPT, pregunta, EJEMPLOS_K)
+    return mensajes_consulta(FEW_SHOT_PROMPT, pregunta)
 
-    write_permission = False
-    try:
-        # Intenta abrir el fichero en modo append para comprobar los permisos de escritura
-        # y se asegura de que el manejador del fichero se cierre inmediatamente después de la comprobación.
-        with open(full_log_path, 'a') as f:
-            pass
-        write_permission = True
-    except IOError as e:
-        write_permission = False
-        print(f"Warning: No se puede escribir en {full_log_path}. Revise los permisos de escritura. Error: {e}")
-
-    # Configuración básica del logging
-    logging.basicConfig(
-        filename=full_log_path,  # Nombre del archivo de log (corrección aquí)
-        level=logging.INFO,      # Nivel mínimo de mensajes que se guardarán
-        format='%(asctime)s - CHATBOT - %(levelname)s - %(message)s'  # Formato del mensaje
-    )
+cache_consultas = CacheConsultas(
+    # Los ejemplos forman parte del prompt: si cambian, las consultas guardadas dejan de valer
+    FEW_SHOT_PROMPT + (f"\nejemplos={selector_ejemplos.huella()};k={EJEMPLOS_K}" if selector_ejemplos else ""),
+    modelo=OPENROUTER_MODEL if USE_OPEN_ROUTER else OLLAMA_MODEL,
+    capacidad=CACHE_CAPACIDAD,
+    ttl=CACHE_TTL,
+    directorio=OUT_DIRECTORY if CACHE_DISCO else None
+) if CACHE_CONSULTAS else None
+
+cache_resultados = CacheResultados(
+    capacidad=CACHE_RESULTADOS_CAPACIDAD,
+    ttl=CACHE_RESULTADOS_TTL
+) if CACHE_RESULTADOS else None
+
+cache_respuestas = CacheLRU(
+    capacidad=CACHE_RESPUESTAS_CAPACIDAD,
+    ttl=CACHE_RESPUESTAS_TTL,
+    politica=CACHE_RESPUESTAS_POLITICA
+) if CACHE_RESPUESTAS else None
+
+def configurar_logging():
+    iniciar_logging(OUT_DIRECTORY, LOG_JSON)
+    if METRICAS_PUERTO:
+        servir_metricas(METRICAS_PUERTO)
 
 def extraer_json_valido(texto):
-    try:
-        match = re.search(r'\{.*\}', texto, re.DOTALL)
-        if not match:
-            raise ValueError("No se encontri bloque JSON.")
-        return json.loads(match.group())
-    except json.JSONDecodeError as e:
-        print(" Error al parsear JSON:", e)
+    consulta = extraer_json(texto)
+    if consulta is None:
+        print(" Error al parsear JSON: no se encontró un objeto JSON válido.")
         print("Respuesta raw:\n", texto)
-        return None
+    return consulta
+
+def esquema_consulta() -> dict:
+    """JSON schema para la salida estructurada de la llamada que genera la consulta (None si está desactivada)."""
+    return esquema_json(obtener_mapeo()) if SALIDA_ESTRUCTURADA else None
+
+def extraer_cercania(pregunta: str):
+    """"cerca de X" con X en el nomenclátor (ver Nomenclator.extraer_cercania), o None."""
+    return obtener_nomenclator().extraer_cercania(pregunta) if NOMENCLATOR else None
+
+def consulta_sin_llm(pregunta: str, cercania: dict = None):
+    """Intenta obtener la consulta con el parser de reglas o desde la caché, sin llamar al LLM."""
+    if PARSER_REGLAS:
+        # Con el nomenclátor la localidad también se reconoce escrita en minúsculas
+        es_localidad = obtener_nomenclator().es_localidad if NOMENCLATOR else None
+        if cercania:
+            consulta = parsear_pregunta(cercania["resto"], ubicacion_opcional=True, agregaciones=AGREGACIONES,
+                                        es_localidad=es_localidad)
+            consulta = consulta and aplicar_cercania(consulta, cercania)
+        else:
+            consulta = parsear_pregunta(pregunta, agregaciones=AGREGACIONES, es_localidad=es_localidad)
+        if consulta is not None and "aggs" in consulta and validar_consulta(consulta, obtener_mapeo()):
+            # terms sobre un subcampo .keyword que este índice no tiene: la consulta la genera el LLM
+            consulta = None
+        if consulta is not None:
+            logging.info(f"Consulta por reglas: {json.dumps(consulta, separators=(',', ':'))}")
+            return consulta
+    if cache_consultas:
+        consulta = cache_consultas.obtener(pregunta)
+        if consulta is not None:
+            logging.info(f"Consulta desde caché: {json.dumps(consulta, separators=(',', ':'))}")
+            return consulta
+    return None
+
+# Las funciones siguientes deciden sin hacer E/S de red: las comparten este módulo y el lote asíncrono
+# (llm_batch.py), que solo cambia cómo se llama al LLM y a Elasticsearch
+
+def texto_para_llm(pregunta: str, cercania: dict = None) -> str:
+    # Las coordenadas no pasan por el LLM: genera la consulta sin la parte "cerca de X" y el filtro se añade después
+    return cercania["resto"] if cercania else pregunta
+
+def revisar_consulta(contenido: str, cercania: dict = None):
+    """Valida (y repara) la consulta que ha devuelto el LLM y le añade el filtro de cercanía.
+
+    Devuelve (consulta, errores, cambios); con errores la consulta es None.
+    """
+    consulta, errores, cambios = consulta_valida(contenido, obtener_mapeo())
+    if errores:
+        return None, errores, cambios
+    return (aplicar_cercania(consulta, cercania) if cercania else consulta), [], cambios
+
+def mensajes_correccion(contenido: str, errores: list) -> list:
+    """Mensajes que se añaden a la conversación para que el LLM corrija una consulta no válida."""
+    return [
+        {"role": "assistant", "content": contenido or ""},
+        {"role": "user", "content": PROMPT_CORRECCION.format(errores="\n".join(f"- {e}" for e in errores))},
+    ]
+
+def guardar_consulta(pregunta: str, consulta: dict):
+    if cache_consultas:
+        cache_consultas.guardar(pregunta, consulta)
 
 def generar_consulta_llm(pregunta: str) -> dict:
-    prompt = FEW_SHOT_PROMPT.replace("{pregunta}", pregunta)
-
-    if USE_OPEN_ROUTER:
-        respuesta = openai_client.chat.completions.create(
-            model=OPENROUTER_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            timeout=60
-        )
-        contenido = respuesta.choices[0].message.content
-    else:
-        try:
-            respuesta = ollama.chat(
-                model=OLLAMA_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                options={"temperature": 0.1},
-            )
-            contenido = respuesta["message"]["content"]
-        except requests.exceptions.RequestException as e:
-            print(f" Error al llamar a Ollama: {e}")
+    with etapa("generar_consulta") as datos:
+        cercania = extraer_cercania(pregunta)
+        if cercania:
+            datos["cerca_de"] = cercania["lugar"]
+        consulta = consulta_sin_llm(pregunta, cercania)
+        if consulta is not None:
+            datos["origen"] = "sin_llm"
+            return json.dumps(consulta, separators=(',', ':'))
+
+        datos["origen"] = "llm"
+        mensajes = mensajes_generar_consulta(texto_para_llm(pregunta, cercania))
+        esquema = esquema_consulta()
+        # Un intento más por cada reintento: los errores de validación se devuelven al modelo para que los corrija
+        for intento in range(REINTENTOS_CONSULTA + 1):
+            datos["intentos"] = intento + 1
+            try:
+                respuesta = obtener_cliente_llm().chat(mensajes, esquema)
+            except ErrorLLM as e:
+                print(f" Error al llamar al modelo: {e}")
+                datos["error"] = str(e)
+                return None
+            contenido = respuesta["contenido"]
+            datos["backend"] = respuesta["backend"]
+            for clave, valor in respuesta["uso"].items():
+                datos[clave] = datos.get(clave, 0) + (valor or 0)
+
+            consulta, errores, cambios = revisar_consulta(contenido, cercania)
+            if cambios:
+                datos["reparaciones"] = datos.get("reparaciones", []) + cambios
+                logging.info(f"Consulta reparada: {cambios}")
+            if not errores:
+                break
+            logging.warning(f"Consulta no válida (intento {intento + 1}): {errores}")
+            mensajes += mensajes_correccion(contenido, errores)
+        else:
+            print(" El LLM no ha generado una consulta válida:", "; ".join(errores))
+            print("Respuesta raw:\n", contenido)
+            datos["error"] = "; ".join(errores)
             return None
 
-    consulta = extraer_json_valido(contenido)
+    guardar_consulta(pregunta, consulta)
     json_comprimido = json.dumps(consulta, separators=(',', ':'))
     print("Respuesta raw del LLM:\n", json_comprimido)
     logging.info(f"Consulta generada: {json_comprimido}")
     return json_comprimido
 
+def comparar_took(original: dict, optimizada: dict) -> dict:
+    """Ejecuta las dos versiones de la consulta, en orden aleatorio, y devuelve el took de cada una."""
+    versiones = [("original", original), ("optimizada", optimizada)]
+    random.shuffle(versiones)
+    tiempos = {}
+    for version, consulta in versiones:
+        respuesta = obtener_es().search(index=ES_INDEX, body=consulta, source_includes=CAMPOS_PROMPT, request_cache=False)
+        tiempos[f"took_{version}_ms"] = respuesta.get("took")
+        metricas.observar("optimizador_took_segundos", (respuesta.get("took") or 0) / 1000, version=version)
+    return tiempos
+
+def optimizar(consulta: dict) -> dict:
+    """Pasa la consulta por optimizador_consulta (ver OPTIMIZAR_CONSULTA y OPTIMIZAR_COMPARAR)."""
+    if not OPTIMIZAR_CONSULTA:
+        return consulta
+    with etapa("optimizar_consulta") as datos:
+        optimizada, cambios = optimizar_consulta(consulta)
+        datos["cambios"] = len(cambios)
+        if not cambios:
+            return consulta
+        logging.info(f"Consulta optimizada: {cambios}")
+        if OPTIMIZAR_COMPARAR and random.random() < OPTIMIZAR_COMPARAR:
+            datos.update(comparar_took(consulta, optimizada))
+            logging.info(f"Took original {datos['took_original_ms']} ms, optimizada {datos['took_optimizada_ms']} ms")
+    return optimizada
+
+def comprobar_version_cache():
+    if cache_resultados.debe_comprobar_version():
+        estadisticas = obtener_es().indices.stats(index=ES_INDEX, metric=["docs", "indexing"])
+        cache_resultados.actualizar_version(version_indice(estadisticas))
+
+def argumentos_busqueda(cuerpo: dict) -> dict:
+    # _seq_no y _primary_term identifican la versión de cada documento (ver caché de respuestas)
+    return {"index": ES_INDEX, "body": {**cuerpo, "seq_no_primary_term": True}, "source_includes": CAMPOS_PROMPT}
+
+def busquedas_noches(consulta: dict, noches: list) -> list:
+    return busquedas_estancia(ES_INDEX, consulta, noches, ESTANCIA_HITS, CAMPOS_PROMPT)
+
+def busquedas_completar_estancia(consulta: dict, noches: list, respuestas: list) -> list:
+    # Los hoteles que han salido solo algunas noches se comprueban en todas (ver busquedas_completar)
+    return busquedas_completar(ES_INDEX, consulta, noches, respuestas, ESTANCIA_HITS,
+                               campo_hotel(obtener_mapeo()), CAMPOS_PROMPT)
+
+def fusionar_estancia(consulta: dict, noches: list, respuestas: list, extra: list = None) -> dict:
+    """Resultados de la estancia a partir de las respuestas por noche y, si las hay, las de busquedas_completar_estancia."""
+    completa = not pagina_llena(respuestas, ESTANCIA_HITS)
+    if extra:
+        respuestas = unir_respuestas(respuestas, extra)
+    return fusionar_por_hotel(consulta, noches, respuestas, completa)
+
 def buscar_en_elasticsearch(consulta: dict):
-    return es.search(index=ES_INDEX, body=consulta)
+    with etapa("buscar") as datos:
+        if cache_resultados:
+            comprobar_version_cache()
+            resultados = cache_resultados.obtener(consulta)
+            datos["cache"] = resultados is not None
+            if resultados is not None:
+                logging.info("Resultados desde caché")
+                return resultados
+
+        if isinstance(consulta, str):
+            consulta = json.loads(consulta)
+        resultados = obtener_es().search(**argumentos_busqueda(consulta))
+        datos["es_took_ms"] = resultados.get("took")
+        datos["hits"] = len(resultados.get("hits", {}).get("hits", []))
+        if cache_resultados:
+            cache_resultados.guardar(consulta, resultados.body)
+        return resultados
+
+def buscar_estancia(consulta: dict, noches: list):
+    """Hoteles disponibles todas las noches: una búsqueda por noche en un msearch, fusionada por hotel."""
+    clave = {"estancia": consulta}
+    with etapa("buscar_estancia", noches=len(noches)) as datos:
+        if cache_resultados:
+            comprobar_version_cache()
+            resultados = cache_resultados.obtener(clave)
+            datos["cache"] = resultados is not None
+            if resultados is not None:
+                logging.info("Resultados desde caché")
+                return resultados
+
+        respuesta = obtener_es().msearch(searches=busquedas_noches(consulta, noches))
+        extra = busquedas_completar_estancia(consulta, noches, respuesta["responses"])
+        resultados = fusionar_estancia(consulta, noches, respuesta["responses"],
+                                       extra and obtener_es().msearch(searches=extra)["responses"])
+        datos["es_took_ms"] = respuesta.get("took")
+        datos["completar"] = bool(extra)
+        datos["hits"] = len(resultados["hits"]["hits"])
+        if cache_resultados:
+            cache_resultados.guardar(clave, resultados)
+        return resultados
+
+def paginar(consulta: dict) -> bool:
+    return PAGINACION and consulta.get("size", TAMANO_POR_DEFECTO) > 1
+
+def limite_paginacion(consulta: dict):
+    """Resultados que pide de verdad la consulta, o None si no hay límite.
+
+    El size por defecto (el de los ejemplos y el parser) y el máximo del validador no son un
+    número pedido por el usuario: con ellos se ofrecen páginas hasta agotar los resultados.
+    """
+    tamano = consulta.get("size", TAMANO_POR_DEFECTO)
+    return None if tamano in (TAMANO_POR_DEFECTO, TAMANO_MAXIMO) else tamano
+
+def primera_pagina(consulta: dict) -> dict:
+    limite = limite_paginacion(consulta)
+    return {**consulta, "size": min(limite or TAMANO_PAGINA, TAMANO_PAGINA)}
+
+def crear_paginador(consulta: dict) -> Paginador:
+    # Se piden TAMANO_PAGINA resultados cada vez hasta agotarlos o llegar al límite de la consulta
+    limite = limite_paginacion(consulta)
+    consulta = {clave: valor for clave, valor in consulta.items() if clave != "size"}
+    if limite is not None:
+        consulta["size"] = limite
+    return Paginador(obtener_es(), ES_INDEX, consulta, TAMANO_PAGINA, campos=CAMPOS_PROMPT, seq_no_primary_term=True)
+
+def buscar_pagina(paginador: Paginador):
+    """Siguiente página de resultados del paginador (None si no quedan)."""
+    with etapa("buscar", pagina=paginador.pagina + 1) as datos:
+        resultados = paginador.siguiente()
+        if resultados is not None:
+            datos["es_took_ms"] = resultados.get("took")
+            datos["hits"] = len(resultados["hits"]["hits"])
+        return resultados
+
+def plan_busqueda(consulta: dict) -> dict:
+    """Cómo se busca una consulta, sin lanzarla.
+
+    tipo es "agregacion", "estancia" (con sus noches), "pagina" (la primera de varias) o "completa";
+    cuerpo es lo que se pasa a argumentos_busqueda en los tres primeros casos.
+    """
+    if es_agregacion(consulta):
+        return {"tipo": "agregacion", "cuerpo": cuerpo_agregaciones(consulta, campo_hotel(obtener_mapeo()))}
+    noches = noches_estancia(consulta, ESTANCIA_MAX_NOCHES) if ESTANCIAS else []
+    if noches:
+        return {"tipo": "estancia", "noches": noches, "cuerpo": consulta}
+    if paginar(consulta):
+        return {"tipo": "pagina", "cuerpo": primera_pagina(consulta)}
+    return {"tipo": "completa", "cuerpo": consulta}
+
+def buscar_resultados(consulta: dict):
+    """Primera página con su paginador, o todos los resultados si no se pagina. Devuelve (resultados, paginador)."""
+    plan = plan_busqueda(consulta)
+    if plan["tipo"] == "estancia":
+        return buscar_estancia(consulta, plan["noches"]), None
+    resultados = buscar_en_elasticsearch(plan["cuerpo"])
+    if plan["tipo"] != "pagina":
+        return resultados, None
+    # La primera página es una búsqueda normal (con caché); el PIT solo se abre con "ver más"
+    paginador = crear_paginador(consulta)
+    paginador.continuar(resultados)
+    return resultados, paginador
+
+def cuerpo_busqueda(consulta: dict) -> dict:
+    """Body de la búsqueda (o de la primera página, si se pagina) tal como lo lanza buscar_resultados."""
+    if es_agregacion(consulta):
+        return cuerpo_agregaciones(consulta, campo_hotel(obtener_mapeo()))
+    cuerpo = {clave: valor for clave, valor in consulta.items() if clave not in ("from", "track_total_hits")}
+    if paginar(consulta):
+        cuerpo = primera_pagina(cuerpo)
+    return {**cuerpo, "_source": CAMPOS_PROMPT, "seq_no_primary_term": True}
 
-def construir_prompt_multiple(resultados) -> str:
+def variantes_relajacion(consulta: dict) -> list:
+    provincia_de = obtener_nomenclator().provincia_de if NOMENCLATOR else None
+    return variantes_relajadas(consulta, provincia_de)
+
+def busquedas_relajacion(variantes: list) -> list:
+    return busquedas_msearch(ES_INDEX, variantes, cuerpo_busqueda)
+
+def elegir_relajada(variantes: list, respuestas: list):
+    """(variante, resultados) de la primera variante con resultados, o (None, None).
+
+    Si la variante es una estancia los resultados son None: se busca noche a noche y se fusiona
+    por hotel, así que la respuesta del msearch no sirve.
+    """
+    variante, resultados = primera_con_resultados(variantes, respuestas)
+    if variante is not None and plan_busqueda(variante["consulta"])["tipo"] == "estancia":
+        resultados = None
+    return variante, resultados
+
+def relajar_consulta(consulta: dict):
+    """Primera versión relajada de la consulta que tiene resultados (ver relajacion.py).
+
+    Todas las variantes se buscan en un único msearch y la respuesta de la elegida es ya su
+    primera página. Devuelve (consulta, nota, resultados, paginador) o None.
+    """
+    variantes = variantes_relajacion(consulta)
+    if not variantes:
+        return None
+    with etapa("relajar", variantes=len(variantes)) as datos:
+        respuesta = obtener_es().msearch(searches=busquedas_relajacion(variantes))
+        datos["es_took_ms"] = respuesta.get("took")
+        variante, resultados = elegir_relajada(variantes, respuesta["responses"])
+        datos["nivel"] = variante["nivel"] if variante else None
+    if variante is None:
+        return None
+    relajada = variante["consulta"]
+    logging.info(f"Consulta relajada ({variante['nivel']}): {json.dumps(relajada, separators=(',', ':'))}")
+    paginador = None
+    if resultados is None:
+        resultados, paginador = buscar_resultados(relajada)
+    elif paginar(relajada):
+        # El PIT solo se abre si se piden más resultados
+        paginador = crear_paginador(relajada)
+        paginador.continuar(resultados)
+    return relajada, nota_relajacion(variante), resultados, paginador
+
+def construir_prompt_multiple(resultados, presupuesto_tokens: int = None) -> str:
     hits = resultados.get("hits", {}).get("hits", [])
     if not hits:
         return "No se encontraron resultados para la consulta."
 
-    prompt = "Describe brevemente y en lenguaje natural los siguientes hoteles:\n\n"
-    for hit in hits:
-        hotel = hit["_source"]
-        servicios = hotel.get("servicios", [])
-        prompt += f"""Hotel {hotel.get('nombre', 'N/A')}:
-
-- Provincia: {hotel.get('provincia', 'N/A')}
-- Localidad: {hotel.get('localidad', 'N/A')} 
-- Direccion: {hotel.get('direccion', 'N/A')}
-- Descripcion: {hotel.get('descripcion', '')}
-- Servicios: {', '.join(servicios) if isinstance(servicios, list) else servicios}
-- Puntuacion: {hotel.get('opinion', 'Sin opiniones')} 
-- Número de comentarios: ({hotel.get('comentarios', '0')} comentarios)
-- Url: {hotel.get('url', 'N/A')}
-- Precio: {hotel.get('precio', 'N/A')} EUR
+    with etapa("construir_prompt") as datos:
+        prompt, informe = construir_contexto(hits, presupuesto_tokens or PRESUPUESTO_TOKENS)
+        datos.update(informe)
+    logging.info(f"Contexto de respuesta: {informe}")
+    return prompt
 
-"""
-    return prompt.strip()
-
-def respuesta_natural(texto_prompt: str) -> str:
-    if USE_OPEN_ROUTER:
-        respuesta = openai_client.chat.completions.create(
-            model=OPENROUTER_MODEL,
-            messages=[{"role": "user", "content": texto_prompt}],
-            timeout=60
-        )
-        return respuesta.choices[0].message.content
-    else:
+def generar_respuesta_stream(texto_prompt: str, uso: dict = None):
+    """Devuelve los fragmentos de la respuesta a medida que los genera el LLM.
+
+    Si se pasa el diccionario uso, al terminar se rellena con los tokens consumidos.
+    """
+    yield from obtener_cliente_llm().chat_stream([{"role": "user", "content": texto_prompt}], uso)
+
+def imprimir_fragmento(fragmento: str):
+    print(fragmento, end="", flush=True)
+
+def respuesta_natural(texto_prompt: str, stream: bool = False, callback=None) -> str:
+    if stream:
+        return respuesta_natural_stream(texto_prompt, callback or imprimir_fragmento)
+
+    with etapa("respuesta", stream=False) as datos:
+        try:
+            respuesta = obtener_cliente_llm().chat([{"role": "user", "content": texto_prompt}])
+        except ErrorLLM as e:
+            print(f" Error al llamar al modelo: {e}")
+            datos["error"] = str(e)
+            return None
+        datos.update(respuesta["uso"], backend=respuesta["backend"])
+        return respuesta["contenido"].strip()
+
+def respuesta_natural_stream(texto_prompt: str, callback) -> str:
+    """Pasa cada fragmento a callback según llega y devuelve la respuesta completa."""
+    with etapa("respuesta", stream=True) as datos:
+        uso = {}
         try:
-            respuesta = ollama.chat(
-                model=OLLAMA_MODEL,
-                messages=[{"role": "user", "content": texto_prompt}],
-                options={"temperature": 0.1}
-            )
-            return respuesta["message"]["content"].strip()
-        except requests.exceptions.RequestException as e:
-            print(f" Error al llamar a Ollama: {e}")
+            respuesta, primer_token, total = consumir_stream(generar_respuesta_stream(texto_prompt, uso), callback)
+        except Exception as e:
+            print(f" Error al llamar al modelo: {e}")
+            datos["error"] = str(e)
             return None
+        datos.update(uso)
+        datos["primer_token_segundos"] = round(primer_token, 4)
+    logging.info(f"Tiempo hasta el primer token: {primer_token:.3f}s, tiempo total: {total:.3f}s")
+    return respuesta
+
+def usar_bloques(hits: list) -> bool:
+    return bool(RESPUESTA_BLOQUE) and len(hits) > RESPUESTA_BLOQUE
+
+def prompts_bloques(hits: list) -> list:
+    """(prompt, informe) de cada bloque de RESPUESTA_BLOQUE hoteles; el informe incluye cuántos hoteles tiene el bloque."""
+    prompts = []
+    for bloque in dividir_en_bloques(hits, RESPUESTA_BLOQUE):
+        prompt, informe = construir_contexto(bloque, PRESUPUESTO_TOKENS)
+        prompts.append((prompt, {**informe, "hoteles": len(bloque)}))
+    return prompts
+
+def prompt_fusion(descripciones: list, total_hoteles: int) -> str:
+    return construir_prompt_fusion(descripciones, total_hoteles, PRESUPUESTO_TOKENS)
+
+def unir_bloques(descripciones: list, introduccion: str, stream: bool = False) -> str:
+    # Sin stream la introducción va delante; en streaming llega al final, cuando ya se han mostrado los bloques
+    partes = descripciones + [introduccion] if stream else [introduccion] + descripciones
+    return "\n\n".join(p for p in partes if p)
+
+def _describir_bloque(numero: int, prompt: str, informe: dict) -> str:
+    with etapa("respuesta_bloque", bloque=numero, hoteles=informe["hoteles"]) as datos:
+        respuesta = obtener_cliente_llm().chat([{"role": "user", "content": prompt}])
+        datos.update(respuesta["uso"], backend=respuesta["backend"], tokens_ahorrados=informe["tokens_ahorrados"])
+        return respuesta["contenido"].strip()
+
+def respuesta_por_bloques(resultados, stream: bool = False, callback=None) -> str:
+    """Map-reduce: describe los hoteles en bloques en paralelo y añade una introducción corta.
+
+    Con stream cada bloque se pasa a callback en cuanto termina (en orden de llegada), de
+    modo que el tiempo total depende del bloque más lento y no del número de hoteles.
+    """
+    hits = resultados.get("hits", {}).get("hits", [])
+    bloques = prompts_bloques(hits)
+    callback = callback or imprimir_fragmento
+    descripciones = [None] * len(bloques)
+    with etapa("respuesta", stream=stream, bloques=len(bloques)) as datos:
+        inicio = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=RESPUESTA_BLOQUES_PARALELOS,
+                                                   thread_name_prefix="bloque") as ejecutor:
+            futuros = {ejecutor.submit(_describir_bloque, i, prompt, informe): i
+                       for i, (prompt, informe) in enumerate(bloques)}
+            for futuro in concurrent.futures.as_completed(futuros):
+                i = futuros[futuro]
+                try:
+                    descripciones[i] = futuro.result()
+                except ErrorLLM as e:
+                    logging.warning(f"Bloque {i} sin respuesta: {e}")
+                    continue
+                if stream:
+                    datos.setdefault("primer_token_segundos", round(time.perf_counter() - inicio, 4))
+                    callback(descripciones[i] + "\n\n")
+        descripciones = [d for d in descripciones if d]
+        if not descripciones:
+            datos["error"] = "ningún bloque ha obtenido respuesta"
+            return None
+
+        try:
+            with etapa("respuesta_fusion") as datos_fusion:
+                fusion = obtener_cliente_llm().chat([{"role": "user", "content": prompt_fusion(descripciones, len(hits))}],
+                                                    max_tokens=RESPUESTA_TOKENS_FUSION)
+                datos_fusion.update(fusion["uso"], backend=fusion["backend"])
+            introduccion = fusion["contenido"].strip()
+        except ErrorLLM as e:
+            logging.warning(f"Fusión sin respuesta: {e}")
+            introduccion = ""
+        if stream and introduccion:
+            callback(introduccion)
+    return unir_bloques(descripciones, introduccion, stream)
+
+def _clave_respuesta(resultados, prompt_hoteles: str) -> str:
+    modelo = f"openrouter:{OPENROUTER_MODEL}" if USE_OPEN_ROUTER else f"ollama:{OLLAMA_MODEL}"
+    hits = resultados.get("hits", {}).get("hits", [])
+    return clave_respuesta(hits, modelo, prompt_hoteles,
+                           ajustes=f"presupuesto={PRESUPUESTO_TOKENS};bloque={usar_bloques(hits) and RESPUESTA_BLOQUE}")
+
+def respuesta_desde_cache(resultados, prompt_hoteles: str):
+    if not cache_respuestas:
+        return None
+    with etapa("cache_respuesta") as datos:
+        respuesta = cache_respuestas.obtener(_clave_respuesta(resultados, prompt_hoteles))
+        datos["cache"] = respuesta is not None
+    if respuesta is not None:
+        logging.info("Respuesta desde caché")
+    return respuesta
+
+def guardar_respuesta_en_cache(resultados, prompt_hoteles: str, respuesta: str):
+    if cache_respuestas and respuesta:
+        cache_respuestas.guardar(_clave_respuesta(resultados, prompt_hoteles), respuesta)
+
+def respuesta_sin_llm(resultados, prompt_hoteles: str):
+    """Respuesta con los resúmenes precalculados o desde la caché de respuestas, o None si hace falta el LLM."""
+    hits = resultados.get("hits", {}).get("hits", [])
+    respuesta = respuesta_precalculada(hits) if RESPUESTA_PRECALCULADA else None
+    if respuesta is not None:
+        logging.info("Respuesta con resúmenes precalculados")
+        return respuesta
+    return respuesta_desde_cache(resultados, prompt_hoteles)
+
+def completar_respuesta(consulta: dict, resultados, respuesta: str, nota: str = None) -> str:
+    """Añade el aviso de lista incompleta (estancias) y, delante, la nota de relajación."""
+    if respuesta and not es_agregacion(consulta) and lista_incompleta(resultados):
+        respuesta = f"{respuesta}\n\n{AVISO_INCOMPLETA}"
+    if respuesta and nota:
+        respuesta = f"{nota}\n\n{respuesta}"
+    return respuesta
+
+def describir_resultados(resultados, stream: bool = False, callback=None) -> str:
+    """Respuesta en lenguaje natural para unos resultados: precalculada, desde caché, por bloques o con el LLM."""
+    prompt_hoteles = construir_prompt_multiple(resultados)
+    hits = resultados.get("hits", {}).get("hits", [])
+    respuesta = respuesta_sin_llm(resultados, prompt_hoteles)
+    if respuesta is not None:
+        if stream:
+            (callback or imprimir_fragmento)(respuesta)
+    elif usar_bloques(hits):
+        respuesta = respuesta_por_bloques(resultados, stream=stream, callback=callback)
+        guardar_respuesta_en_cache(resultados, prompt_hoteles, respuesta)
+    else:
+        respuesta = respuesta_natural(prompt_hoteles, stream=stream, callback=callback)
+        guardar_respuesta_en_cache(resultados, prompt_hoteles, respuesta)
+    return respuesta
+
+def responder(pregunta: str, stream: bool = False, callback=None) -> dict:
+    """Ejecuta el flujo completo para una pregunta reutilizando los clientes del módulo.
+
+    Si quedan más páginas de resultados, el diccionario incluye el paginador para pedirlas
+    con ver_mas (quien lo recibe debe cerrarlo si no las pide).
+    """
+    inicio = time.perf_counter()
+    logging.info(f"Pregunta: {pregunta}")
+    paginador = None
+    with etapa("total", stream=stream):
+        consulta = generar_consulta_llm(pregunta)
+        if not consulta:
+            return {"pregunta": pregunta, "consulta": None, "respuesta": None}
+        consulta = optimizar(json.loads(consulta))
+        resultados, paginador = buscar_resultados(consulta)
+        nota = None
+        if RELAJAR_CONSULTA and sin_resultados(consulta, resultados):
+            relajada = relajar_consulta(consulta)
+            if relajada:
+                consulta, nota, resultados, paginador = relajada
+                if stream:
+                    (callback or imprimir_fragmento)(f"{nota}\n\n")
+        if es_agregacion(consulta):
+            respuesta = respuesta_agregaciones(consulta, resultados)
+            if stream:
+                (callback or imprimir_fragmento)(respuesta)
+        else:
+            respuesta = describir_resultados(resultados, stream=stream, callback=callback)
+        # En streaming la nota ya se ha enviado antes de la respuesta
+        completa = completar_respuesta(consulta, resultados, respuesta, None if stream else nota)
+        if stream and respuesta and completa != respuesta:
+            (callback or imprimir_fragmento)(completa[len(respuesta):])
+        respuesta = completa
+    logging.info(f"Respuesta: {respuesta}")
+    resultado = {
+        "pregunta": pregunta,
+        "consulta": consulta,
+        "respuesta": respuesta,
+        "segundos": round(time.perf_counter() - inicio, 3),
+    }
+    if nota:
+        resultado["relajacion"] = nota
+    if paginador is not None:
+        resultado.update(pagina=paginador.pagina, hay_mas=paginador.hay_mas)
+        if paginador.hay_mas:
+            resultado["paginador"] = paginador
+    return resultado
+
+def ver_mas(paginador: Paginador, stream: bool = False, callback=None) -> dict:
+    """Describe la siguiente página de resultados de una pregunta anterior."""
+    inicio = time.perf_counter()
+    with etapa("total", stream=stream, pagina=paginador.pagina + 1):
+        resultados = buscar_pagina(paginador)
+        if resultados is None:
+            return {"pagina": paginador.pagina, "respuesta": None, "hay_mas": False}
+        respuesta = describir_resultados(resultados, stream=stream, callback=callback)
+    logging.info(f"Respuesta (página {paginador.pagina}): {respuesta}")
+    return {
+        "pagina": paginador.pagina,
+        "respuesta": respuesta,
+        "hay_mas": paginador.hay_mas,
+        "segundos": round(time.perf_counter() - inicio, 3),
+    }
+
+def ofrecer_mas(paginador: Paginador):
+    """Pregunta en la terminal si se quieren ver más resultados y los muestra página a página."""
+    try:
+        while paginador.hay_mas:
+            if input("\n¿Ver más resultados? [s/N]: ").strip().lower() not in ("s", "si", "sí", "mas", "más", "ver más"):
+                break
+            print(f"\nPágina {paginador.pagina + 1}:")
+            resultado = ver_mas(paginador, stream=STREAM_RESPUESTA)
+            if STREAM_RESPUESTA:
+                print()
+            elif resultado["respuesta"]:
+                print(resultado["respuesta"])
+    except (EOFError, KeyboardInterrupt):
+        print()
+    finally:
+        paginador.cerrar()
 
 def main():
+    parser = argparse.ArgumentParser(description="Buscador de hoteles con Elasticsearch y LLM.")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="Muestra cuánto ha tardado cada paso de importación e inicialización")
+    args = parser.parse_args()
+
     configurar_logging()
+    hilos_arranque = iniciar_en_segundo_plano()
+    perfil.marcar("prompt mostrado")
     pregunta_usuario = input("Pregunta sobre hoteles: ")
-    logging.info(f"Pregunta: {pregunta_usuario}")
-    consulta = generar_consulta_llm(pregunta_usuario)
-    if not consulta:
-        return
-    resultados = buscar_en_elasticsearch(consulta)
-    prompt_hoteles = construir_prompt_multiple(resultados)
-    respuesta = respuesta_natural(prompt_hoteles)
-    print("\nRespuesta:\n", respuesta)
-    logging.info("Respuesta: " + respuesta)
+    if args.startup_profile:
+        for hilo in hilos_arranque:
+            hilo.join()
+        print(perfil.informe())
+    if STREAM_RESPUESTA:
+        print("\nRespuesta:")
+        resultado = responder(pregunta_usuario, stream=True)
+        print()
+    else:
+        resultado = responder(pregunta_usuario)
+        if resultado["respuesta"]:
+            print("\nRespuesta:\n", resultado["respuesta"])
+    if resultado.get("paginador"):
+        ofrecer_mas(resultado["paginador"])
+
+perfil.marcar("import llm")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import sys
+import time
+from elasticsearch import AsyncElasticsearch
+from agregaciones import es_agregacion, respuesta_agregaciones, sin_resultados
+from backend_llm import ErrorLLM
+from cache import version_indice
+from parser_reglas import estadisticas_parser
+from relajacion import nota_relajacion
+
+import llm
+from llm import (
+    construir_prompt_multiple,
+    configurar_logging,
+)
+
+# Número de preguntas que se procesan a la vez por defecto
+CONCURRENCIA_POR_DEFECTO = 16
+
+
+def leer_preguntas(entrada, formato: str):
+    """Devuelve (indice, pregunta) para cada pregunta del fichero o de stdin."""
+    if formato == "csv":
+        lector = csv.DictReader(entrada)
+        columna = "pregunta" if "pregunta" in (lector.fieldnames or []) else lector.fieldnames[0]
+        for indice, fila in enumerate(lector):
+            yield indice, fila[columna]
+        return
+
+    for indice, linea in enumerate(l for l in entrada if l.strip()):
+        linea = linea.strip()
+        if formato == "jsonl":
+            dato = json.loads(linea)
+            yield indice, dato["pregunta"] if isinstance(dato, dict) else str(dato)
+        else:
+            yield indice, linea
+
+
+def detectar_formato(ruta: str) -> str:
+    if ruta.endswith(".csv"):
+        return "csv"
+    if ruta.endswith((".jsonl", ".json")):
+        return "jsonl"
+    return "texto"
+
+
+def crear_clientes():
+    es = AsyncElasticsearch(
+        [f"http://{llm.ELASTICSEARCH_HOST}:{llm.ELASTICSEARCH_PORT}"],
+        basic_auth=(llm.ELASTICSEARCH_USERNAME, llm.ELASTICSEARCH_PASSWORD)
+    )
+    # Mismo cliente que llm.py (reintentos, hedging y failover), usado con sus métodos asíncronos
+    return es, llm.obtener_cliente_llm()
+
+
+async def chat_async(cliente_llm, contenido, esquema: dict = None) -> str:
+    """contenido es el texto del mensaje o la lista completa de mensajes; esquema, la salida estructurada."""
+    mensajes = [{"role": "user", "content": contenido}] if isinstance(contenido, str) else contenido
+    respuesta = await cliente_llm.chat_async(mensajes, esquema)
+    return respuesta["contenido"].strip()
+
+
+async def generar_consulta_async(cliente_llm, pregunta: str, cercania: dict = None) -> dict:
+    """Igual que llm.generar_consulta_llm: salida estructurada, reparación local y reintentos acotados."""
+    mensajes = llm.mensajes_generar_consulta(llm.texto_para_llm(pregunta, cercania))
+    esquema = llm.esquema_consulta()
+    for _ in range(llm.REINTENTOS_CONSULTA + 1):
+        contenido = await chat_async(cliente_llm, mensajes, esquema)
+        consulta, errores, _ = llm.revisar_consulta(contenido, cercania)
+        if not errores:
+            return consulta
+        mensajes += llm.mensajes_correccion(contenido, errores)
+    raise ValueError(f"El LLM no ha devuelto una consulta válida: {'; '.join(errores)}")
+
+
+async def buscar_async(es, consulta):
+    """Igual que llm.buscar_resultados (la primera página, sin paginador), compartiendo la caché de resultados."""
+    plan = llm.plan_busqueda(consulta)
+    cache = llm.cache_resultados
+    clave = {"estancia": consulta} if plan["tipo"] == "estancia" else plan["cuerpo"]
+    if cache:
+        if cache.debe_comprobar_version():
+            estadisticas = await es.indices.stats(index=llm.ES_INDEX, metric=["docs", "indexing"])
+            cache.actualizar_version(version_indice(estadisticas))
+        resultados = cache.obtener(clave)
+        if resultados is not None:
+            return resultados
+    if plan["tipo"] == "estancia":
+        noches = plan["noches"]
+        respuesta = await es.msearch(searches=llm.busquedas_noches(consulta, noches))
+        extra = llm.busquedas_completar_estancia(consulta, noches, respuesta["responses"])
+        resultados = llm.fusionar_estancia(consulta, noches, respuesta["responses"],
+                                           extra and (await es.msearch(searches=extra))["responses"])
+    else:
+        resultados = (await es.search(**llm.argumentos_busqueda(plan["cuerpo"]))).body
+    if cache:
+        cache.guardar(clave, resultados)
+    return resultados
+
+
+async def relajar_async(es, consulta):
+    """Igual que llm.relajar_consulta, sin paginador: (consulta, nota, resultados) de la primera variante
+    con resultados, o None."""
+    variantes = await asyncio.to_thread(llm.variantes_relajacion, consulta)
+    if not variantes:
+        return None
+    respuesta = await es.msearch(searches=llm.busquedas_relajacion(variantes))
+    variante, resultados = llm.elegir_relajada(variantes, respuesta["responses"])
+    if variante is None:
+        return None
+    if resultados is None:
+        resultados = await buscar_async(es, variante["consulta"])
+    return variante["consulta"], nota_relajacion(variante), resultados
+
+
+async def bloques_async(cliente_llm, hits: list) -> str:
+    """Igual que llm.respuesta_por_bloques sin stream: bloques en paralelo y una introducción."""
+    semaforo = asyncio.Semaphore(llm.RESPUESTA_BLOQUES_PARALELOS)
+
+    async def describir(prompt):
+        async with semaforo:
+            return await chat_async(cliente_llm, prompt)
+
+    respuestas = await asyncio.gather(*(describir(prompt) for prompt, _ in llm.prompts_bloques(hits)),
+                                      return_exceptions=True)
+    descripciones = []
+    for i, respuesta in enumerate(respuestas):
+        if isinstance(respuesta, Exception):
+            logging.warning(f"Bloque {i} sin respuesta: {respuesta}")
+        elif respuesta:
+            descripciones.append(respuesta)
+    if not descripciones:
+        return None
+    try:
+        fusion = await cliente_llm.chat_async([{"role": "user", "content": llm.prompt_fusion(descripciones, len(hits))}],
+                                              max_tokens=llm.RESPUESTA_TOKENS_FUSION)
+        introduccion = fusion["contenido"].strip()
+    except ErrorLLM as e:
+        logging.warning(f"Fusión sin respuesta: {e}")
+        introduccion = ""
+    return llm.unir_bloques(descripciones, introduccion)
+
+
+async def describir_async(cliente_llm, resultados) -> str:
+    """Igual que llm.describir_resultados sin stream: precalculada, desde caché, por bloques o con el LLM."""
+    prompt_hoteles = construir_prompt_multiple(resultados)
+    respuesta = await asyncio.to_thread(llm.respuesta_sin_llm, resultados, prompt_hoteles)
+    if respuesta is not None:
+        return respuesta
+    hits = resultados.get("hits", {}).get("hits", [])
+    if llm.usar_bloques(hits):
+        respuesta = await bloques_async(cliente_llm, hits)
+    else:
+        respuesta = await chat_async(cliente_llm, prompt_hoteles)
+    await asyncio.to_thread(llm.guardar_respuesta_en_cache, resultados, prompt_hoteles, respuesta)
+    return respuesta
+
+
+async def procesar_pregunta(es, cliente_llm, indice: int, pregunta: str) -> dict:
+    inicio = time.perf_counter()
+    resultado = {"indice": indice, "pregunta": pregunta, "consulta": None, "respuesta": None, "error": None}
+    try:
+        # El parser, el nomenclátor y la caché de consultas (SQLite) se consultan fuera del bucle de eventos
+        cercania = await asyncio.to_thread(llm.extraer_cercania, pregunta)
+        consulta = await asyncio.to_thread(llm.consulta_sin_llm, pregunta, cercania)
+        if consulta is None:
+            consulta = await generar_consulta_async(cliente_llm, pregunta, cercania)
+            await asyncio.to_thread(llm.guardar_consulta, pregunta, consulta)
+        consulta = await asyncio.to_thread(llm.optimizar, consulta)
+        resultado["consulta"] = consulta
+        resultados = await buscar_async(es, consulta)
+        if llm.RELAJAR_CONSULTA and sin_resultados(consulta, resultados):
+            relajada = await relajar_async(es, consulta)
+            if relajada:
+                resultado["consulta"], resultado["relajacion"], resultados = relajada
+        if es_agregacion(resultado["consulta"]):
+            respuesta = respuesta_agregaciones(resultado["consulta"], resultados)
+        else:
+            respuesta = await describir_async(cliente_llm, resultados)
+        resultado["respuesta"] = llm.completar_respuesta(resultado["consulta"], resultados, respuesta,
+                                                         resultado.get("relajacion"))
+    except Exception as e:
+        resultado["error"] = str(e)
+        logging.error(f"Pregunta {indice} fallida: {e}")
+    resultado["segundos"] = round(time.perf_counter() - inicio, 3)
+    return resultado
+
+
+async def ejecutar_lote(preguntas, salida, concurrencia: int = CONCURRENCIA_POR_DEFECTO) -> int:
+    """Procesa las preguntas con un límite de concurrencia y escribe los resultados en orden de entrada."""
+    es, cliente_llm = crear_clientes()
+    # El mapping y el nomenclátor se leen una sola vez (cliente síncrono) antes de lanzar los trabajadores
+    await asyncio.to_thread(llm.obtener_mapeo)
+    if llm.NOMENCLATOR:
+        await asyncio.to_thread(llm.obtener_nomenclator)
+    cola = asyncio.Queue(maxsize=concurrencia * 2)
+    pendientes = {}
+    siguiente = 0
+    total = 0
+
+    def volcar_en_orden():
+        nonlocal siguiente
+        while siguiente in pendientes:
+            salida.write(json.dumps(pendientes.pop(siguiente), ensure_ascii=False) + "\n")
+            siguiente += 1
+        salida.flush()
+
+    async def trabajador():
+        while True:
+            elemento = await cola.get()
+            if elemento is None:
+                cola.task_done()
+                return
+            indice, pregunta = elemento
+            pendientes[indice] = await procesar_pregunta(es, cliente_llm, indice, pregunta)
+            volcar_en_orden()
+            cola.task_done()
+
+    trabajadores = [asyncio.create_task(trabajador()) for _ in range(concurrencia)]
+    try:
+        for indice, pregunta in preguntas:
+            await cola.put((indice, pregunta))
+            total += 1
+        for _ in trabajadores:
+            await cola.put(None)
+        await asyncio.gather(*trabajadores)
+    finally:
+        await es.close()
+        await cliente_llm.aclose()
+    volcar_en_orden()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Responde en lote preguntas sobre hoteles.")
+    parser.add_argument("entrada", nargs="?", default="-", help="Fichero JSONL/CSV/texto con preguntas ('-' para stdin)")
+    parser.add_argument("-o", "--salida", default="-", help="Fichero JSONL de resultados ('-' para stdout)")
+    parser.add_argument("-c", "--concurrencia", type=int, default=CONCURRENCIA_POR_DEFECTO)
+    parser.add_argument("-f", "--formato", choices=["jsonl", "csv", "texto"], help="Formato de la entrada")
+    args = parser.parse_args()
+
+    configurar_logging()
+    formato = args.formato or detectar_formato(args.entrada)
+    entrada = sys.stdin if args.entrada == "-" else open(args.entrada, encoding="utf-8", newline="")
+    salida = sys.stdout if args.salida == "-" else open(args.salida, "w", encoding="utf-8")
+
+    inicio = time.perf_counter()
+    try:
+        total = asyncio.run(ejecutar_lote(leer_preguntas(entrada, formato), salida, args.concurrencia))
+    finally:
+        if entrada is not sys.stdin:
+            entrada.close()
+        if salida is not sys.stdout:
+            salida.close()
+    duracion = time.perf_counter() - inicio
+    logging.info(f"Lote de {total} preguntas en {duracion:.1f}s ({total / duracion:.2f} preguntas/s)")
+    if llm.PARSER_REGLAS:
+        logging.info(f"Parser de reglas: {estadisticas_parser()}")
+    if llm.cache_consultas:
+        logging.info(f"Caché de consultas: {llm.cache_consultas.estadisticas()}")
+    if llm.cache_resultados:
+        logging.info(f"Caché de resultados: {llm.cache_resultados.estadisticas()}")
+    if llm.cache_respuestas:
+        logging.info(f"Caché de respuestas: {llm.cache_respuestas.estadisticas()}")
+    print(f"{total} preguntas procesadas en {duracion:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
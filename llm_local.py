@@ -1,10 +1,17 @@
+from arranque import perfil
+import argparse
+import logging
 import os
 import json
-import re
-from elasticsearch import Elasticsearch
-import ollama
-import requests 
+import threading
 from dotenv import load_dotenv
+from backend_llm import BackendOllama, ClienteLLM, ErrorLLM, consumir_stream
+from metricas import iniciar_logging
+from ejemplos import SelectorEjemplos
+from contexto_prompt import CAMPOS_PROMPT
+from agregaciones import cuerpo_agregaciones, es_agregacion, respuesta_agregaciones
+from esquema_consulta import extraer_json, mensajes_consulta
+from plantillas_busqueda import PROMPT_PARAMETROS, fuera_de_plantilla, registrar_plantillas, validar_parametros, buscar_con_plantilla
 
 load_dotenv()
 
@@ -15,19 +22,28 @@ ELASTICSEARCH_PASSWORD = os.getenv('ELASTICSEARCH_PASSWORD')
 
 # Conexión Elasticsearch
 hosts = f"http://{ELASTICSEARCH_HOST}:{ELASTICSEARCH_PORT}"
-es = Elasticsearch([hosts], basic_auth=(ELASTICSEARCH_USERNAME, ELASTICSEARCH_PASSWORD))
-es.info()
 
 
 # Configuración Ollama
 OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL')
 OLLAMA_MODEL = os.getenv('OLLAMA_MODEL')
+# Plazo, reintentos y petición de respaldo de las llamadas al modelo (ver backend_llm.py)
+LLM_PLAZO = float(os.getenv('LLM_PLAZO', '60'))
+LLM_REINTENTOS = int(os.getenv('LLM_REINTENTOS', '3'))
+LLM_HEDGE_SEGUNDOS = float(os.getenv('LLM_HEDGE_SEGUNDOS', '0'))
+# Tiempo que el modelo sigue cargado entre preguntas
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
 
 
 
 ES_INDEX = os.getenv('ES_INDEX')
+STREAM_RESPUESTA = os.getenv('STREAM_RESPUESTA', 'yes').lower() == 'yes'
 TEMPLATE_ID = os.getenv('TEMPLATE_ID')
 
+# Directorio del fichero de log (si no se define, los logs van a la consola) y formato JSON
+OUT_DIRECTORY = os.getenv('OUT_DIRECTORY')
+LOG_JSON = os.getenv('LOG_JSON', 'no').lower() == 'yes'
+
 
 indice = ES_INDEX
 
@@ -35,16 +51,60 @@ mensajes = [
         {"role": "user", "content": "hola"},
     ]
 
- # Inicialización del cliente Ollama
-try:        
-    respuesta = ollama.chat(
-                model=OLLAMA_MODEL,
-                messages=mensajes,
-                options={"temperature": 0.1}, 
-            )
+# Los clientes se crean al primer uso; la comprobación de Elasticsearch y el
+# calentamiento de Ollama se lanzan en segundo plano desde main()
+_es = None
+_ollama = None
+_lock_es = threading.Lock()
+_lock_ollama = threading.Lock()
+
+def obtener_es():
+    global _es
+    with _lock_es:
+        if _es is None:
+            with perfil.medir("import elasticsearch"):
+                from elasticsearch import Elasticsearch
+            with perfil.medir("cliente Elasticsearch"):
+                _es = Elasticsearch([hosts], basic_auth=(ELASTICSEARCH_USERNAME, ELASTICSEARCH_PASSWORD))
+    return _es
+
+def obtener_ollama() -> ClienteLLM:
+    global _ollama
+    with _lock_ollama:
+        if _ollama is None:
+            _ollama = ClienteLLM([BackendOllama(OLLAMA_MODEL, host=OLLAMA_BASE_URL, timeout=LLM_PLAZO,
+                                               keep_alive=OLLAMA_KEEP_ALIVE or None)],
+                                 reintentos=LLM_REINTENTOS, plazo=LLM_PLAZO, hedge_segundos=LLM_HEDGE_SEGUNDOS)
+    return _ollama
+
+def comprobar_es():
+    cliente = obtener_es()
+    with perfil.medir("es.info()"):
+        cliente.info()
+
+def calentar_ollama():
+    # Inicialización del cliente Ollama
+    cliente = obtener_ollama()
+    try:
+        with perfil.medir("calentamiento del modelo"):
+            cliente.chat(mensajes, max_tokens=1)
+    except ErrorLLM as e:
+        print(f"Error iniciando Ollama: {e}")
+
+def iniciar_en_segundo_plano() -> list:
+    def ejecutar(nombre, funcion):
+        try:
+            funcion()
+        except Exception as e:
+            logging.warning(f"Arranque en segundo plano ({nombre}) fallido: {e}")
 
-except requests.exceptions.RequestException as e:
-    print(f"Error iniciando Ollama: {e}")
+    hilos = [
+        threading.Thread(target=ejecutar, args=("Elasticsearch", comprobar_es), name="arranque-es", daemon=True),
+        threading.Thread(target=ejecutar, args=("Ollama", calentar_ollama), name="arranque-llm", daemon=True),
+    ]
+    for hilo in hilos:
+        hilo.start()
+    return hilos
 
 FEW_SHOT_PROMPT = """
 Eres un experto en Elasticsearch. Dado el siguiente esquema de índice de hoteles, genera SOLO la consulta JSON válida para buscar detalles del hotel solicitado.
@@ -58,6 +118,8 @@ Esquema:
 - descripcion: text
 - precio: integer
 - fechaEntrada: date (yyyy-MM-dd)
+- opinion: float
+- comentarios: integer
 
 Ejemplo 1:
 Pregunta: "Muéstrame hoteles en Aguadulce con piscina y parking, ordenados por precio ascendente para el día 01/06/2025."
@@ -115,37 +177,63 @@ Ahora, genera SOLO la consulta JSON para esta pregunta:
 "{pregunta}"
 """
 
+# Ejemplos few-shot dinámicos: solo los EJEMPLOS_K más parecidos a la pregunta (ver ejemplos.py)
+EJEMPLOS_DINAMICOS = os.getenv('EJEMPLOS_DINAMICOS', 'yes').lower() == 'yes'
+EJEMPLOS_FICHERO = os.getenv('EJEMPLOS_FICHERO', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ejemplos_consultas.jsonl'))
+EJEMPLOS_K = int(os.getenv('EJEMPLOS_K', '3'))
+selector_ejemplos = (SelectorEjemplos.desde_fichero(EJEMPLOS_FICHERO)
+                     if EJEMPLOS_DINAMICOS and os.path.exists(EJEMPLOS_FICHERO) else None)
+
 def extraer_json_valido(texto):
     """Extrae y parsea el primer bloque JSON válido de un string."""
-    try:
-        match = re.search(r'\{.*\}', texto, re.DOTALL)
-        if not match:
-            raise ValueError("No se encontró bloque JSON.")
-        return json.loads(match.group())
-    except json.JSONDecodeError as e:
-        print("⚠️ Error al parsear JSON:", e)
+    consulta = extraer_json(texto)
+    if consulta is None:
+        print("⚠️ Error al parsear JSON: no se encontró un objeto JSON válido.")
         print("Respuesta raw:\n", texto)
-        return None
+    return consulta
 
 def generar_consulta_llm(pregunta: str) -> dict:
-    prompt = FEW_SHOT_PROMPT.replace("{pregunta}", pregunta)
-    try:        
-        respuesta = ollama.chat(
-                model=OLLAMA_MODEL,
-                messages=[{"role":"user", "content": prompt}],
-                options={"temperature": 0.1}, 
-            )
-
-    except requests.exceptions.RequestException as e:
+    mensajes = (selector_ejemplos.mensajes(FEW_SHOT_PROMPT, pregunta, EJEMPLOS_K) if selector_ejemplos
+                else mensajes_consulta(FEW_SHOT_PROMPT, pregunta))
+    try:
+        respuesta = obtener_ollama().chat(mensajes)
+    except ErrorLLM as e:
         print(f"Error iniciando Ollama: {e}")
-    mensaje = respuesta.get("message", {})
-    consulta = extraer_json_valido(mensaje.content)
+        return None
+    consulta = extraer_json_valido(respuesta["contenido"])
     print("Respuesta raw del LLM:")
     print(consulta)
     return consulta
 
+def generar_parametros_llm(pregunta: str) -> dict:
+    """Pide al LLM solo los parámetros de la plantilla de búsqueda (TEMPLATE_ID), o None si la
+    pregunta no cabe en las plantillas y hay que generar la consulta completa."""
+    if fuera_de_plantilla(pregunta):
+        return None
+    prompt = PROMPT_PARAMETROS.replace("{pregunta}", pregunta)
+    try:
+        respuesta = obtener_ollama().chat([{"role": "user", "content": prompt}], max_tokens=128)
+    except ErrorLLM as e:
+        print(f"Error iniciando Ollama: {e}")
+        return None
+    parametros = validar_parametros(extraer_json_valido(respuesta["contenido"]))
+    print("Parámetros generados por el LLM:")
+    print(parametros)
+    return parametros
+
+_plantillas_registradas = False
+_lock_plantillas = threading.Lock()
+
+def buscar_con_plantilla_en_elasticsearch(parametros: dict):
+    global _plantillas_registradas
+    with _lock_plantillas:
+        if not _plantillas_registradas:
+            registrar_plantillas(obtener_es(), TEMPLATE_ID)
+            _plantillas_registradas = True
+    return buscar_con_plantilla(obtener_es(), indice, TEMPLATE_ID, parametros)
+
 def buscar_en_elasticsearch(consulta: dict):
-    resultados = es.search(index=indice, body=consulta)
+    resultados = obtener_es().search(index=indice, body=consulta, source_includes=CAMPOS_PROMPT)
     return resultados
 
 def construir_prompt_multiple(resultados) -> str:
@@ -177,31 +265,73 @@ def construir_prompt_multiple(resultados) -> str:
 """
     return prompt.strip()
 
-def respuesta_natural(resultados) -> str:
-    try:        
-        respuesta = ollama.chat(
-                model=OLLAMA_MODEL,
-                messages=[{"role":"user", "content": resultados}],
-                options={"temperature": 0.1}, 
-            )
-    except requests.exceptions.RequestException as e:
+def generar_respuesta_stream(resultados):
+    """Devuelve los fragmentos de la respuesta a medida que los genera Ollama."""
+    yield from obtener_ollama().chat_stream([{"role": "user", "content": resultados}])
+
+def respuesta_natural_stream(resultados, callback=None) -> str:
+    """Muestra la respuesta según llega (o la pasa a callback) y devuelve el texto completo."""
+    consola = callback is None
+    callback = callback or (lambda fragmento: print(fragmento, end="", flush=True))
+    try:
+        respuesta, primer_token, total = consumir_stream(generar_respuesta_stream(resultados), callback)
+    except ErrorLLM as e:
         print(f"Error iniciando Ollama: {e}")
         return None
-    mensaje = respuesta.get("message", {})
-    if mensaje:
-        return mensaje.content.strip()
-    else:
+    if consola:
+        print(f"\n[primer token: {primer_token:.2f}s, total: {total:.2f}s]")
+    logging.info(f"Respuesta ({primer_token:.3f}s hasta el primer token, {total:.3f}s en total): {respuesta}")
+    return respuesta
+
+def respuesta_natural(resultados, stream: bool = False, callback=None) -> str:
+    if stream:
+        return respuesta_natural_stream(resultados, callback)
+    try:
+        respuesta = obtener_ollama().chat([{"role": "user", "content": resultados}])
+    except ErrorLLM as e:
+        print(f"Error iniciando Ollama: {e}")
         return None
+    return respuesta["contenido"] or None
     
 def main():
+    parser = argparse.ArgumentParser(description="Buscador de hoteles con Elasticsearch y Ollama.")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="Muestra cuánto ha tardado cada paso de importación e inicialización")
+    args = parser.parse_args()
+
+    iniciar_logging(OUT_DIRECTORY, LOG_JSON)
+    hilos_arranque = iniciar_en_segundo_plano()
+    perfil.marcar("prompt mostrado")
     pregunta_usuario = input("Pregunta sobre hoteles: ")
-    consulta = generar_consulta_llm(pregunta_usuario)
-    print("Consulta Elasticsearch generada:")
-    print(json.dumps(consulta, indent=2))
-    resultados = buscar_en_elasticsearch(consulta)
+    if args.startup_profile:
+        for hilo in hilos_arranque:
+            hilo.join()
+        print(perfil.informe())
+    # Con TEMPLATE_ID el LLM solo rellena los parámetros de una plantilla almacenada;
+    # si no consigue hacerlo se genera la consulta completa como antes
+    parametros = generar_parametros_llm(pregunta_usuario) if TEMPLATE_ID else None
+    if parametros:
+        resultados = buscar_con_plantilla_en_elasticsearch(parametros)
+    else:
+        consulta = generar_consulta_llm(pregunta_usuario)
+        if not consulta:
+            print("No se ha podido generar la consulta.")
+            return
+        print("Consulta Elasticsearch generada:")
+        print(json.dumps(consulta, indent=2))
+        if es_agregacion(consulta):
+            # Preguntas de cifras: la respuesta sale de las agregaciones, sin pasar por el LLM
+            print(respuesta_agregaciones(consulta, buscar_en_elasticsearch(cuerpo_agregaciones(consulta))))
+            return
+        resultados = buscar_en_elasticsearch(consulta)
     prompt_hoteles = construir_prompt_multiple(resultados)
-    respuesta = respuesta_natural(prompt_hoteles)
-    print(respuesta)
+    if STREAM_RESPUESTA:
+        respuesta_natural(prompt_hoteles, stream=True)
+    else:
+        respuesta = respuesta_natural(prompt_hoteles)
+        print(respuesta)
+
+perfil.marcar("import llm_local")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
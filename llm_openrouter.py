@@ -1,9 +1,14 @@
+import logging
 import os
 import json
-import re
 from elasticsearch import Elasticsearch
-from openai import OpenAI, APIError, APIStatusError, APIConnectionError, RateLimitError, AuthenticationError
 from dotenv import load_dotenv
+from backend_llm import BackendOpenRouter, ClienteLLM, ErrorLLM, consumir_stream
+from metricas import iniciar_logging
+from ejemplos import SelectorEjemplos
+from contexto_prompt import CAMPOS_PROMPT
+from agregaciones import cuerpo_agregaciones, es_agregacion, respuesta_agregaciones
+from esquema_consulta import extraer_json, mensajes_consulta
 
 load_dotenv()
 
@@ -16,6 +21,10 @@ OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
 OPENROUTER_API_BASE = os.getenv('OPENROUTER_API_BASE')
 OPENROUTER_SITE_URL = os.getenv('OPENROUTER_SITE_URL')
 OPENROUTER_MODEL = os.getenv('OPENROUTER_MODEL') 
+# Plazo, reintentos y petición de respaldo de las llamadas al modelo (ver backend_llm.py)
+LLM_PLAZO = float(os.getenv('LLM_PLAZO', '60'))
+LLM_REINTENTOS = int(os.getenv('LLM_REINTENTOS', '3'))
+LLM_HEDGE_SEGUNDOS = float(os.getenv('LLM_HEDGE_SEGUNDOS', '0'))
 
 
 # Conexión Elasticsearch
@@ -25,18 +34,20 @@ es.info()
 
 
 ES_INDEX = os.getenv('ES_INDEX')
+STREAM_RESPUESTA = os.getenv('STREAM_RESPUESTA', 'yes').lower() == 'yes'
+
+# Directorio del fichero de log (si no se define, los logs van a la consola) y formato JSON
+OUT_DIRECTORY = os.getenv('OUT_DIRECTORY')
+LOG_JSON = os.getenv('LOG_JSON', 'no').lower() == 'yes'
 
 
 indice = ES_INDEX
 
 
- # Inicialización del cliente OpenAI para OpenRouter
-openai_client = OpenAI(
-    base_url=OPENROUTER_API_BASE,
-    api_key=OPENROUTER_API_KEY,
-    default_headers={ 
-        "HTTP-Referer": OPENROUTER_SITE_URL
-    }
+ # Inicialización del cliente OpenAI para OpenRouter (la conexión se abre en la primera llamada)
+cliente_llm = ClienteLLM(
+    [BackendOpenRouter(OPENROUTER_MODEL, OPENROUTER_API_BASE, OPENROUTER_API_KEY, OPENROUTER_SITE_URL, timeout=LLM_PLAZO)],
+    reintentos=LLM_REINTENTOS, plazo=LLM_PLAZO, hedge_segundos=LLM_HEDGE_SEGUNDOS
 )
 
 FEW_SHOT_PROMPT = """
@@ -51,6 +62,8 @@ Esquema:
 - descripcion: text
 - precio: integer
 - fechaEntrada: date (yyyy-MM-dd)
+- opinion: float
+- comentarios: integer
 
 Ejemplo 1:
 Pregunta: "Muéstrame hoteles en Aguadulce con piscina y parking, ordenados por precio ascendente para el día 01/06/2025."
@@ -108,36 +121,36 @@ Ahora, genera SOLO la consulta JSON para esta pregunta:
 "{pregunta}"
 """
 
+# Ejemplos few-shot dinámicos: solo los EJEMPLOS_K más parecidos a la pregunta (ver ejemplos.py)
+EJEMPLOS_DINAMICOS = os.getenv('EJEMPLOS_DINAMICOS', 'yes').lower() == 'yes'
+EJEMPLOS_FICHERO = os.getenv('EJEMPLOS_FICHERO', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ejemplos_consultas.jsonl'))
+EJEMPLOS_K = int(os.getenv('EJEMPLOS_K', '3'))
+selector_ejemplos = (SelectorEjemplos.desde_fichero(EJEMPLOS_FICHERO)
+                     if EJEMPLOS_DINAMICOS and os.path.exists(EJEMPLOS_FICHERO) else None)
+
 def extraer_json_valido(texto):
     """Extrae y parsea el primer bloque JSON válido de un string."""
-    try:
-        match = re.search(r'\{.*\}', texto, re.DOTALL)
-        if not match:
-            raise ValueError("No se encontró bloque JSON.")
-        return json.loads(match.group())
-    except json.JSONDecodeError as e:
-        print("⚠️ Error al parsear JSON:", e)
+    consulta = extraer_json(texto)
+    if consulta is None:
+        print("⚠️ Error al parsear JSON: no se encontró un objeto JSON válido.")
         print("Respuesta raw:\n", texto)
-        return None
+    return consulta
 
 def generar_consulta_llm(pregunta: str) -> dict:
-    prompt = FEW_SHOT_PROMPT.replace("{pregunta}", pregunta)
-    respuesta = openai_client.chat.completions.create(
-                model=OPENROUTER_MODEL,
-                messages=[{"role":"user", "content": prompt}],
-                timeout=60 
-            )
-    if respuesta.choices and respuesta.choices[0].message:
-      contenido = respuesta.choices[0].message.content
-    else:
-      print("Error: No se ha obtenido mensaje desde OpenRouter.")
+    mensajes = (selector_ejemplos.mensajes(FEW_SHOT_PROMPT, pregunta, EJEMPLOS_K) if selector_ejemplos
+                else mensajes_consulta(FEW_SHOT_PROMPT, pregunta))
+    try:
+        contenido = cliente_llm.chat(mensajes)["contenido"]
+    except ErrorLLM as e:
+        print(f"Error: No se ha obtenido mensaje desde OpenRouter: {e}")
+        return None
     consulta = extraer_json_valido(contenido)
     print("Respuesta raw del LLM:")
     print(consulta)
     return consulta
 
 def buscar_en_elasticsearch(consulta: dict):
-    resultados = es.search(index=indice, body=consulta)
+    resultados = es.search(index=indice, body=consulta, source_includes=CAMPOS_PROMPT)
     return resultados
 
 def resumen_resultados(resultados) -> str:
@@ -180,31 +193,53 @@ def construir_prompt_multiple(resultados) -> str:
 """
     return prompt.strip()
 
-def respuesta_natural(resultados) -> str:
+def generar_respuesta_stream(resultados):
+    """Devuelve los fragmentos de la respuesta a medida que los genera OpenRouter."""
+    yield from cliente_llm.chat_stream([{"role": "user", "content": resultados}])
+
+def respuesta_natural_stream(resultados, callback=None) -> str:
+    """Muestra la respuesta según llega (o la pasa a callback) y devuelve el texto completo."""
+    consola = callback is None
+    callback = callback or (lambda fragmento: print(fragmento, end="", flush=True))
     try:
-        respuesta = openai_client.chat.completions.create(
-            model=OPENROUTER_MODEL,
-            messages=[{"role": "user", "content": resultados}],
-            timeout=60
-        )
-        if respuesta.choices and respuesta.choices[0].message:
-            return respuesta.choices[0].message.content
-        else:
-            print("Error: No se ha obtenido mensajes desde OpenRouter.")
-            return None
+        respuesta, primer_token, total = consumir_stream(generar_respuesta_stream(resultados), callback)
     except Exception as e:
         print(f"Error al llamar al modelo: {e}")
         return None
+    if consola:
+        print(f"\n[primer token: {primer_token:.2f}s, total: {total:.2f}s]")
+    logging.info(f"Respuesta ({primer_token:.3f}s hasta el primer token, {total:.3f}s en total): {respuesta}")
+    return respuesta
+
+def respuesta_natural(resultados, stream: bool = False, callback=None) -> str:
+    if stream:
+        return respuesta_natural_stream(resultados, callback)
+    try:
+        return cliente_llm.chat([{"role": "user", "content": resultados}])["contenido"]
+    except ErrorLLM as e:
+        print(f"Error al llamar al modelo: {e}")
+        return None
     
 def main():
+    iniciar_logging(OUT_DIRECTORY, LOG_JSON)
     pregunta_usuario = input("Pregunta sobre hoteles: ")
     consulta = generar_consulta_llm(pregunta_usuario)
+    if not consulta:
+        print("No se ha podido generar la consulta.")
+        return
     print("Consulta Elasticsearch generada:")
     print(json.dumps(consulta, indent=2))
+    if es_agregacion(consulta):
+        # Preguntas de cifras: la respuesta sale de las agregaciones, sin pasar por el LLM
+        print(respuesta_agregaciones(consulta, buscar_en_elasticsearch(cuerpo_agregaciones(consulta))))
+        return
     resultados = buscar_en_elasticsearch(consulta)
     prompt_hoteles = construir_prompt_multiple(resultados)
-    respuesta = respuesta_natural(prompt_hoteles)
-    print(respuesta)
+    if STREAM_RESPUESTA:
+        respuesta_natural(prompt_hoteles, stream=True)
+    else:
+        respuesta = respuesta_natural(prompt_hoteles)
+        print(respuesta)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
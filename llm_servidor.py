@@ -0,0 +1,225 @@
+import argparse
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import llm
+from metricas import metricas
+
+# Palabras que cierran el modo interactivo
+SALIR = {"salir", "exit", "quit"}
+
+# Paginadores pendientes de "ver más" en el modo HTTP, por cursor. Se descartan pasado el keep_alive del PIT
+PAGINADORES_TTL = 300
+_paginadores = {}
+_lock_paginadores = threading.Lock()
+
+
+def guardar_paginador(cursor: str, paginador):
+    with _lock_paginadores:
+        _purgar_paginadores()
+        _paginadores[cursor] = (paginador, time.monotonic())
+
+
+def tomar_paginador(cursor: str):
+    with _lock_paginadores:
+        _purgar_paginadores()
+        entrada = _paginadores.get(cursor)
+        if entrada is None:
+            return None
+        _paginadores[cursor] = (entrada[0], time.monotonic())
+        return entrada[0]
+
+
+def soltar_paginador(cursor: str):
+    with _lock_paginadores:
+        entrada = _paginadores.pop(cursor, None)
+    if entrada:
+        entrada[0].cerrar()
+
+
+def _purgar_paginadores():
+    limite = time.monotonic() - PAGINADORES_TTL
+    for cursor, (paginador, usado) in list(_paginadores.items()):
+        if usado < limite:
+            del _paginadores[cursor]
+            paginador.cerrar()
+
+
+def bucle_interactivo():
+    print("Escribe una pregunta sobre hoteles ('salir' para terminar).")
+    while True:
+        try:
+            pregunta = input("\nPregunta sobre hoteles: ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+        if not pregunta:
+            continue
+        if pregunta.lower() in SALIR:
+            break
+        try:
+            if llm.STREAM_RESPUESTA:
+                print("\nRespuesta:")
+                resultado = llm.responder(pregunta, stream=True)
+                print()
+            else:
+                resultado = llm.responder(pregunta)
+                print("\nRespuesta:\n", resultado["respuesta"])
+            print(f"({resultado.get('segundos', 0):.2f}s)")
+            if resultado.get("paginador"):
+                llm.ofrecer_mas(resultado["paginador"])
+        except Exception as e:
+            logging.error(f"Error procesando la pregunta: {e}")
+            print(f"Error procesando la pregunta: {e}")
+
+
+class ManejadorPreguntas(BaseHTTPRequestHandler):
+    """POST /preguntar con {"pregunta": "..."}; con ?stream=1 la respuesta se envía por fragmentos.
+
+    Si hay más resultados, la respuesta lleva un cursor (también en la cabecera X-Cursor) y
+    POST /mas con {"cursor": "..."} describe la página siguiente.
+    GET /metrics devuelve las métricas de las etapas en formato Prometheus.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, formato, *args):
+        logging.info("HTTP %s - " + formato, self.address_string(), *args)
+
+    def enviar_json(self, estado: int, datos: dict):
+        cuerpo = json.dumps(datos, ensure_ascii=False).encode("utf-8")
+        self.send_response(estado)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/salud":
+            self.enviar_json(200, {"estado": "ok"})
+        elif urlparse(self.path).path == "/metrics":
+            cuerpo = metricas.exportar().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+        else:
+            self.enviar_json(404, {"error": "Ruta no encontrada"})
+
+    def leer_campo(self, campo: str):
+        try:
+            longitud = int(self.headers.get("Content-Length", 0))
+            valor = json.loads(self.rfile.read(longitud) or b"{}").get(campo, "").strip()
+        except (ValueError, AttributeError):
+            self.enviar_json(400, {"error": f"Se esperaba un JSON con el campo '{campo}'"})
+            return None
+        if not valor:
+            self.enviar_json(400, {"error": f"Falta el campo '{campo}'"})
+            return None
+        return valor
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ("/preguntar", "/mas"):
+            self.enviar_json(404, {"error": "Ruta no encontrada"})
+            return
+        valor = self.leer_campo("pregunta" if url.path == "/preguntar" else "cursor")
+        if valor is None:
+            return
+
+        if url.path == "/preguntar":
+            # El cursor se decide antes de responder para poder enviarlo en la cabecera del streaming
+            cursor = uuid.uuid4().hex
+            ejecutar = lambda **kwargs: self.preguntar(valor, cursor, **kwargs)
+        else:
+            cursor = valor
+            paginador = tomar_paginador(cursor)
+            if paginador is None:
+                self.enviar_json(404, {"error": "Cursor desconocido, caducado o sin más resultados"})
+                return
+            ejecutar = lambda **kwargs: self.mas(paginador, cursor, **kwargs)
+
+        if parse_qs(url.query).get("stream", ["0"])[0] in ("1", "true", "yes"):
+            self.responder_stream(ejecutar, cursor)
+            return
+        try:
+            self.enviar_json(200, ejecutar())
+        except Exception as e:
+            logging.error(f"Error procesando la pregunta: {e}")
+            self.enviar_json(500, {"error": str(e)})
+
+    def preguntar(self, pregunta: str, cursor: str, **kwargs) -> dict:
+        resultado = llm.responder(pregunta, **kwargs)
+        paginador = resultado.pop("paginador", None)
+        if paginador is not None:
+            guardar_paginador(cursor, paginador)
+            resultado["cursor"] = cursor
+        return resultado
+
+    def mas(self, paginador, cursor: str, **kwargs) -> dict:
+        resultado = llm.ver_mas(paginador, **kwargs)
+        if resultado["hay_mas"]:
+            resultado["cursor"] = cursor
+        else:
+            soltar_paginador(cursor)
+        return resultado
+
+    def responder_stream(self, ejecutar, cursor: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        # Solo sirve para POST /mas si la respuesta resulta tener más páginas
+        self.send_header("X-Cursor", cursor)
+        self.end_headers()
+
+        def enviar_fragmento(fragmento: str):
+            datos = fragmento.encode("utf-8")
+            self.wfile.write(f"{len(datos):X}\r\n".encode() + datos + b"\r\n")
+            self.wfile.flush()
+
+        try:
+            ejecutar(stream=True, callback=enviar_fragmento)
+        except Exception as e:
+            logging.error(f"Error procesando la pregunta: {e}")
+            enviar_fragmento(f"\nError: {e}")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def servir_http(host: str, puerto: int):
+    servidor = ThreadingHTTPServer((host, puerto), ManejadorPreguntas)
+    servidor.daemon_threads = True
+    print(f"Servidor escuchando en http://{host}:{puerto} (POST /preguntar, POST /mas)")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Modo residente: reutiliza los clientes de Elasticsearch y del LLM entre preguntas.")
+    parser.add_argument("--http", action="store_true", help="Sirve las preguntas por HTTP en lugar del modo interactivo")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8000)
+    args = parser.parse_args()
+
+    llm.configurar_logging()
+    hilos_arranque = llm.iniciar_en_segundo_plano()
+    if args.http:
+        # Antes de aceptar peticiones se espera a que los clientes estén listos
+        for hilo in hilos_arranque:
+            hilo.join()
+        servir_http(args.host, args.puerto)
+    else:
+        bucle_interactivo()
+
+
+if __name__ == "__main__":
+    main()
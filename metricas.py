@@ -0,0 +1,250 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Límites (en segundos) de los buckets de los histogramas de latencia
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Campos estándar de LogRecord que no se copian al JSON
+_CAMPOS_LOGRECORD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class Metricas:
+    """Registro en memoria de contadores e histogramas con exportación en formato de texto de Prometheus."""
+
+    def __init__(self, prefijo: str = "hoteles"):
+        self.prefijo = prefijo
+        self._contadores = {}
+        self._histogramas = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _clave(nombre: str, etiquetas: dict):
+        return nombre, tuple(sorted((etiquetas or {}).items()))
+
+    def incrementar(self, nombre: str, valor: float = 1, **etiquetas):
+        clave = self._clave(nombre, etiquetas)
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def observar(self, nombre: str, valor: float, **etiquetas):
+        clave = self._clave(nombre, etiquetas)
+        with self._lock:
+            histograma = self._histogramas.setdefault(clave, {"buckets": [0] * len(BUCKETS_SEGUNDOS), "suma": 0.0, "cuenta": 0})
+            for i, limite in enumerate(BUCKETS_SEGUNDOS):
+                if valor <= limite:
+                    histograma["buckets"][i] += 1
+            histograma["suma"] += valor
+            histograma["cuenta"] += 1
+
+    @staticmethod
+    def _etiquetas(etiquetas, extra: str = "") -> str:
+        partes = [f'{k}="{v}"' for k, v in etiquetas] + ([extra] if extra else [])
+        return "{" + ",".join(partes) + "}" if partes else ""
+
+    def exportar(self) -> str:
+        lineas = []
+        with self._lock:
+            contadores = dict(self._contadores)
+            histogramas = {k: dict(v, buckets=list(v["buckets"])) for k, v in self._histogramas.items()}
+        tipos_emitidos = set()
+        for (nombre, etiquetas), valor in sorted(contadores.items()):
+            completo = f"{self.prefijo}_{nombre}"
+            if completo not in tipos_emitidos:
+                lineas.append(f"# TYPE {completo} counter")
+                tipos_emitidos.add(completo)
+            lineas.append(f"{completo}{self._etiquetas(etiquetas)} {valor}")
+        for (nombre, etiquetas), histograma in sorted(histogramas.items()):
+            completo = f"{self.prefijo}_{nombre}"
+            if completo not in tipos_emitidos:
+                lineas.append(f"# TYPE {completo} histogram")
+                tipos_emitidos.add(completo)
+            for limite, cuenta in zip(BUCKETS_SEGUNDOS, histograma["buckets"]):
+                etiquetas_bucket = self._etiquetas(etiquetas, 'le="%s"' % limite)
+                lineas.append(f"{completo}_bucket{etiquetas_bucket} {cuenta}")
+            etiquetas_bucket = self._etiquetas(etiquetas, 'le="+Inf"')
+            lineas.append(f"{completo}_bucket{etiquetas_bucket} {histograma['cuenta']}")
+            lineas.append(f"{completo}_sum{self._etiquetas(etiquetas)} {histograma['suma']}")
+            lineas.append(f"{completo}_count{self._etiquetas(etiquetas)} {histograma['cuenta']}")
+        return "\n".join(lineas) + "\n"
+
+
+metricas = Metricas()
+
+
+@contextmanager
+def etapa(nombre: str, **campos):
+    """Mide una etapa del flujo, la registra en las métricas y escribe un log estructurado.
+
+    El diccionario devuelto admite campos adicionales (tokens, took de ES, hits, caché...):
+    los que se reconocen alimentan también sus métricas.
+    """
+    datos = dict(campos)
+    inicio = time.perf_counter()
+    error = None
+    try:
+        yield datos
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        segundos = time.perf_counter() - inicio
+        datos["segundos"] = round(segundos, 4)
+        metricas.observar("etapa_segundos", segundos, etapa=nombre)
+        if error is not None:
+            datos["error"] = str(error)
+        if datos.get("error"):
+            metricas.incrementar("errores_total", etapa=nombre)
+        if datos.get("origen"):
+            metricas.incrementar("origen_total", etapa=nombre, origen=datos["origen"])
+        for tipo in ("prompt", "completion"):
+            if datos.get(f"tokens_{tipo}"):
+                metricas.incrementar("tokens_total", datos[f"tokens_{tipo}"], etapa=nombre, tipo=tipo)
+        if datos.get("tokens_prompt_cacheados"):
+            metricas.incrementar("tokens_total", datos["tokens_prompt_cacheados"], etapa=nombre, tipo="prompt_cacheado")
+        if datos.get("tokens_prompt_cacheados") is not None:
+            metricas.incrementar("cache_total", cache=f"prefijo_{nombre}",
+                                 resultado="acierto" if datos["tokens_prompt_cacheados"] else "fallo")
+        if datos.get("prefill_segundos") is not None:
+            metricas.observar("prefill_segundos", datos["prefill_segundos"], etapa=nombre)
+        if datos.get("tokens_ahorrados"):
+            metricas.incrementar("tokens_ahorrados_total", datos["tokens_ahorrados"], etapa=nombre)
+        if datos.get("es_took_ms") is not None:
+            metricas.observar("es_took_segundos", datos["es_took_ms"] / 1000)
+        if datos.get("hits") is not None:
+            metricas.incrementar("es_hits_total", datos["hits"])
+        if datos.get("cache") is not None:
+            metricas.incrementar("cache_total", cache=nombre, resultado="acierto" if datos["cache"] else "fallo")
+        if datos.get("primer_token_segundos") is not None:
+            metricas.observar("primer_token_segundos", datos["primer_token_segundos"], etapa=nombre)
+        logging.info(f"Etapa {nombre}", extra={"etapa": nombre, "metricas": datos})
+
+
+def uso_openai(respuesta) -> dict:
+    """Tokens de la respuesta de OpenAI/OpenRouter (campo usage)."""
+    uso = getattr(respuesta, "usage", None)
+    if not uso:
+        return {}
+    datos = {"tokens_prompt": uso.prompt_tokens, "tokens_completion": uso.completion_tokens}
+    detalles = getattr(uso, "prompt_tokens_details", None)
+    if detalles and getattr(detalles, "cached_tokens", None) is not None:
+        datos["tokens_prompt_cacheados"] = detalles.cached_tokens
+    return datos
+
+
+def uso_ollama(respuesta) -> dict:
+    """Tokens de la respuesta de Ollama (prompt_eval_count / eval_count) y tiempo de procesar el prompt.
+
+    Ollama no informa de los tokens reutilizados de la caché KV: prompt_eval_count solo cuenta
+    los que ha evaluado, así que un prefijo reutilizado se ve como menos tokens y menos prefill.
+    """
+    try:
+        datos = {"tokens_prompt": respuesta["prompt_eval_count"], "tokens_completion": respuesta["eval_count"]}
+    except (KeyError, TypeError):
+        return {}
+    try:
+        if respuesta["prompt_eval_duration"]:
+            datos["prefill_segundos"] = round(respuesta["prompt_eval_duration"] / 1e9, 4)
+    except (KeyError, TypeError):
+        pass
+    return datos
+
+
+class FormatoJSON(logging.Formatter):
+    """Escribe cada registro como una línea JSON, incluidos los campos pasados con extra=."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        datos = {
+            "timestamp": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        for clave, valor in vars(record).items():
+            if clave not in _CAMPOS_LOGRECORD:
+                datos[clave] = valor
+        if record.exc_info:
+            datos["excepcion"] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class FormatoTexto(logging.Formatter):
+    """Formato de texto que añade al mensaje, en JSON compacto, los datos de la etapa (extra metricas=)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        texto = super().format(record)
+        datos = getattr(record, "metricas", None)
+        if datos:
+            texto += " " + json.dumps(datos, ensure_ascii=False, separators=(",", ":"), default=str)
+        return texto
+
+
+def iniciar_logging(directorio: str = None, formato_json: bool = False):
+    """Logs de nivel INFO en directorio/chatbot_<fecha>.log (o en consola si no hay directorio o no se
+    puede escribir en él), en texto o JSON. Si ya están configurados no hace nada."""
+    full_log_path = None
+    if directorio:
+        # Ruta a fichero logging
+        log_filename = f"chatbot_{datetime.now().strftime('%Y%m%d')}.log"
+        full_log_path = os.path.join(directorio, log_filename)
+
+        #Crea el directorio de salida en caso de que no exista
+        if not os.path.exists(directorio):
+            os.makedirs(directorio)
+
+        try:
+            # Intenta abrir el fichero en modo append para comprobar los permisos de escritura
+            # y se asegura de que el manejador del fichero se cierre inmediatamente después de la comprobación.
+            with open(full_log_path, 'a') as f:
+                pass
+        except IOError as e:
+            print(f"Warning: No se puede escribir en {full_log_path}. Revise los permisos de escritura. Error: {e}")
+            full_log_path = None
+
+    # El fichero se escribe desde un hilo aparte (QueueListener) para no bloquear el flujo de la pregunta
+    raiz = logging.getLogger()
+    if any(isinstance(h, logging.handlers.QueueHandler) for h in raiz.handlers):
+        return
+    manejador = logging.FileHandler(full_log_path) if full_log_path else logging.StreamHandler()
+    if formato_json:
+        manejador.setFormatter(FormatoJSON())
+    else:
+        manejador.setFormatter(FormatoTexto('%(asctime)s - CHATBOT - %(levelname)s - %(message)s'))
+    cola = queue.SimpleQueue()
+    raiz.addHandler(logging.handlers.QueueHandler(cola))
+    raiz.setLevel(logging.INFO)
+    oyente = logging.handlers.QueueListener(cola, manejador)
+    oyente.start()
+    atexit.register(oyente.stop)
+
+
+class ManejadorMetricas(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        cuerpo = metricas.exportar().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+
+def servir_metricas(puerto: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Arranca en segundo plano un endpoint GET /metrics en formato Prometheus."""
+    servidor = ThreadingHTTPServer((host, puerto), ManejadorMetricas)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="metricas", daemon=True).start()
+    return servidor
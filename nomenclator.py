@@ -0,0 +1,184 @@
+import json
+import logging
+import re
+import threading
+
+from normalizacion import quitar_acentos, texto_plano
+
+# Lugares conocidos que no salen del índice (lat, lon). Se pueden ampliar con un fichero JSON
+# {"nombre": [lat, lon], ...} (ver NOMENCLATOR_FICHERO en llm.py)
+LUGARES = {
+    "alhambra": (37.1761, -3.5881),
+    "sagrada familia": (41.4036, 2.1744),
+    "parque guell": (41.4145, 2.1527),
+    "mezquita de cordoba": (37.8789, -4.7794),
+    "giralda": (37.3862, -5.9926),
+    "catedral de sevilla": (37.3858, -5.9931),
+    "puerta del sol": (40.4169, -3.7035),
+    "plaza mayor de madrid": (40.4155, -3.7074),
+    "museo del prado": (40.4138, -3.6921),
+    "acueducto de segovia": (40.9480, -4.1184),
+    "catedral de burgos": (42.3405, -3.7044),
+    "catedral de santiago": (42.8806, -8.5446),
+    "ciudad de las artes y las ciencias": (39.4546, -0.3506),
+    "museo guggenheim": (43.2687, -2.9340),
+    "alcazaba de almeria": (36.8417, -2.4700),
+    "caminito del rey": (36.9156, -4.7870),
+    "aeropuerto de madrid": (40.4983, -3.5676),
+    "aeropuerto de barcelona": (41.2974, 2.0833),
+    "aeropuerto de malaga": (36.6749, -4.4991),
+}
+
+# Radio por defecto de "cerca de X" según lo que sea X
+DISTANCIA_KM = {"lugar": 3, "localidad": 10, "provincia": 30}
+# Prioridad cuando un nombre es a la vez lugar, localidad y provincia (Granada, Málaga...)
+PRIORIDAD = {"lugar": 0, "localidad": 1, "provincia": 2}
+
+_ARTICULOS = {"el", "la", "los", "las"}
+_FIN_LUGAR = {"con", "para", "que", "disponible", "disponibles", "ordenados", "ordenadas"}
+_MAXIMO_PALABRAS = 10
+_DISTANCIA = re.compile(
+    r"\b(?:a\s+menos\s+de|como\s+mucho\s+a|a\s+un\s+maximo\s+de|hasta|a(?:\s+unos?)?)\s+(\d+(?:[.,]\d+)?)\s*"
+    r"(km|kms|kilometros?|m|metros?)\s+(?:de|del)\s+"
+)
+_CERCA = re.compile(r"\b(?:cerca|cercan[oa]s?|proxim[oa]s?|junto|al\s+lado)\s+(?:de|del|a|al)\s+")
+_PALABRA = re.compile(r"\s*([^\s,.;:¿?¡!]+)")
+
+
+def normalizar_lugar(texto: str) -> str:
+    palabras = quitar_acentos(texto.lower()).split()
+    while palabras and palabras[0] in _ARTICULOS:
+        palabras.pop(0)
+    return " ".join(palabras)
+
+
+class Nomenclator:
+    """Coordenadas de localidades, provincias y lugares conocidos, en memoria."""
+
+    def __init__(self, lugares: dict = None):
+        self._entradas = {}
+        self._provincias = {}
+        self._localidades = set()
+        self._lock = threading.Lock()
+        self.agregar(lugares if lugares is not None else LUGARES, "lugar")
+
+    def agregar(self, lugares: dict, tipo: str, provincias: dict = None):
+        """provincias, si se pasa, dice a qué provincia pertenece cada nombre de lugares."""
+        with self._lock:
+            for nombre, (lat, lon) in lugares.items():
+                clave = normalizar_lugar(nombre)
+                if not clave:
+                    continue
+                if provincias and provincias.get(nombre):
+                    self._provincias[clave] = provincias[nombre]
+                if tipo != "lugar":
+                    self._localidades.add(clave)
+                actual = self._entradas.get(clave)
+                if actual is None or PRIORIDAD[tipo] <= PRIORIDAD[actual["tipo"]]:
+                    self._entradas[clave] = {"nombre": nombre, "lat": lat, "lon": lon, "tipo": tipo}
+
+    def cargar_fichero(self, ruta: str):
+        with open(ruta, encoding="utf-8") as f:
+            self.agregar(json.load(f), "lugar")
+
+    def cargar_desde_indice(self, es, indice: str, maximo: int = 10000):
+        """Centroide de los hoteles de cada localidad y provincia (terms + geo_centroid).
+
+        De cada localidad se guarda también su provincia más frecuente (ver provincia_de).
+        """
+        agregaciones = {
+            campo: {
+                "terms": {"field": f"{campo}.keyword", "size": maximo},
+                "aggs": {"centro": {"geo_centroid": {"field": "location"}}},
+            }
+            for campo in ("localidad", "provincia")
+        }
+        agregaciones["localidad"]["aggs"]["provincia"] = {"terms": {"field": "provincia.keyword", "size": 1}}
+        respuesta = es.search(index=indice, size=0, aggs=agregaciones)
+        for campo in ("localidad", "provincia"):
+            lugares = {}
+            provincias = {}
+            for cubo in respuesta.get("aggregations", {}).get(campo, {}).get("buckets", []):
+                centro = cubo.get("centro", {}).get("location")
+                if centro:
+                    lugares[cubo["key"]] = (centro["lat"], centro["lon"])
+                provincia = cubo.get("provincia", {}).get("buckets", [])
+                if provincia:
+                    provincias[cubo["key"]] = provincia[0]["key"]
+            self.agregar(lugares, campo, provincias)
+        logging.info(f"Nomenclátor cargado: {len(self)} nombres")
+
+    def buscar(self, nombre: str):
+        return self._entradas.get(normalizar_lugar(nombre))
+
+    def es_localidad(self, nombre: str) -> bool:
+        """Si nombre es una localidad o provincia del índice (no un lugar como "la Alhambra")."""
+        return normalizar_lugar(nombre) in self._localidades
+
+    def provincia_de(self, localidad: str):
+        """Provincia de una localidad del índice, o None si no se conoce."""
+        return self._provincias.get(normalizar_lugar(localidad))
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def extraer_cercania(self, pregunta: str):
+        """Reconoce "cerca de X" o "a menos de N km de X" con X en el nomenclátor.
+
+        Devuelve {"lugar", "lat", "lon", "km", "resto"}, donde resto es la pregunta sin esa
+        parte, o None si no hay ninguna o X no es un lugar conocido.
+        """
+        plano = texto_plano(pregunta)
+        for patron in (_DISTANCIA, _CERCA):
+            for m in patron.finditer(plano):
+                palabras = []
+                posicion = m.end()
+                while (len(palabras) < _MAXIMO_PALABRAS and (p := _PALABRA.match(plano, posicion))
+                       and p.group(1) not in _FIN_LUGAR):
+                    palabras.append(p)
+                    posicion = p.end()
+                # El nombre más largo que esté en el nomenclátor ("mezquita de cordoba" antes que "mezquita")
+                for n in range(len(palabras), 0, -1):
+                    entrada = self.buscar(plano[m.end():palabras[n - 1].end()])
+                    if entrada:
+                        break
+                else:
+                    continue
+                km = DISTANCIA_KM[entrada["tipo"]]
+                if patron is _DISTANCIA:
+                    km = float(m.group(1).replace(",", "."))
+                    if m.group(2).startswith("m") and not m.group(2).startswith("km"):
+                        km /= 1000
+                resto = re.sub(r"\s+", " ", pregunta[:m.start()] + pregunta[palabras[n - 1].end():])
+                resto = re.sub(r"\s+(?=[,.;:?!])", "", resto).strip(" ,")
+                return {"lugar": entrada["nombre"], "lat": entrada["lat"], "lon": entrada["lon"], "km": km,
+                        "resto": resto}
+        return None
+
+
+def aplicar_cercania(consulta: dict, cercania: dict, campo: str = "location") -> dict:
+    """Añade a la consulta un filtro geo_distance y el orden por distancia.
+
+    El filtro va en contexto filter (sin puntuación), así Elasticsearch puede cachearlo, y lleva
+    el lugar como _name para poder describirlo (ver agregaciones.describir_filtros). Si la consulta
+    ya tenía un orden (por precio, por ejemplo) la distancia queda como segundo criterio; si solo
+    pide agregaciones no se ordena, porque no devuelve hoteles.
+    """
+    punto = {"lat": cercania["lat"], "lon": cercania["lon"]}
+    filtro = {"geo_distance": {"distance": f"{cercania['km']:g}km", campo: punto, "_name": cercania["lugar"]}}
+    query = consulta.get("query") or {"match_all": {}}
+    if "bool" in query:
+        booleana = dict(query["bool"])
+        anteriores = booleana.get("filter", [])
+        booleana["filter"] = (anteriores if isinstance(anteriores, list) else [anteriores]) + [filtro]
+        query = {"bool": booleana}
+    elif "match_all" in query:
+        query = {"bool": {"filter": [filtro]}}
+    else:
+        query = {"bool": {"must": [query], "filter": [filtro]}}
+    if "aggs" in consulta or consulta.get("size") == 0:
+        return {**consulta, "query": query}
+    orden = consulta.get("sort") or []
+    orden = (orden if isinstance(orden, list) else [orden]) + [
+        {"_geo_distance": {campo: punto, "order": "asc", "unit": "km"}}]
+    return {**consulta, "query": query, "sort": orden}
@@ -0,0 +1,107 @@
+import re
+import unicodedata
+from datetime import date, timedelta
+
+MESES = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6,
+    "julio": 7, "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10,
+    "noviembre": 11, "diciembre": 12,
+}
+
+FECHA_NUMERICA = re.compile(r"\b(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{4})\b")
+FECHA_ISO = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+FECHA_TEXTO = re.compile(r"\b(\d{1,2})\s+de\s+(" + "|".join(MESES) + r")(?:\s+(?:de|del)\s+(\d{4}))?\b")
+
+# Estancias: "del 1 al 7 de junio de 2025", "entre el 30 de junio y el 2 de julio de 2025",
+# "desde el 01/06/2025 hasta el 07/06/2025". El año (y el mes) del final valen para el inicio
+_DESDE = r"\b(?:del|desde\s+el|entre\s+el)\s+(?:dia\s+)?"
+_HASTA = r"\s+(?:al|hasta\s+el|y\s+el)\s+(?:dia\s+)?"
+_MES = "(" + "|".join(MESES) + ")"
+RANGO_TEXTO = re.compile(
+    _DESDE + r"(\d{1,2})(?:\s+de\s+" + _MES + r")?" + _HASTA + r"(\d{1,2})\s+de\s+" + _MES + r"\s+(?:de|del)\s+(\d{4})\b"
+)
+_FECHA_COMPLETA = (r"(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[/\-.]\d{1,2}[/\-.]\d{4}|\d{1,2}\s+de\s+(?:" + "|".join(MESES)
+                   + r")\s+(?:de|del)\s+\d{4})")
+RANGO_FECHAS = re.compile(_DESDE + _FECHA_COMPLETA + _HASTA + _FECHA_COMPLETA + r"\b")
+
+
+def quitar_acentos(texto: str) -> str:
+    descompuesto = unicodedata.normalize("NFKD", texto)
+    return "".join(c for c in descompuesto if not unicodedata.combining(c))
+
+
+def texto_plano(texto: str) -> str:
+    """Minúsculas y sin acentos conservando la posición de cada carácter."""
+    return "".join(c2 if len(c2) == 1 else c for c, c2 in ((c, quitar_acentos(c)) for c in texto.lower()))
+
+
+def fecha_iso(dia, mes, anio) -> str:
+    return f"{int(anio):04d}-{int(mes):02d}-{int(dia):02d}"
+
+
+def buscar_fechas(texto: str) -> list:
+    """Devuelve (inicio, fin, aaaa-mm-dd) de cada fecha completa del texto (en minúsculas y sin acentos)."""
+    fechas = []
+    for patron, orden in ((FECHA_ISO, (3, 2, 1)), (FECHA_NUMERICA, (1, 2, 3)), (FECHA_TEXTO, (1, 2, 3))):
+        for m in patron.finditer(texto):
+            dia, mes, anio = (m.group(i) for i in orden)
+            if anio is None:
+                continue
+            fechas.append((m.start(), m.end(), fecha_iso(dia, MESES.get(mes, mes), anio)))
+    return sorted(fechas)
+
+
+def _fecha_valida(dia, mes, anio):
+    try:
+        return date(int(anio), int(mes), int(dia))
+    except ValueError:
+        return None
+
+
+def buscar_rangos(texto: str) -> list:
+    """Devuelve (inicio, fin, entrada, salida) de cada estancia del texto, con fechas aaaa-mm-dd.
+
+    La salida es el día en que se deja el hotel: "del 1 al 7 de junio" son las noches del 1 al 6,
+    mientras que "entre el 1 y el 5 de agosto" incluye la noche del 5 (la salida es el 6).
+    """
+    rangos = []
+    for m in RANGO_TEXTO.finditer(texto):
+        dia_entrada, mes_entrada, dia_salida, mes_salida, anio = m.groups()
+        salida = _fecha_valida(dia_salida, MESES[mes_salida], anio)
+        entrada = _fecha_valida(dia_entrada, MESES[mes_entrada or mes_salida], anio)
+        if entrada and salida and entrada > salida:
+            # "del 28 de diciembre al 3 de enero de 2026": la entrada es del año anterior
+            entrada = _fecha_valida(dia_entrada, MESES[mes_entrada or mes_salida], int(anio) - 1)
+        rangos.append((m.start(), m.end(), entrada, salida))
+    for m in RANGO_FECHAS.finditer(texto):
+        extremos = [buscar_fechas(m.group(i)) for i in (1, 2)]
+        if all(extremos):
+            entrada, salida = (_fecha_valida(*reversed(e[0][2].split("-"))) for e in extremos)
+            rangos.append((m.start(), m.end(), entrada, salida))
+    return sorted((inicio, fin, entrada.isoformat(),
+                   (salida + timedelta(days=1) if texto.startswith("entre", inicio) else salida).isoformat())
+                  for inicio, fin, entrada, salida in rangos if entrada and salida and entrada < salida)
+
+
+def noches(entrada: str, salida: str) -> list:
+    """Fechas aaaa-mm-dd de cada noche entre entrada (incluida) y salida (excluida)."""
+    dia, fin = date.fromisoformat(entrada), date.fromisoformat(salida)
+    return [(dia + timedelta(days=i)).isoformat() for i in range((fin - dia).days)]
+
+
+def normalizar_fechas(texto: str) -> str:
+    """Reescribe las fechas dd/mm/aaaa y "10 de julio de 2025" como aaaa-mm-dd (texto ya en minúsculas)."""
+    texto = FECHA_ISO.sub(lambda m: fecha_iso(m.group(3), m.group(2), m.group(1)), texto)
+    texto = FECHA_NUMERICA.sub(lambda m: fecha_iso(m.group(1), m.group(2), m.group(3)), texto)
+    return FECHA_TEXTO.sub(
+        lambda m: fecha_iso(m.group(1), MESES[m.group(2)], m.group(3)) if m.group(3) else m.group(0),
+        texto
+    )
+
+
+def normalizar_pregunta(pregunta: str) -> str:
+    """Forma canónica de una pregunta: minúsculas, sin acentos, fechas ISO y espacios simples."""
+    texto = quitar_acentos(pregunta.lower())
+    texto = normalizar_fechas(texto)
+    texto = re.sub(r"[¿?¡!.,;:\"'()]+", " ", texto)
+    return re.sub(r"\s+", " ", texto).strip()
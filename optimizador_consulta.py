@@ -0,0 +1,194 @@
+import json
+
+from esquema_consulta import OCURRENCIAS_BOOL
+
+# Campos text que en las consultas hacen de restricción y no de relevancia: que un hotel
+# esté en Aguadulce o tenga piscina no lo hace "más relevante" que otro que también lo cumpla
+CAMPOS_FILTRO = {"localidad", "provincia", "servicios"}
+
+# Cláusulas exactas: su puntuación es constante, así que en must solo cuestan
+CLAUSULAS_EXACTAS = {"term", "terms", "range", "geo_distance", "exists", "ids"}
+
+
+class _Bool:
+    """Nodo bool del árbol: listas de hijos por ocurrencia y minimum_should_match explícito."""
+
+    def __init__(self, cuerpo: dict):
+        for ocurrencia in OCURRENCIAS_BOOL:
+            hijos = cuerpo.get(ocurrencia, [])
+            setattr(self, ocurrencia, [_nodo(h) for h in (hijos if isinstance(hijos, list) else [hijos])])
+        self.minimo = cuerpo.get("minimum_should_match")
+        self.resto = {c: v for c, v in cuerpo.items() if c not in OCURRENCIAS_BOOL and c != "minimum_should_match"}
+
+    def minimo_efectivo(self) -> int:
+        """Cuántas should tienen que cumplirse (el valor por defecto de Elasticsearch si no se indica)."""
+        if not self.should:
+            return 0
+        if self.minimo is None:
+            return 0 if self.must or self.filter else 1
+        if isinstance(self.minimo, int):
+            return self.minimo if self.minimo >= 0 else max(len(self.should) + self.minimo, 0)
+        # Porcentajes y combinaciones ("75%", "2<50%"): se dejan como están
+        return -1
+
+    def hijos(self) -> int:
+        return sum(len(getattr(self, o)) for o in OCURRENCIAS_BOOL)
+
+    def a_dict(self) -> dict:
+        cuerpo = {o: [_a_dict(h) for h in getattr(self, o)] for o in OCURRENCIAS_BOOL if getattr(self, o)}
+        if self.should and self.minimo is not None:
+            cuerpo["minimum_should_match"] = self.minimo
+        cuerpo.update(self.resto)
+        return {"bool": cuerpo}
+
+
+def _nodo(clausula):
+    if isinstance(clausula, dict) and len(clausula) == 1 and isinstance(clausula.get("bool"), dict):
+        return _Bool(clausula["bool"])
+    return clausula
+
+
+def _a_dict(nodo):
+    return nodo.a_dict() if isinstance(nodo, _Bool) else nodo
+
+
+def _es_filtro(nodo) -> bool:
+    """La cláusula restringe resultados pero su puntuación no ordena nada útil."""
+    if isinstance(nodo, _Bool):
+        # "Alguno de estos servicios" (should de filtros con mínimo) es una restricción más
+        return not nodo.must and (not nodo.should or nodo.minimo_efectivo() > 0
+                                  and all(_es_filtro(h) for h in nodo.should))
+    if not isinstance(nodo, dict) or len(nodo) != 1:
+        return False
+    tipo, cuerpo = next(iter(nodo.items()))
+    if tipo in CLAUSULAS_EXACTAS:
+        return True
+    if tipo in ("match", "match_phrase") and isinstance(cuerpo, dict) and len(cuerpo) == 1:
+        return next(iter(cuerpo)).split(".")[0] in CAMPOS_FILTRO
+    return False
+
+
+def _es_match_all(nodo) -> bool:
+    return isinstance(nodo, dict) and "match_all" in nodo and not nodo["match_all"]
+
+
+def _optimizar(nodo, puntua: bool, cambios: list):
+    if not isinstance(nodo, _Bool) or nodo.resto:
+        # Un bool con boost u otras opciones se deja como está
+        return nodo
+    for ocurrencia in OCURRENCIAS_BOOL:
+        contexto = puntua and ocurrencia in ("must", "should")
+        setattr(nodo, ocurrencia, [_optimizar(h, contexto, cambios) for h in getattr(nodo, ocurrencia)])
+
+    minimo = nodo.minimo_efectivo()
+    if nodo.should and minimo == len(nodo.should):
+        # Todas las should son obligatorias: es lo mismo que ponerlas en must (o en filter si no puntúan)
+        nodo.must += nodo.should
+        nodo.should, nodo.minimo = [], None
+        cambios.append("should con minimum_should_match = todas -> must/filter")
+    elif nodo.should and minimo == 0 and not puntua:
+        # Sin puntuación, una should opcional no cambia qué documentos coinciden
+        nodo.should, nodo.minimo = [], None
+        cambios.append("should opcional eliminada en contexto filter")
+
+    must = []
+    for hijo in nodo.must:
+        if _es_match_all(hijo) and (len(nodo.must) > 1 or nodo.filter or not nodo.should):
+            cambios.append("match_all redundante eliminado")
+        elif not puntua or _es_filtro(hijo):
+            nodo.filter.append(hijo)
+            cambios.append(f"{_describir(hijo)}: must -> filter")
+        else:
+            must.append(hijo)
+    nodo.must = must
+
+    # Los bool anidados sin should se suben al padre: coinciden los mismos documentos con la misma puntuación
+    quedan = {"must": [], "filter": []}
+    for ocurrencia in ("filter", "must"):
+        for hijo in getattr(nodo, ocurrencia):
+            if isinstance(hijo, _Bool) and not hijo.resto and not hijo.should:
+                quedan[ocurrencia] += hijo.must
+                quedan["filter"] += hijo.filter
+                nodo.must_not += hijo.must_not
+                cambios.append(f"bool anidado en {ocurrencia} aplanado")
+            else:
+                quedan[ocurrencia].append(hijo)
+    nodo.must, nodo.filter = quedan["must"], quedan["filter"]
+
+    # Sin must ni filter, Elasticsearch exige por defecto una should: se fija el valor que tenía
+    if nodo.should and nodo.minimo is None and nodo.minimo_efectivo() != minimo:
+        nodo.minimo = minimo
+    return nodo
+
+
+def _describir(nodo) -> str:
+    if isinstance(nodo, _Bool):
+        return "bool"
+    tipo, cuerpo = next(iter(nodo.items()))
+    campo = next(iter(cuerpo), "") if isinstance(cuerpo, dict) else ""
+    return f"{tipo} {campo}".strip()
+
+
+def _colapsar(nodo, puntua: bool, cambios: list):
+    """Sustituye los bool de un solo hijo por el hijo, si no cambia el contexto."""
+    if not isinstance(nodo, _Bool):
+        return nodo
+    for ocurrencia in OCURRENCIAS_BOOL:
+        contexto = puntua and ocurrencia in ("must", "should")
+        setattr(nodo, ocurrencia, [_colapsar(h, contexto, cambios) for h in getattr(nodo, ocurrencia)])
+    if nodo.resto or nodo.hijos() != 1:
+        return nodo
+    if nodo.must or (nodo.should and nodo.minimo_efectivo() == 1) or (nodo.filter and not puntua):
+        cambios.append("bool de un solo hijo colapsado")
+        return (nodo.must or nodo.should or nodo.filter)[0]
+    return nodo
+
+
+def ordena_por_puntuacion(consulta: dict) -> bool:
+    """Si el orden depende de _score (sin sort, o con _score entre los criterios).
+
+    Con size 0 no se devuelven documentos: solo puntúan los top_hits que se ordenan por _score.
+    """
+    if consulta.get("size") == 0:
+        return any(ordena_por_puntuacion(agregacion["top_hits"])
+                   for agregacion in consulta.get("aggs", {}).values() if "top_hits" in agregacion)
+    orden = consulta.get("sort")
+    if not orden:
+        return True
+    for criterio in orden if isinstance(orden, list) else [orden]:
+        campo = criterio if isinstance(criterio, str) else next(iter(criterio), None)
+        if campo == "_score":
+            return True
+    return False
+
+
+def optimizar_consulta(consulta: dict):
+    """Reescribe la consulta para que Elasticsearch puntúe lo mínimo y pueda cachear los filtros.
+
+    - Las cláusulas exactas (term, range, geo_distance...) y los match sobre CAMPOS_FILTRO pasan
+      de must a filter; si la consulta se ordena sin _score (o solo agrega), pasa a filter todo.
+    - Una lista should con minimum_should_match igual a su longitud se convierte en cláusulas
+      obligatorias (en filter si son servicios); las should opcionales desaparecen sin puntuación.
+    - Los bool anidados sin should se suben al padre y los bool de un solo hijo se colapsan.
+    - Se quita track_total_hits: el flujo no usa totales exactos por encima de 10000.
+
+    Coinciden los mismos documentos; solo deja de puntuar lo que no ordena nada útil. Devuelve
+    (consulta, cambios) sin modificar la consulta original.
+    """
+    cambios = []
+    optimizada = json.loads(json.dumps(consulta))
+    if optimizada.pop("track_total_hits", None) is not None:
+        cambios.append("track_total_hits eliminado")
+    if "query" not in optimizada:
+        return optimizada, cambios
+
+    con_puntuacion = ordena_por_puntuacion(optimizada)
+    raiz = _nodo(optimizada["query"])
+    if not con_puntuacion and not isinstance(raiz, _Bool) and not _es_match_all(raiz):
+        raiz = _Bool({"filter": [raiz]})
+        cambios.append(f"{_describir(optimizada['query'])}: query -> filter (orden sin _score)")
+    raiz = _colapsar(_optimizar(raiz, con_puntuacion, cambios), True, cambios)
+    if isinstance(raiz, _Bool) and raiz.hijos() == 0:
+        raiz = {"match_all": {}}
+    optimizada["query"] = _a_dict(raiz)
+    return optimizada, cambios
@@ -0,0 +1,145 @@
+import logging
+import threading
+
+# Orden por defecto para recorrer un índice completo: _shard_doc es el más barato con point-in-time
+ORDEN_RECORRIDO = [{"_shard_doc": "asc"}]
+
+# Desempate de search_after: sin él, dos hits con los mismos valores de orden podrían repetirse o perderse
+DESEMPATE = {"_shard_doc": "asc"}
+
+
+def abrir_pit(es, indice: str, keep_alive: str = "2m") -> str:
+    return es.open_point_in_time(index=indice, keep_alive=keep_alive)["id"]
+
+
+def cerrar_pit(es, pit_id: str):
+    try:
+        es.close_point_in_time(id=pit_id)
+    except Exception as e:
+        # El PIT caduca solo al pasar keep_alive; no merece interrumpir nada
+        logging.warning(f"No se ha podido cerrar el point-in-time: {e}")
+
+
+def orden_con_desempate(orden) -> list:
+    """Normaliza el sort de la consulta a lista y le añade _shard_doc como último criterio."""
+    if not orden:
+        orden = [{"_score": "desc"}]
+    elif not isinstance(orden, list):
+        orden = [orden]
+    if not any((criterio if isinstance(criterio, str) else next(iter(criterio), None)) == "_shard_doc"
+               for criterio in orden):
+        orden = orden + [DESEMPATE]
+    return orden
+
+
+class Paginador:
+    """Resultados de una consulta página a página, con point-in-time y search_after.
+
+    El PIT se abre con la primera página y se cierra solo al llegar a la última (o con cerrar),
+    así todas las páginas ven el mismo estado del índice y cada una cuesta lo mismo que la primera.
+    El size de la consulta, si lo tiene, es el máximo de resultados entre todas las páginas.
+    """
+
+    def __init__(self, es, indice: str, consulta: dict = None, tamano_pagina: int = 10,
+                 campos: list = None, keep_alive: str = "5m", **opciones):
+        consulta = consulta or {}
+        self.es = es
+        self.indice = indice
+        self.tamano_pagina = tamano_pagina
+        self.campos = campos
+        self.keep_alive = keep_alive
+        self.opciones = {clave: valor for clave, valor in consulta.items() if clave not in ("query", "sort", "size", "from")}
+        self.opciones.update(opciones)
+        self.limite = consulta.get("size")
+        self.query = consulta.get("query", {"match_all": {}})
+        self.orden = orden_con_desempate(consulta.get("sort"))
+        self.pagina = 0
+        self.vistos = 0
+        self.total = None
+        self.hay_mas = True
+        self._pit_id = None
+        self._despues = None
+        self._lock = threading.Lock()
+
+    def siguiente(self):
+        """Respuesta de búsqueda con la siguiente página, o None si ya no quedan resultados."""
+        with self._lock:
+            if not self.hay_mas:
+                return None
+            if self._pit_id is None:
+                self._pit_id = abrir_pit(self.es, self.indice, self.keep_alive)
+            tamano = self.tamano_pagina if self.limite is None else min(self.tamano_pagina, self.limite - self.vistos)
+            cuerpo = {
+                "query": self.query,
+                "size": tamano,
+                "sort": self.orden,
+                "pit": {"id": self._pit_id, "keep_alive": self.keep_alive},
+                **self.opciones,
+            }
+            if self._despues is not None:
+                cuerpo["search_after"] = self._despues
+            elif self.vistos:
+                # La primera página llegó de fuera (ver continuar): la segunda se pide con from
+                cuerpo["from"] = self.vistos
+            try:
+                respuesta = self.es.search(body=cuerpo, **({"source_includes": self.campos} if self.campos else {}))
+            except Exception:
+                self._cerrar()
+                raise
+            # Cada respuesta puede traer un id de PIT actualizado
+            self._pit_id = respuesta.get("pit_id", self._pit_id)
+            hits = self._registrar(respuesta, tamano)
+            if self.hay_mas and "sort" in hits[-1]:
+                self._despues = hits[-1]["sort"]
+            else:
+                self.hay_mas = False
+                self._cerrar()
+            return respuesta
+
+    def continuar(self, respuesta):
+        """Toma como primera página una respuesta ya obtenida sin PIT (por ejemplo de un msearch).
+
+        El PIT solo se abre si se pide la página siguiente, que empieza con from.
+        """
+        with self._lock:
+            tamano = self.tamano_pagina if self.limite is None else min(self.tamano_pagina, self.limite)
+            self._registrar(respuesta, tamano)
+
+    def _registrar(self, respuesta, tamano: int) -> list:
+        hits = respuesta["hits"]["hits"]
+        total = respuesta["hits"].get("total") or {}
+        if total.get("relation", "eq") == "eq" and "value" in total:
+            self.total = total["value"]
+        self.pagina += 1
+        self.vistos += len(hits)
+        self.hay_mas = (len(hits) == tamano and tamano > 0
+                        and (self.total is None or self.vistos < self.total)
+                        and (self.limite is None or self.vistos < self.limite))
+        return hits
+
+    def cerrar(self):
+        with self._lock:
+            self.hay_mas = False
+            self._cerrar()
+
+    def _cerrar(self):
+        if self._pit_id is not None:
+            cerrar_pit(self.es, self._pit_id)
+            self._pit_id = None
+
+
+def recorrer_indice(es, indice: str, consulta: dict = None, tamano_pagina: int = 500,
+                    campos: list = None, keep_alive: str = "2m", **opciones):
+    """Devuelve, página a página, todos los hits de la consulta usando point-in-time y search_after.
+
+    A diferencia de scroll, el PIT no retiene un contexto por consulta y cada página
+    es una búsqueda normal; se cierra al terminar aunque el recorrido se interrumpa.
+    """
+    consulta = {"query": (consulta or {}).get("query", {"match_all": {}}), "sort": ORDEN_RECORRIDO}
+    paginador = Paginador(es, indice, consulta, tamano_pagina, campos, keep_alive, **opciones)
+    try:
+        while (respuesta := paginador.siguiente()) is not None:
+            if respuesta["hits"]["hits"]:
+                yield respuesta["hits"]["hits"]
+    finally:
+        paginador.cerrar()
@@ -0,0 +1,263 @@
+import re
+import threading
+
+from normalizacion import buscar_fechas, buscar_rangos, texto_plano
+
+# Servicios reconocidos (forma sin acentos -> valor usado en la consulta)
+SERVICIOS = {
+    "piscina": "piscina",
+    "piscina climatizada": "piscina climatizada",
+    "parking": "parking",
+    "aparcamiento": "parking",
+    "garaje": "parking",
+    "wifi": "wifi",
+    "wi-fi": "wifi",
+    "internet": "wifi",
+    "gimnasio": "gimnasio",
+    "spa": "spa",
+    "jacuzzi": "jacuzzi",
+    "sauna": "sauna",
+    "restaurante": "restaurante",
+    "bar": "bar",
+    "cafeteria": "cafetería",
+    "desayuno": "desayuno",
+    "terraza": "terraza",
+    "jardin": "jardín",
+    "playa": "playa",
+    "ascensor": "ascensor",
+    "aire acondicionado": "aire acondicionado",
+    "calefaccion": "calefacción",
+    "mascotas": "mascotas",
+    "admite mascotas": "mascotas",
+    "recepcion 24 horas": "recepción 24 horas",
+    "servicio de habitaciones": "servicio de habitaciones",
+    "traslado al aeropuerto": "traslado aeropuerto",
+    "accesible": "accesible",
+    "adaptado": "accesible",
+}
+
+# Palabras que pueden quedar sin interpretar sin cambiar el significado de la pregunta
+RELLENO = {
+    "muestrame", "muestra", "ensename", "dime", "dame", "busca", "buscame", "encuentra", "encuentrame",
+    "quiero", "quisiera", "necesito", "me", "gustaria", "puedes", "podrias", "por", "favor", "ver",
+    "conocer", "saber", "hay", "que", "cual", "cuales", "es", "son", "hotel", "hoteles", "alojamiento",
+    "alojamientos", "el", "la", "los", "las", "un", "una", "unos", "unas", "algun", "algunos", "todos",
+    "lista", "listado", "disponible", "disponibles", "libre", "libres", "para", "dia", "en", "de", "y",
+}
+
+_SEPARADOR = "|"
+_CONECTORES = {"de", "del", "la", "las", "los", "el"}
+# Palabras como mucho de una localidad o provincia ("Sanlúcar de Barrameda", "Santa Cruz de Tenerife")
+_MAXIMO_PALABRAS = 6
+
+_ORDEN = [
+    (re.compile(r"\b(?:ordenad[oa]s?\s+)?por\s+precio\s+(?:ascendente|de\s+menor\s+a\s+mayor)\b"), "precio", "asc"),
+    (re.compile(r"\b(?:ordenad[oa]s?\s+)?por\s+precio\s+(?:descendente|de\s+mayor\s+a\s+menor)\b"), "precio", "desc"),
+    (re.compile(r"\bordenad[oa]s?\s+por\s+precio\b"), "precio", "asc"),
+    (re.compile(r"\bmas\s+(?:barat[oa]s?|economic[oa]s?)\b"), "precio", "asc"),
+    (re.compile(r"\bmas\s+car[oa]s?\b"), "precio", "desc"),
+    (re.compile(r"\bmejor\s+(?:valorad[oa]s?|puntuad[oa]s?)\b"), "opinion", "desc"),
+]
+
+# Preguntas numéricas que se responden con agregaciones (size 0) y una plantilla, sin documentos
+_METRICAS = [
+    (re.compile(r"\b(?:precio\s+(?:medio|promedio)|media\s+de\s+(?:los\s+)?precios?)\b"), "avg", "precio"),
+    (re.compile(r"\bprecio\s+(?:minimo|mas\s+bajo)\b"), "min", "precio"),
+    (re.compile(r"\bprecio\s+(?:maximo|mas\s+alto)\b"), "max", "precio"),
+    (re.compile(r"\b(?:opinion|valoracion|puntuacion|nota)\s+(?:media|promedio)\b"), "avg", "opinion"),
+]
+_CUANTOS = re.compile(r"\bcuant[oa]s\b")
+_SERVICIOS_FRECUENTES = re.compile(r"\bservicios\s+mas\s+(?:comunes|frecuentes|habituales|populares)\b")
+_PREFIJO_FECHA = re.compile(r"(?:\b(?:para|disponibles?|libres?)\s+)?(?:\bel\s+)?(?:\bdia\s+)?$")
+_NOMBRE = re.compile(r"\b(?:detalles|informacion|datos|ficha)\s+(?:del|sobre\s+el|de\s+el)\s+hotel\s+(.+)$")
+_PROVINCIA = re.compile(r"\b(?:en|de)\s+la\s+provincia\s+de\s+")
+_PREPOSICION = re.compile(r"\b(?:en|de)\s+")
+_PALABRA = re.compile(r"\s*([^\s|,.;:¿?¡!]+)")
+_PATRON_SERVICIO = "|".join(re.escape(s) for s in sorted(SERVICIOS, key=len, reverse=True))
+_SERVICIOS = re.compile(r"\bcon\s+((?:" + _PATRON_SERVICIO + r")(?:\s*(?:,|\by\b|\be\b)\s*(?:" + _PATRON_SERVICIO + r"))*)\b")
+
+_estadisticas = {"aciertos": 0, "fallos": 0}
+_lock = threading.Lock()
+
+
+def _tapar(plano: str, inicio: int, fin: int) -> str:
+    return plano[:inicio] + _SEPARADOR * (fin - inicio) + plano[fin:]
+
+
+def _limpiar_valor(texto: str) -> str:
+    return texto.strip(" ,.;:¿?¡!\"'")
+
+
+def _nombre_propio(pregunta: str, palabras: list) -> int:
+    """Cuántas de las palabras forman un nombre en mayúsculas ("Málaga", "Sanlúcar de Barrameda").
+
+    Los conectores solo forman parte del nombre si van seguidos de otra palabra en mayúscula.
+    """
+    n = 0
+    for i, p in enumerate(palabras):
+        if pregunta[p.start(1):p.end(1)][:1].isupper():
+            n = i + 1
+        elif p.group(1) not in _CONECTORES:
+            break
+    return n
+
+
+def _localidad_conocida(pregunta: str, palabras: list, es_localidad) -> int:
+    """Cuántas palabras forman la localidad o provincia conocida más larga (en minúsculas también vale)."""
+    for n in range(len(palabras), 0, -1):
+        if es_localidad(pregunta[palabras[0].start(1):palabras[n - 1].end(1)]):
+            return n
+    return 0
+
+
+def _extraer_ubicacion(pregunta: str, plano: str, es_localidad=None):
+    """Busca "de la provincia de X" o "en/de X" y devuelve (campo, valor, plano tapado).
+
+    X es un nombre en mayúsculas o, con es_localidad, una localidad o provincia conocida. Lo que
+    va detrás ("sin piscina", "de 4 estrellas", "o Marbella") queda sin tapar, así que la
+    pregunta no se da por interpretada y la consulta la genera el LLM.
+    """
+    for patron, campo in ((_PROVINCIA, "provincia"), (_PREPOSICION, "localidad")):
+        for m in patron.finditer(plano):
+            palabras = []
+            posicion = m.end()
+            while len(palabras) < _MAXIMO_PALABRAS and (p := _PALABRA.match(plano, posicion)):
+                palabras.append(p)
+                posicion = p.end()
+            n = _nombre_propio(pregunta, palabras)
+            if es_localidad is not None:
+                n = max(n, _localidad_conocida(pregunta, palabras, es_localidad))
+            palabras = palabras[:n]
+            if not palabras or all(p.group(1) in RELLENO for p in palabras):
+                continue
+            fin = palabras[-1].end()
+            return campo, _limpiar_valor(pregunta[m.end():fin]), _tapar(plano, m.start(), fin)
+    return None, None, plano
+
+
+def parsear_pregunta(pregunta: str, ubicacion_opcional: bool = False, agregaciones: bool = False,
+                     es_localidad=None):
+    """Construye la consulta Elasticsearch para las preguntas con forma conocida.
+
+    Devuelve None si queda alguna parte de la pregunta sin interpretar; en ese caso
+    la consulta debe generarla el LLM. Con ubicacion_opcional se aceptan preguntas sin
+    localidad ni provincia (la ubicación la pone después el filtro geográfico). Con
+    agregaciones, "precio medio", "cuántos hoteles" o "el hotel más barato" se resuelven
+    con agregaciones y size 0 en lugar de pedir documentos. La ubicación es un nombre en
+    mayúsculas o, si se pasa es_localidad (ver Nomenclator.es_localidad), uno conocido.
+    """
+    consulta = _parsear(pregunta, ubicacion_opcional, agregaciones, es_localidad)
+    with _lock:
+        _estadisticas["aciertos" if consulta else "fallos"] += 1
+    return consulta
+
+
+def _parsear(pregunta: str, ubicacion_opcional: bool = False, agregaciones: bool = False, es_localidad=None):
+    plano = texto_plano(pregunta)
+
+    m = _NOMBRE.search(plano)
+    if m:
+        nombre = _limpiar_valor(pregunta[m.start(1):m.end(1)])
+        if not nombre:
+            return None
+        return {"query": {"match": {"nombre": nombre}}, "size": 1}
+
+    # Una estancia ("del 1 al 7 de junio de 2025") va como range de entrada a salida (ver estancias.py)
+    rangos = buscar_rangos(plano)
+    if len(rangos) > 1:
+        return None
+    estancia = None
+    if rangos:
+        inicio, fin, *estancia = rangos[0]
+        inicio = _PREFIJO_FECHA.search(plano[:inicio]).start()
+        plano = _tapar(plano, inicio, fin)
+
+    fechas = buscar_fechas(plano)
+    if len(fechas) > 1 or (fechas and estancia):
+        return None
+    fecha = None
+    if fechas:
+        inicio, fin, fecha = fechas[0]
+        inicio = _PREFIJO_FECHA.search(plano[:inicio]).start()
+        plano = _tapar(plano, inicio, fin)
+
+    orden = None
+    for patron, campo_orden, sentido in _ORDEN:
+        m = patron.search(plano)
+        if m:
+            orden = {campo_orden: sentido}
+            plano = _tapar(plano, m.start(), m.end())
+            break
+
+    metricas = []
+    for patron, tipo, campo_metrica in _METRICAS:
+        m = patron.search(plano)
+        if m:
+            metricas.append((tipo, campo_metrica))
+            plano = _tapar(plano, m.start(), m.end())
+    cuenta = _CUANTOS.search(plano)
+    if cuenta:
+        plano = _tapar(plano, cuenta.start(), cuenta.end())
+    frecuentes = _SERVICIOS_FRECUENTES.search(plano)
+    if frecuentes:
+        plano = _tapar(plano, frecuentes.start(), frecuentes.end())
+    if (metricas or cuenta or frecuentes) and not agregaciones:
+        return None
+
+    servicios = []
+    m = _SERVICIOS.search(plano)
+    if m:
+        for nombre in re.split(r"\s*(?:,|\by\b|\be\b)\s*", m.group(1)):
+            valor = SERVICIOS[nombre.strip()]
+            if valor not in servicios:
+                servicios.append(valor)
+        plano = _tapar(plano, m.start(), m.end())
+
+    campo, ubicacion, plano = _extraer_ubicacion(pregunta, plano, es_localidad)
+    if not ubicacion and not ubicacion_opcional:
+        return None
+
+    # Todo lo que no se ha interpretado tiene que ser relleno
+    sobrantes = [p for p in re.findall(r"[^\s|,.;:¿?¡!]+", plano) if p not in RELLENO]
+    if sobrantes:
+        return None
+
+    clausulas = [{"match": {campo: ubicacion}}] if ubicacion else []
+    if fecha:
+        clausulas.append({"term": {"fechaEntrada": fecha}})
+    if estancia:
+        clausulas.append({"range": {"fechaEntrada": {"gte": estancia[0], "lt": estancia[1]}}})
+    if servicios:
+        clausulas.append({
+            "bool": {
+                "should": [{"match": {"servicios": s}} for s in servicios],
+                "minimum_should_match": len(servicios)
+            }
+        })
+
+    if not clausulas:
+        consulta = {"query": {"match_all": {}}}
+    else:
+        consulta = {"query": clausulas[0] if len(clausulas) == 1 else {"bool": {"must": clausulas}}}
+    # "el hotel más barato" pide un único resultado, igual que en los ejemplos del prompt
+    singular = re.search(r"\b(?:el|un)\s+hotel\b", texto_plano(pregunta)) and not re.search(r"\bhoteles\b", texto_plano(pregunta))
+    if agregaciones and (metricas or cuenta or frecuentes or (orden and singular)):
+        aggs = {f"{c}_{t}": {t: {"field": c}} for t, c in metricas}
+        if frecuentes:
+            aggs["servicios_frecuentes"] = {"terms": {"field": "servicios.keyword", "size": 5}}
+        if orden and singular:
+            aggs["hotel"] = {"top_hits": {"size": 1, "sort": [orden]}}
+        consulta["size"] = 0
+        if aggs:
+            consulta["aggs"] = aggs
+        return consulta
+    if orden:
+        consulta["sort"] = [orden]
+    consulta["size"] = 1 if orden and singular else 10
+    return consulta
+
+
+def estadisticas_parser() -> dict:
+    with _lock:
+        total = _estadisticas["aciertos"] + _estadisticas["fallos"]
+        return {**_estadisticas, "tasa_aciertos": round(_estadisticas["aciertos"] / total, 3) if total else 0.0}
@@ -0,0 +1,146 @@
+import json
+import re
+
+from contexto_prompt import CAMPOS_PROMPT
+from normalizacion import buscar_fechas, buscar_rangos, quitar_acentos
+
+# Igual que en las búsquedas normales, solo se piden los campos que usa el prompt de respuesta
+_SOURCE = '"_source": ' + json.dumps(CAMPOS_PROMPT, ensure_ascii=False) + ','
+
+# Plantillas mustache almacenadas en Elasticsearch. Cada cláusula opcional va
+# precedida de una coma, y "match_all" garantiza que la lista nunca empieza vacía.
+PLANTILLA_FILTROS = """{
+  "query": {
+    "bool": {
+      "must": [
+        { "match_all": {} }
+        {{#localidad}}, { "match": { "localidad": "{{localidad}}" } }{{/localidad}}
+        {{#provincia}}, { "match": { "provincia": "{{provincia}}" } }{{/provincia}}
+        {{#fecha}}, { "term": { "fechaEntrada": "{{fecha}}" } }{{/fecha}}
+        {{#servicios_texto}}, { "match": { "servicios": { "query": "{{servicios_texto}}", "operator": "and" } } }{{/servicios_texto}}
+      ]
+    }
+  },
+  {{#orden}}"sort": [ { "precio": "{{orden}}" } ],{{/orden}}
+  """ + _SOURCE + """
+  "size": {{#size}}{{size}}{{/size}}{{^size}}10{{/size}}
+}"""
+
+PLANTILLA_NOMBRE = """{
+  "query": { "match": { "nombre": "{{nombre}}" } },
+  """ + _SOURCE + """
+  "size": {{#size}}{{size}}{{/size}}{{^size}}1{{/size}}
+}"""
+
+PROMPT_PARAMETROS = """
+Eres un asistente que extrae los parámetros de búsqueda de una pregunta sobre hoteles.
+Devuelve SOLO un objeto JSON con estas claves (omite las que no aparezcan en la pregunta):
+- "nombre": nombre del hotel si se pregunta por un hotel concreto
+- "localidad": localidad
+- "provincia": provincia (solo si la pregunta dice "provincia")
+- "fecha": fecha de entrada en formato yyyy-MM-dd
+- "servicios": lista de servicios
+- "orden": "asc" para el más barato u ordenado por precio ascendente, "desc" para el más caro
+- "size": número de hoteles pedidos (1 si se pregunta por "el hotel")
+- "otros": true si la pregunta pide algo que no cabe en las claves anteriores (límites de precio,
+  estancias de varias noches, "cerca de", número de estrellas, cuántos hoteles, precio medio...)
+
+Pregunta: "Muéstrame hoteles en Aguadulce con piscina y parking, ordenados por precio ascendente para el día 01/06/2025."
+{"localidad": "Aguadulce", "fecha": "2025-06-01", "servicios": ["piscina", "parking"], "orden": "asc"}
+
+Pregunta: "¿Cuál es el hotel más barato de la provincia de Huelva?"
+{"provincia": "Huelva", "orden": "asc", "size": 1}
+
+Pregunta: "Quiero conocer los detalles del hotel La Perla."
+{"nombre": "La Perla"}
+
+Pregunta: "Hoteles en Málaga por menos de 80 euros."
+{"localidad": "Málaga", "otros": true}
+
+Pregunta: "{pregunta}"
+"""
+
+_CLAVES_TEXTO = ("nombre", "localidad", "provincia")
+
+# Restricciones que las plantillas no pueden expresar: con ellas se genera la consulta completa
+_FUERA_DE_PLANTILLA = re.compile(
+    r"\b(?:euros?|eur|menos\s+de|mas\s+de|entre|hasta|maximo|minimo|cerca|cercan[oa]s?|km|kilometros?|metros|"
+    r"estrellas?|cuant[oa]s|medio|media|promedio|sin|excepto|salvo|noches?)\b|€"
+)
+
+
+def fuera_de_plantilla(pregunta: str) -> bool:
+    """Si la pregunta tiene restricciones que no caben en los parámetros de las plantillas."""
+    plano = quitar_acentos(pregunta.lower())
+    return bool(_FUERA_DE_PLANTILLA.search(plano) or buscar_rangos(plano))
+
+
+def ids_plantillas(template_id: str) -> dict:
+    return {"filtros": f"{template_id}-filtros", "nombre": f"{template_id}-nombre"}
+
+
+def registrar_plantillas(es, template_id: str):
+    """Guarda (o actualiza) las plantillas en el clúster; es idempotente."""
+    ids = ids_plantillas(template_id)
+    es.put_script(id=ids["filtros"], script={"lang": "mustache", "source": PLANTILLA_FILTROS})
+    es.put_script(id=ids["nombre"], script={"lang": "mustache", "source": PLANTILLA_NOMBRE})
+
+
+def validar_parametros(parametros) -> dict:
+    """Limpia el objeto devuelto por el LLM; devuelve None si no contiene ningún criterio de búsqueda
+    o si el LLM marca "otros" (la pregunta pide algo que las plantillas no cubren)."""
+    if not isinstance(parametros, dict) or parametros.get("otros"):
+        return None
+    limpios = {}
+    for clave in _CLAVES_TEXTO:
+        valor = parametros.get(clave)
+        if isinstance(valor, str) and valor.strip():
+            limpios[clave] = valor.strip()
+
+    fecha = parametros.get("fecha")
+    if isinstance(fecha, str) and fecha.strip():
+        fechas = buscar_fechas(quitar_acentos(fecha.lower()))
+        if not fechas:
+            return None
+        limpios["fecha"] = fechas[0][2]
+
+    servicios = parametros.get("servicios") or []
+    if isinstance(servicios, str):
+        servicios = re.split(r"\s*(?:,|\by\b)\s*", servicios)
+    servicios = [s.strip() for s in servicios if isinstance(s, str) and s.strip()]
+    if servicios:
+        limpios["servicios"] = servicios
+        limpios["servicios_texto"] = " ".join(servicios)
+
+    orden = str(parametros.get("orden") or "").lower()
+    if orden in ("asc", "desc"):
+        limpios["orden"] = orden
+
+    try:
+        size = int(parametros.get("size") or 0)
+    except (TypeError, ValueError):
+        size = 0
+    if size > 0:
+        limpios["size"] = min(size, 100)
+
+    if not any(clave in limpios for clave in ("nombre", "localidad", "provincia", "fecha", "servicios")):
+        return None
+    return limpios
+
+
+def elegir_plantilla(parametros: dict, template_id: str) -> str:
+    ids = ids_plantillas(template_id)
+    return ids["nombre"] if "nombre" in parametros else ids["filtros"]
+
+
+def buscar_con_plantilla(es, indice: str, template_id: str, parametros: dict):
+    return es.search_template(index=indice, id=elegir_plantilla(parametros, template_id), params=parametros)
+
+
+def buscar_varias_con_plantilla(es, indice: str, template_id: str, lista_parametros: list) -> list:
+    """Ejecuta varias búsquedas en una sola petición _msearch/template."""
+    peticiones = []
+    for parametros in lista_parametros:
+        peticiones.append({"index": indice})
+        peticiones.append({"id": elegir_plantilla(parametros, template_id), "params": parametros})
+    return es.msearch_template(search_templates=peticiones)["responses"]
@@ -0,0 +1,178 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+from elasticsearch import helpers
+
+import llm
+from backend_llm import ErrorLLM
+from cargar_hoteles import MAPPING_HOTELES
+from contexto_prompt import deduplicar_servicios, formatear_hotel, recortar_descripcion
+from paginacion import recorrer_indice
+
+PROMPT_RESUMEN = (
+    "Escribe en dos frases, en español y en lenguaje natural, una descripción atractiva del siguiente hotel "
+    "para una recomendación turística. Usa solo los datos recibidos y no menciones el precio:\n\n"
+)
+
+# Campos que determinan el resumen: si ninguno cambia, no se vuelve a generar
+CAMPOS_RESUMEN = ["nombre", "localidad", "provincia", "descripcion", "servicios", "opinion", "comentarios"]
+
+MAPEO_RESUMEN = {campo: tipo for campo, tipo in MAPPING_HOTELES["properties"].items() if campo.startswith("resumen")}
+
+TOKENS_DESCRIPCION = 400
+TOKENS_RESUMEN = 120
+
+
+def hash_resumen(hotel: dict, modelo: str) -> str:
+    """Huella de los datos de entrada, el prompt y el modelo que producen el resumen."""
+    datos = {campo: hotel.get(campo) for campo in CAMPOS_RESUMEN}
+    base = json.dumps(datos, sort_keys=True, ensure_ascii=False, default=str) + PROMPT_RESUMEN + modelo
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+
+def prompt_resumen(hotel: dict) -> str:
+    descripcion = recortar_descripcion(str(hotel.get("descripcion", "") or ""), TOKENS_DESCRIPCION)
+    hotel = {campo: valor for campo, valor in hotel.items() if campo != "precio"}
+    return PROMPT_RESUMEN + formatear_hotel(hotel, descripcion, deduplicar_servicios(hotel.get("servicios", []))).strip()
+
+
+def leer_checkpoint(ruta: str) -> dict:
+    """Ids ya procesados en ejecuciones anteriores con su hash."""
+    procesados = {}
+    if ruta and os.path.exists(ruta):
+        with open(ruta, encoding="utf-8") as f:
+            for linea in f:
+                doc_id, _, huella = linea.rstrip("\n").partition("\t")
+                if doc_id:
+                    procesados[doc_id] = huella
+    return procesados
+
+
+def generar_resumen(cliente, hotel: dict) -> str:
+    respuesta = cliente.chat([{"role": "user", "content": prompt_resumen(hotel)}], max_tokens=TOKENS_RESUMEN)
+    return respuesta["contenido"].strip()
+
+
+def accion_resumen(hit: dict, huella: str, modelo: str, resumen: str) -> dict:
+    return {
+        "_op_type": "update",
+        "_index": hit["_index"],
+        "_id": hit["_id"],
+        # Si el documento ha cambiado mientras se generaba el resumen, la actualización se rechaza
+        "if_seq_no": hit["_seq_no"],
+        "if_primary_term": hit["_primary_term"],
+        "doc": {
+            "resumen": resumen,
+            "resumen_hash": huella,
+            "resumen_modelo": modelo,
+            "resumen_fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        },
+    }
+
+
+def precalcular(es, cliente, indice: str, modelo: str, concurrencia: int = 8, tamano_pagina: int = 200,
+                checkpoint: str = None, forzar: bool = False, limite: int = None) -> dict:
+    es.indices.put_mapping(index=indice, properties=MAPEO_RESUMEN)
+    procesados = {} if forzar else leer_checkpoint(checkpoint)
+    estadisticas = {"leidos": 0, "omitidos": 0, "generados": 0, "llamadas_llm": 0, "errores": 0, "conflictos": 0}
+    # Cada documento es un hotel en una fecha y el hash solo depende de los datos del hotel: el
+    # resumen se genera una vez por hash y se escribe en todos los documentos que lo comparten
+    resumenes = {}
+    inicio = time.perf_counter()
+    fichero = open(checkpoint, "a", encoding="utf-8") if checkpoint else None
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrencia, thread_name_prefix="resumen") as ejecutor:
+            for pagina in recorrer_indice(es, indice, tamano_pagina=tamano_pagina,
+                                          campos=CAMPOS_RESUMEN + ["resumen", "resumen_hash"], seq_no_primary_term=True):
+                pendientes = {}
+                for hit in pagina:
+                    if limite is not None and estadisticas["leidos"] >= limite:
+                        break
+                    estadisticas["leidos"] += 1
+                    huella = hash_resumen(hit["_source"], modelo)
+                    if not forzar and (hit["_source"].get("resumen_hash") == huella or procesados.get(hit["_id"]) == huella):
+                        # Un resumen ya al día sirve para las demás fechas del mismo hotel
+                        if hit["_source"].get("resumen_hash") == huella and hit["_source"].get("resumen"):
+                            resumenes.setdefault(huella, hit["_source"]["resumen"])
+                        estadisticas["omitidos"] += 1
+                        continue
+                    pendientes.setdefault(huella, []).append(hit)
+
+                futuros = {}
+                for huella, hits in pendientes.items():
+                    if huella not in resumenes:
+                        futuros[ejecutor.submit(generar_resumen, cliente, hits[0]["_source"])] = huella
+                        estadisticas["llamadas_llm"] += 1
+                for futuro in concurrent.futures.as_completed(futuros):
+                    huella = futuros[futuro]
+                    try:
+                        resumenes[huella] = futuro.result()
+                    except ErrorLLM as e:
+                        estadisticas["errores"] += len(pendientes[huella])
+                        logging.warning(f"Resumen de {pendientes[huella][0]['_id']} fallido: {e}")
+                acciones = [accion_resumen(hit, huella, modelo, resumenes[huella])
+                            for huella, hits in pendientes.items() if huella in resumenes for hit in hits]
+
+                # Una página se escribe entera antes de pasar a la siguiente, así el checkpoint nunca se adelanta
+                huellas = {accion["_id"]: accion["doc"]["resumen_hash"] for accion in acciones}
+                for correcto, resultado in helpers.parallel_bulk(es, acciones, thread_count=2, chunk_size=100,
+                                                                 raise_on_error=False):
+                    detalle = resultado.get("update", {})
+                    if correcto:
+                        estadisticas["generados"] += 1
+                        if fichero:
+                            fichero.write(f"{detalle['_id']}\t{huellas[detalle['_id']]}\n")
+                    elif detalle.get("status") == 409:
+                        estadisticas["conflictos"] += 1
+                    else:
+                        estadisticas["errores"] += 1
+                        logging.warning(f"No se ha podido guardar el resumen de {detalle.get('_id')}: {detalle.get('error')}")
+                if fichero:
+                    fichero.flush()
+                if limite is not None and estadisticas["leidos"] >= limite:
+                    break
+    finally:
+        if fichero:
+            fichero.close()
+
+    segundos = time.perf_counter() - inicio
+    estadisticas["segundos"] = round(segundos, 2)
+    estadisticas["docs_por_segundo"] = round(estadisticas["leidos"] / segundos, 1) if segundos else 0.0
+    return estadisticas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera y guarda en el índice un resumen corto de cada hotel.")
+    parser.add_argument("-c", "--concurrencia", type=int, default=8, help="Llamadas simultáneas al LLM (por defecto 8)")
+    parser.add_argument("--pagina", type=int, default=200, help="Documentos por página del recorrido (por defecto 200)")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Fichero de progreso (por defecto OUT_DIRECTORY/resumenes.checkpoint)")
+    parser.add_argument("--reiniciar", action="store_true", help="Borra el checkpoint antes de empezar")
+    parser.add_argument("--forzar", action="store_true", help="Regenera también los resúmenes que no han cambiado")
+    parser.add_argument("--limite", type=int, default=None, help="Procesa como mucho este número de documentos")
+    args = parser.parse_args()
+
+    llm.configurar_logging()
+    checkpoint = args.checkpoint or os.path.join(llm.OUT_DIRECTORY or ".", "resumenes.checkpoint")
+    if args.reiniciar and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    cliente = llm.obtener_cliente_llm()
+    estadisticas = precalcular(
+        llm.obtener_es(), cliente, llm.ES_INDEX, cliente.principal.nombre,
+        concurrencia=args.concurrencia, tamano_pagina=args.pagina, checkpoint=checkpoint,
+        forzar=args.forzar, limite=args.limite,
+    )
+    logging.info(f"Resúmenes precalculados: {estadisticas}")
+    print(json.dumps(estadisticas, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import json
+
+from esquema_consulta import OCURRENCIAS_BOOL
+
+# Escalera de relajación para las consultas sin resultados. Cada nivel se aplica sobre el
+# anterior y los que no cambian la consulta se saltan
+NIVELES = ("fecha", "servicios", "provincia", "fuzzy")
+
+
+def _campo(clausula):
+    """Tipo y campo de una cláusula hoja ({"match": {"localidad": ...}} -> ("match", "localidad"))."""
+    if not isinstance(clausula, dict) or len(clausula) != 1:
+        return None, None
+    tipo, cuerpo = next(iter(clausula.items()))
+    if tipo == "bool" or not isinstance(cuerpo, dict) or not cuerpo:
+        return tipo, None
+    return tipo, next(iter(cuerpo)).split(".")[0]
+
+
+def _texto(valor):
+    return valor.get("query") if isinstance(valor, dict) else valor
+
+
+def _transformar(clausula, funcion):
+    """Aplica funcion a cada hoja; si devuelve None la hoja desaparece. funcion(bool) recibe el cuerpo ya recorrido."""
+    tipo, _ = _campo(clausula)
+    if tipo != "bool":
+        return funcion(clausula)
+    cuerpo = {}
+    for clave, valor in clausula["bool"].items():
+        if clave in OCURRENCIAS_BOOL:
+            hijos = [_transformar(h, funcion) for h in (valor if isinstance(valor, list) else [valor])]
+            hijos = [h for h in hijos if h is not None]
+            if hijos:
+                cuerpo[clave] = hijos
+        else:
+            cuerpo[clave] = valor
+    if "should" not in cuerpo:
+        cuerpo.pop("minimum_should_match", None)
+    elif isinstance(cuerpo.get("minimum_should_match"), int):
+        cuerpo["minimum_should_match"] = min(cuerpo["minimum_should_match"], len(cuerpo["should"]))
+    return funcion({"bool": cuerpo})
+
+
+def sin_fecha(consulta: dict, **_):
+    def quitar(clausula):
+        return None if _campo(clausula)[1] == "fechaEntrada" else clausula
+    return _aplicar(consulta, quitar), "sin tener en cuenta la fecha"
+
+
+def servicios_opcionales(consulta: dict, **_):
+    """Con varios servicios obligatorios basta con uno; si solo se pedía uno, deja de exigirse."""
+    def relajar(clausula):
+        if _campo(clausula)[0] != "bool":
+            return clausula
+        cuerpo = dict(clausula["bool"])
+        obligatorios = [h for o in ("must", "filter") for h in cuerpo.get(o, []) if _campo(h)[1] == "servicios"]
+        minimo = cuerpo.get("minimum_should_match")
+        if obligatorios:
+            for ocurrencia in ("must", "filter"):
+                if ocurrencia in cuerpo:
+                    cuerpo[ocurrencia] = [h for h in cuerpo[ocurrencia] if _campo(h)[1] != "servicios"]
+            if len(obligatorios) > 1:
+                cuerpo["filter"] = cuerpo.get("filter", []) + [
+                    {"bool": {"should": obligatorios, "minimum_should_match": 1}}]
+        elif (isinstance(minimo, int) and minimo > 1 and cuerpo.get("should")
+              and all(_campo(h)[1] == "servicios" for h in cuerpo["should"])):
+            cuerpo["minimum_should_match"] = 1
+        return {"bool": {clave: valor for clave, valor in cuerpo.items() if valor != []}}
+    return _aplicar(consulta, relajar), "sin exigir todos los servicios pedidos"
+
+
+def provincia_completa(consulta: dict, provincia_de=None, **_):
+    """Cambia el match sobre localidad por la provincia a la que pertenece (según provincia_de)."""
+    provincias = []
+
+    def ampliar(clausula):
+        tipo, campo = _campo(clausula)
+        if campo != "localidad" or tipo not in ("match", "match_phrase") or provincia_de is None:
+            return clausula
+        provincia = provincia_de(str(_texto(next(iter(clausula[tipo].values())))))
+        if not provincia:
+            return clausula
+        provincias.append(provincia)
+        return {"match": {"provincia": provincia}}
+    relajada = _aplicar(consulta, ampliar)
+    return relajada, f"en toda la provincia de {' y '.join(dict.fromkeys(provincias))}"
+
+
+def con_fuzzy(consulta: dict, **_):
+    """Los match admiten errores de escritura; match_phrase pasa a match con todas las palabras."""
+    def difuso(clausula):
+        tipo, campo = _campo(clausula)
+        if tipo not in ("match", "match_phrase") or campo is None:
+            return clausula
+        nombre, valor = next(iter(clausula[tipo].items()))
+        opciones = dict(valor) if isinstance(valor, dict) else {"query": valor}
+        if tipo == "match_phrase":
+            opciones = {"query": opciones.get("query"), "operator": "and"}
+        return {"match": {nombre: {**opciones, "fuzziness": "AUTO"}}}
+    return _aplicar(consulta, difuso), "admitiendo errores de escritura"
+
+
+RELAJACIONES = {
+    "fecha": sin_fecha,
+    "servicios": servicios_opcionales,
+    "provincia": provincia_completa,
+    "fuzzy": con_fuzzy,
+}
+
+
+def _aplicar(consulta: dict, funcion) -> dict:
+    query = _transformar(consulta.get("query", {"match_all": {}}), funcion)
+    return {**consulta, "query": query if query is not None else {"match_all": {}}}
+
+
+def variantes_relajadas(consulta: dict, provincia_de=None) -> list:
+    """Versiones cada vez más permisivas de la consulta: [{"nivel", "notas", "consulta"}, ...]."""
+    variantes = []
+    actual = consulta
+    notas = []
+    for nivel in NIVELES:
+        relajada, nota = RELAJACIONES[nivel](actual, provincia_de=provincia_de)
+        if json.dumps(relajada, sort_keys=True) == json.dumps(actual, sort_keys=True):
+            continue
+        actual = relajada
+        notas = notas + [nota]
+        variantes.append({"nivel": nivel, "notas": notas, "consulta": actual})
+    return variantes
+
+
+def busquedas_msearch(indice: str, variantes: list, cuerpo) -> list:
+    """Cuerpo de msearch con la búsqueda completa de cada variante; cuerpo(consulta) da el body de
+    la primera página, así la respuesta de la variante elegida se usa tal cual."""
+    busquedas = []
+    for variante in variantes:
+        busquedas += [{"index": indice}, cuerpo(variante["consulta"])]
+    return busquedas
+
+
+def primera_con_resultados(variantes: list, respuestas: list):
+    """(variante, respuesta) de la primera variante de msearch con algún hit, o (None, None)."""
+    for variante, respuesta in zip(variantes, respuestas):
+        if "error" not in respuesta and respuesta.get("hits", {}).get("total", {}).get("value", 0) > 0:
+            return variante, respuesta
+    return None, None
+
+
+def nota_relajacion(variante: dict) -> str:
+    notas = variante["notas"]
+    texto = notas[0] if len(notas) == 1 else ", ".join(notas[:-1]) + " y " + notas[-1]
+    return f"No hay hoteles que cumplan todo lo pedido; estos son los resultados {texto}."